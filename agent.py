@@ -1,4 +1,6 @@
+import asyncio
 import logging
+import sys
 
 from dotenv import load_dotenv
 from livekit.agents import (
@@ -9,25 +11,59 @@ from livekit.agents import (
     cli,
     llm,
     metrics,
+    utils,
 )
 from livekit.agents.pipeline import VoicePipelineAgent
 from livekit.plugins import (
     cartesia,
     openai,
     deepgram,
-    noise_cancellation,
-    silero,
     turn_detector,
 )
 
 from datetime import datetime
 
+from chat_context import CHAT_SUMMARY_MODEL, ChatContextWindow, load_tokenizer
+from tts_cache import CachedTTS, fill_tts_cache, fixed_phrases, load_tts_cache
+from session_data import SessionData
+from turn_metrics import TurnMetrics
+from warmup import (
+    DEEPGRAM_URL,
+    WarmupTimings,
+    create_openai_client,
+    load_noise_cancellation,
+    load_vad,
+    warm_http,
+    warm_openai,
+    warm_session,
+    warm_tts,
+    warm_turn_detector,
+)
+
 load_dotenv(dotenv_path=".env.local")
 logger = logging.getLogger("voice-agent")
 
+GREETING = "Hey, how can I help you today?"
+
+
+def create_tts(http_session=None):
+    # outside of a job (filling the TTS cache) the plugin needs its own HTTP session, in a
+    # job the one the session warmup opens its connection with
+    return cartesia.TTS(http_session=http_session)
+
 
 def prewarm(proc: JobProcess):
-    proc.userdata["vad"] = silero.VAD.load()
+    timings = WarmupTimings("process")
+    with timings.timed("tokenizer"):
+        load_tokenizer()
+    with timings.timed("vad"):
+        proc.userdata["vad"] = load_vad()
+    with timings.timed("noise_cancellation"):
+        proc.userdata["noise_cancellation"] = load_noise_cancellation()
+    with timings.timed("tts_cache"):
+        # audio of the greeting, synthesized when the worker starts
+        proc.userdata["tts_cache"] = load_tts_cache(create_tts, fixed_phrases(GREETING))
+    timings.report()
 
 
 async def entrypoint(ctx: JobContext):
@@ -44,34 +80,57 @@ async def entrypoint(ctx: JobContext):
     logger.info(f"connecting to room {ctx.room.name}")
     await ctx.connect(auto_subscribe=AutoSubscribe.AUDIO_ONLY)
 
+    # the plugins are created and warmed while waiting for the participant
+    # This project is configured to use Deepgram STT, OpenAI LLM and Cartesia TTS plugins
+    # Other great providers exist like Cerebras, ElevenLabs, Groq, Play.ht, Rime, and more
+    # Learn more and pick the best one for your app:
+    # https://docs.livekit.io/agents/plugins
+    tts_cache = ctx.proc.userdata.get("tts_cache")
+    http_session = utils.http_context.http_session()
+    openai_client = create_openai_client()
+    ctx.add_shutdown_callback(lambda: openai_client.close())
+    agent_stt = deepgram.STT(http_session=http_session)
+    agent_llm = openai.LLM(model="gpt-4o-mini", client=openai_client)
+    agent_tts = create_tts(http_session)
+    if tts_cache is not None:
+        agent_tts = CachedTTS(agent_tts, tts_cache)
+    # use LiveKit's transformer-based turn detector
+    eou_model = turn_detector.EOUModel()
+    # referenced until the warmup is done
+    warmup_task = asyncio.create_task(warm_session({
+        "turn_detector": lambda: warm_turn_detector(eou_model),
+        "stt": lambda: warm_http(http_session, DEEPGRAM_URL),
+        "llm": lambda: warm_openai(openai_client),
+        "tts": lambda: warm_tts(agent_tts),
+    }))
+
     # Wait for the first participant to connect
     participant = await ctx.wait_for_participant()
     logger.info(f"starting voice assistant for participant {participant.identity}")
+    # transcript of the session, written to TRANSCRIPT_FILE in the background
+    session_data = SessionData(ctx.job.id, room=ctx.room.name, participant=participant.identity)
+    ctx.add_shutdown_callback(session_data.aclose)
     
+    # the conversation sent to the LLM stays within CHAT_CONTEXT_TOKENS, older turns are summarized
+    chat_window = ChatContextWindow(summarize_llm=openai.LLM(model=CHAT_SUMMARY_MODEL) if CHAT_SUMMARY_MODEL else None)
+    ctx.add_shutdown_callback(chat_window.aclose)
+
     async def llm_cb(assistant: VoicePipelineAgent, chat_ctx: llm.ChatContext):
-        logger.info(f"lm_cb assistant room: {str(assistant._room)} chat_ctx: {str(chat_ctx)}")
-        if len(chat_ctx.messages) > 6:
-            chat_ctx.messages.pop(1)
-        # if len(chat_ctx.messages) > 15:
-        #     chat_ctx.messages = chat_ctx.messages[-15:]
-    # This project is configured to use Deepgram STT, OpenAI LLM and Cartesia TTS plugins
-    # Other great providers exist like Cerebras, ElevenLabs, Groq, Play.ht, Rime, and more
-    # Learn more and pick the best one for your app:
-    # https://docs.livekit.io/agents/plugins
+        chat_window.fit(chat_ctx)
+        session_data.sample_llm_request(chat_ctx, chat_window.prompt_tokens)
     agent = VoicePipelineAgent(
         vad=ctx.proc.userdata["vad"],
-        stt=deepgram.STT(),
-        llm=openai.LLM(model="gpt-4o-mini"),
-        tts=cartesia.TTS(),
-        # use LiveKit's transformer-based turn detector
-        turn_detector=turn_detector.EOUModel(),
+        stt=agent_stt,
+        llm=agent_llm,
+        tts=agent_tts,
+        turn_detector=eou_model,
         # minimum delay for endpointing, used when turn detector believes the user is done with their turn
         min_endpointing_delay=0.5,
         # maximum delay for endpointing, used when turn detector does not believe the user is done with their turn
         max_endpointing_delay=5.0,
         # enable background voice & noise cancellation, powered by Krisp
         # included at no additional cost with LiveKit Cloud
-        noise_cancellation=noise_cancellation.BVC(),
+        noise_cancellation=ctx.proc.userdata["noise_cancellation"],
         chat_ctx=initial_ctx,
         before_llm_cb=llm_cb
     )
@@ -88,11 +147,16 @@ async def entrypoint(ctx: JobContext):
         logger.info("agent_speech_committed handler attached")
 
     usage_collector = metrics.UsageCollector()
+    # per-turn latency of each stage, written to METRICS_FILE (see turn_metrics.py)
+    turn_metrics = TurnMetrics(room=ctx.room.name)
 
     @agent.on("metrics_collected")
     def on_metrics_collected(agent_metrics: metrics.AgentMetrics):
         metrics.log_metrics(agent_metrics)
+        if isinstance(agent_metrics, metrics.PipelineLLMMetrics) and not agent_metrics.cancelled:
+            chat_window.observe_ttft(agent_metrics.ttft)
         usage_collector.collect(agent_metrics)
+        turn_metrics.collect(agent_metrics)
 
     # user_speech_committed
     @agent.on("user_speech_committed")
@@ -113,7 +177,7 @@ async def entrypoint(ctx: JobContext):
                 "is_final": True,
                 "timestamp": datetime.now().isoformat()
             }
-            # session_data.add_stt_transcript(transcript)
+            session_data.add_stt_transcript(transcript)
             logger.info(f"Added user speech to session data {str(transcript)}")
         except Exception as e:
             logger.error(f"Error processing user speech: {str(e)}", exc_info=True)
@@ -137,7 +201,7 @@ async def entrypoint(ctx: JobContext):
                 "text": content,
                 "timestamp": datetime.now().isoformat()
             }
-            # session_data.add_llm_message(message)
+            session_data.add_llm_message(message)
             logger.info(f"Added agent speech to session data {str(message)}")
         except Exception as e:
             logger.error(f"Error processing agent speech: {str(e)}", exc_info=True)
@@ -145,10 +209,13 @@ async def entrypoint(ctx: JobContext):
     agent.start(ctx.room, participant)
 
     # The agent should be polite and greet the user when it joins :)
-    await agent.say("Hey, how can I help you today?", allow_interruptions=True)
+    await agent.say(GREETING, allow_interruptions=True)
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] != ["download-files"]:
+        # synthesize the fixed phrases not cached yet once, in the worker process
+        asyncio.run(fill_tts_cache(create_tts, fixed_phrases(GREETING)))
     cli.run_app(
         WorkerOptions(
             entrypoint_fnc=entrypoint,
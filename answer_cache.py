@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import dataclasses
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from livekit.agents import llm
+from livekit.agents.types import DEFAULT_API_CONNECT_OPTIONS
+from livekit.plugins import llama_index
+from llama_index.core import Settings
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import NodeWithScore
+
+from chat_context import is_opener
+from retrieval import normalize_question
+from vector_store import normalize
+
+logger = logging.getLogger("answer-cache")
+
+# next to the chatbot's persisted index, shared by the job processes serving the chatbot
+ANSWER_CACHE_NAME = "answer_cache.sqlite"
+# seconds an entry is used, and entries kept per kind (answers, retrievals), least recently used out first
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))
+# cosine similarity of two questions' embeddings for them to be the same question, 0 for exact matches only
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+# question embeddings kept in memory, so the answer lookup and the retrieval embed a question once
+EMBEDDINGS_KEPT = 32
+# seconds the session end waits for the answers and retrievals still being stored
+CLOSE_TIMEOUT = 5
+
+ANSWER = "answer"
+RETRIEVAL = "retrieval"
+
+class KnowledgeCache:
+    """
+    Answers and retrieved nodes of the questions asked to a chatbot, in SQLite, keyed by
+    normalized question. A question matches an entry exactly (get(), no embedding) or
+    by the cosine similarity of its embedding of at least ``similarity`` (get_similar(),
+    raced against the retrieval or the LLM rather than awaited before them). Entries belong to one
+    version of the index (indexer.index_version()): entries of older versions are never
+    returned and are deleted by the next write, like entries older than ``ttl``.
+    """
+
+    def __init__(self, persist_dir, version, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_SIZE,
+                 similarity=ANSWER_CACHE_SIMILARITY, embed_model=None):
+        self.version = version
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.embed_model = embed_model
+        self.embeddings = collections.OrderedDict()  # normalized question -> embedding task
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(persist_dir, ANSWER_CACHE_NAME), timeout=5,
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (kind TEXT NOT NULL, key TEXT NOT NULL, version INTEGER NOT NULL, "
+            "embedding BLOB, value TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL, PRIMARY KEY (kind, key))")
+
+    async def embedding(self, question):
+        """
+        Normalized embedding of the question, None when only exact matches are used. One
+        embedding request per question, shared by the lookups, the vector retrieval
+        (retrieval.QueryEmbeddingRetriever) and the stores of the question.
+        """
+        if self.similarity <= 0:
+            return None
+        key = normalize_question(question)
+        task = self.embeddings.get(key)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = self.embeddings[key] = asyncio.ensure_future(self._embed(question))
+            if len(self.embeddings) > EMBEDDINGS_KEPT:
+                self.embeddings.popitem(last=False)
+        # a caller giving up (a retrieval over its budget) does not cancel it for the others
+        return await asyncio.shield(task)
+
+    async def _embed(self, question):
+        embed_model = self.embed_model or Settings.embed_model
+        return normalize(np.asarray(await embed_model.aget_query_embedding(question), dtype=np.float32))
+
+    def lookup(self, kind, question, embedding=None):
+        key = normalize_question(question)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT key, value FROM entries WHERE kind = ? AND key = ? AND version = ? AND created > ?",
+                (kind, key, self.version, now - self.ttl)).fetchone()
+            if row is None and embedding is not None:
+                rows = self.connection.execute(
+                    "SELECT key, value, embedding FROM entries "
+                    "WHERE kind = ? AND version = ? AND created > ? AND embedding IS NOT NULL",
+                    (kind, self.version, now - self.ttl)).fetchall()
+                if rows:
+                    similarities = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows]) @ embedding
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity:
+                        row = rows[best]
+            if row is None:
+                return None
+            with self.connection:
+                self.connection.execute("UPDATE entries SET used = ? WHERE kind = ? AND key = ?", (now, kind, row[0]))
+        return json.loads(row[1])
+
+    def store(self, kind, question, value, embedding=None):
+        now = time.time()
+        embedding = embedding.astype(np.float32).tobytes() if embedding is not None else None
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries (kind, key, version, embedding, value, created, used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, normalize_question(question), self.version, embedding, json.dumps(value, ensure_ascii=False),
+                 now, now))
+            # versions are the index state's mtime, older ones are indexes replaced since
+            self.connection.execute("DELETE FROM entries WHERE version < ? OR created <= ?",
+                                    (self.version, now - self.ttl))
+            self.connection.execute(
+                "DELETE FROM entries WHERE kind = ? AND key NOT IN "
+                "(SELECT key FROM entries WHERE kind = ? ORDER BY used DESC LIMIT ?)",
+                (kind, kind, self.max_entries))
+
+    async def get(self, kind, question):
+        """The cached value of the question matching exactly, None on a miss."""
+        return await asyncio.to_thread(self.lookup, kind, question)
+
+    async def get_similar(self, kind, question):
+        """The cached value of a question similar to this one, once it is embedded; None on a miss."""
+        try:
+            embedding = await self.embedding(question)
+            if embedding is None:
+                return None
+            return await asyncio.to_thread(self.lookup, kind, question, embedding)
+        except Exception as e:
+            # the retrieval or the LLM it is raced against answers instead
+            logger.warning(f"no similar question lookup for {question!r}: {e!r}")
+            return None
+
+    def put(self, kind, question, value):
+        """Store the value of the question in the background, with its embedding once there."""
+        task = asyncio.ensure_future(self._put(kind, question, value))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _put(self, kind, question, value):
+        try:
+            embedding = await self.embedding(question)
+        except Exception:
+            embedding = None
+        try:
+            await asyncio.to_thread(self.store, kind, question, value, embedding)
+        except sqlite3.Error:
+            logger.exception(f"failed to cache the {kind} of {question!r}")
+
+    async def aclose(self, reason=None):
+        # also a job shutdown callback, which gets the shutdown reason
+        if self.pending:
+            await asyncio.wait(self.pending, timeout=CLOSE_TIMEOUT)
+        for task in list(self.pending) + list(self.embeddings.values()):
+            task.cancel()
+        with self.lock:
+            self.connection.close()
+
+
+class CachedRetriever(BaseRetriever):
+    """
+    Retriever answering from the KnowledgeCache the questions retrieved for before. After
+    an exact miss, retrieval starts at once and the lookup of a similar question runs
+    alongside it, used when it hits first; both share the question embedding (see
+    KnowledgeBase.as_retriever(embed=...)), so the retrieval budget still holds.
+    ``on_retrieved`` is called with the seconds each retrieval took.
+    """
+
+    def __init__(self, retriever, cache, docstore, on_retrieved=None):
+        super().__init__()
+        self._retriever = retriever
+        self._cache = cache
+        self._docstore = docstore
+        self._on_retrieved = on_retrieved
+
+    def _retrieve(self, query_bundle):
+        # the agent retrieves asynchronously; synchronous retrievals are not cached
+        return self._retriever.retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle):
+        start = time.perf_counter()
+        nodes = await self._cached_retrieve(query_bundle)
+        if self._on_retrieved is not None:
+            self._on_retrieved(time.perf_counter() - start)
+        return nodes
+
+    def _cached_nodes(self, query_bundle, hits):
+        logger.info(f"retrieval of {query_bundle.query_str!r} from the cache")
+        nodes = self._docstore.get_nodes([node_id for node_id, _ in hits])
+        return [NodeWithScore(node=node, score=score) for node, (_, score) in zip(nodes, hits)]
+
+    async def _cached_retrieve(self, query_bundle):
+        hits = await self._cache.get(RETRIEVAL, query_bundle.query_str)
+        if hits is not None:
+            return self._cached_nodes(query_bundle, hits)
+        retrieval = asyncio.ensure_future(self._retriever.aretrieve(query_bundle))
+        similar = asyncio.ensure_future(self._cache.get_similar(RETRIEVAL, query_bundle.query_str))
+        try:
+            await asyncio.wait({retrieval, similar}, return_when=asyncio.FIRST_COMPLETED)
+            if not retrieval.done() and similar.result() is not None:
+                return self._cached_nodes(query_bundle, similar.result())
+            nodes = await retrieval
+        finally:
+            retrieval.cancel()
+            similar.cancel()
+        self._cache.put(RETRIEVAL, query_bundle.query_str, [[node.node.node_id, node.score] for node in nodes])
+        return nodes
+
+
+class CachedLLM(llm.LLM):
+    """
+    llama_index.LLM (the chat engine as the agent's LLM) answering from the
+    KnowledgeCache a question that opens the conversation and was answered before.
+    Later questions may refer to the conversation, so they are always answered by the
+    chat engine (whose retrieval can still come from the cache, see CachedRetriever).
+    """
+
+    def __init__(self, *, chat_engine, cache):
+        super().__init__()
+        self._chat_engine_llm = llama_index.LLM(chat_engine=chat_engine)
+        self._cache = cache
+
+    def chat(self, *, chat_ctx, conn_options=DEFAULT_API_CONNECT_OPTIONS, fnc_ctx=None, **kwargs):
+        if fnc_ctx is not None:
+            logger.warning("fnc_ctx is currently not supported with CachedLLM")
+        # from the context, as the agent may request the answer to the same question again
+        return CachedLLMStream(self, chat_engine_llm=self._chat_engine_llm, cache=self._cache, chat_ctx=chat_ctx,
+                               conn_options=conn_options, opener=is_opener(chat_ctx))
+
+
+class CachedLLMStream(llm.LLMStream):
+    def __init__(self, cached_llm, *, chat_engine_llm, cache, chat_ctx, conn_options, opener):
+        # the chat engine stream retries by itself
+        super().__init__(cached_llm, chat_ctx=chat_ctx, fnc_ctx=None,
+                         conn_options=dataclasses.replace(conn_options, max_retry=0))
+        self._chat_engine_llm = chat_engine_llm
+        self._cache = cache
+        self._inner_options = conn_options
+        self._opener = opener
+
+    def _send(self, content):
+        self._event_ch.send_nowait(
+            llm.ChatChunk(request_id="", choices=[llm.Choice(delta=llm.ChoiceDelta(role="assistant", content=content))]))
+
+    async def _run(self):
+        question = self._chat_ctx.messages[-1].content
+        cacheable = self._opener and isinstance(question, str)
+        similar = None
+        if cacheable:
+            answer = await self._cache.get(ANSWER, question)
+            if answer is not None:
+                logger.info(f"answer to {question!r} from the cache")
+                self._send(answer)
+                return
+            # the chat engine starts at once, a similar question's answer is used if found before its first token
+            similar = asyncio.ensure_future(self._cache.get_similar(ANSWER, question))
+
+        parts = []
+        try:
+            async with self._chat_engine_llm.chat(chat_ctx=self._chat_ctx, conn_options=self._inner_options) as stream:
+                chunks = aiter(stream)
+                chunk = asyncio.ensure_future(anext(chunks, None))
+                if similar is not None:
+                    await asyncio.wait({chunk, similar}, return_when=asyncio.FIRST_COMPLETED)
+                    if similar.done() and similar.result() is not None:
+                        chunk.cancel()
+                        logger.info(f"answer to {question!r} from the cache (similar question)")
+                        self._send(similar.result())
+                        return
+                chunk = await chunk
+                while chunk is not None:
+                    self._event_ch.send_nowait(chunk)
+                    parts.extend(choice.delta.content or '' for choice in chunk.choices)
+                    chunk = await anext(chunks, None)
+        finally:
+            if similar is not None:
+                similar.cancel()
+        # an interrupted answer cancels this task before it is cached
+        if cacheable and ''.join(parts).strip():
+            self._cache.put(ANSWER, question, ''.join(parts))
@@ -0,0 +1,182 @@
+"""
+Compare downloader.clean_html with the BeautifulSoup implementation it replaced.
+
+Every page of the corpus is cleaned by both implementations; the outputs must match
+(flat output, and the pretty output against the old clean_html + prettify() re-parse)
+and the timings of both are reported.
+
+    python benchmarks/fetch_corpus.py            # real pages, see corpus_urls.txt
+    python benchmarks/clean_html_benchmark.py [--synthetic] [extra .html files or dirs]
+
+``--synthetic`` adds generated stress pages (large product grids, deep and wide DOMs)
+so the benchmark also runs without network access.
+
+The old pipeline parsed the cleaned HTML again with html.parser, which turned literal
+"<" and "&" in page text into markup; pages where only that differs are reported as
+``escaped`` instead of failing.
+"""
+import argparse
+import contextlib
+import glob
+import io
+import os
+import random
+import re
+import string
+import sys
+import time
+from typing import List, Union
+
+from bs4 import BeautifulSoup, Comment, NavigableString, Tag
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from downloader import ALLOWED_ATTRS, MEANINGFUL_TAGS, REMOVE_TAGS, clean_html
+
+CORPUS_DIR = os.path.join(BENCHMARK_DIR, "corpus")
+
+
+def legacy_clean_html(html: str) -> str:
+    """downloader.clean_html before the single pass rewrite, kept as the reference."""
+    def process_tag(tag: Union[Tag, NavigableString]) -> List[str]:
+        if isinstance(tag, NavigableString):
+            return [str(tag).strip()] if tag.strip() else []
+
+        if tag.name not in MEANINGFUL_TAGS:
+            return sum((process_tag(child) for child in tag.children), [])
+
+        attrs = ' '.join(f'{k}="{v}"' for k, v in tag.attrs.items() if k in ALLOWED_ATTRS.get(tag.name, []))
+        opening_tag = f"<{tag.name}{f' {attrs}' if attrs else ''}>"
+        closing_tag = f"</{tag.name}>"
+
+        content = ' '.join(sum((process_tag(child) for child in tag.children), []))
+        return [f"{opening_tag}{content}{closing_tag}"]
+
+    try:
+        soup = BeautifulSoup(html, 'lxml')
+        for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
+            comment.extract()
+        for tag in soup.find_all(style=True):
+            if tag is not None and tag.get_text() and tag['style'] is not None:
+                style = tag['style'].translate({ord(c): None for c in string.whitespace})
+                if ('display:none' in style) or ('visibility:hidden' in style):
+                    tag.decompose()
+        for tag in soup.find_all():
+            if not tag.contents or not ''.join(tag.stripped_strings):
+                tag.decompose()
+        for tag in soup.find_all(REMOVE_TAGS):
+            tag.decompose()
+
+        processed_content = sum((process_tag(tag) for tag in soup.body.children
+                                 if isinstance(tag, Tag) or (isinstance(tag, NavigableString) and tag.strip())), [])
+        formatted_output = ' '.join(processed_content)
+        formatted_output = re.sub(r'\n{3,}', '\n\n', formatted_output)
+        return formatted_output.strip()
+    except Exception:
+        return ""
+
+
+def legacy_download_html(html: str) -> str:
+    """What download_html_page used to save: the cleaned HTML re-parsed and prettified."""
+    return str(BeautifulSoup(legacy_clean_html(html), 'html.parser').prettify())
+
+
+def synthetic_pages():
+    """Deterministic stress pages shaped like the slow e-commerce pages we ingest."""
+    rng = random.Random(0)
+    words = ["トヨタ", "プリウス", "ハイブリッド", "価格", "在庫あり", "送料無料", "Toyota", "Prius", "SUV", "カタログ"]
+
+    def sentence():
+        return " ".join(rng.choice(words) for _ in range(rng.randint(3, 12)))
+
+    items = []
+    for i in range(3000):
+        hidden = ' style="display: none"' if i % 7 == 0 else ''
+        items.append(
+            f'<div class="product"{hidden}><div class="thumb"><a href="/item/{i}"><img src="/img/{i}.jpg" alt="{i}"></a></div>'
+            f'<div class="body"><h3><a href="/item/{i}" title="item {i}">{sentence()}</a></h3>'
+            f'<span class="price">¥{rng.randint(1000, 99999)}</span><p>{sentence()}</p>'
+            f'<ul class="tags">{"".join(f"<li><span>{w}</span></li>" for w in rng.sample(words, 4))}</ul>'
+            f'<script>track({i})</script><!-- item {i} --><div class="empty"><span></span></div></div></div>')
+    yield "synthetic-product-grid", (
+        f'<html><head><title>shop</title><style>.p{{}}</style></head><body><header><nav>menu</nav></header>'
+        f'<main>{"".join(items)}</main><footer>footer</footer></body></html>')
+
+    depth = 200
+    nested = "".join(f'<div class="level-{i}"><span>{sentence()}</span>' for i in range(depth)) + "</div>" * depth
+    yield "synthetic-deep-dom", f"<html><body>{nested}</body></html>"
+
+    rows = "".join(f"<tr>{''.join(f'<td>{sentence()}</td>' for _ in range(12))}</tr>" for _ in range(1500))
+    yield "synthetic-wide-table", f"<html><body><table>{rows}</table></body></html>"
+
+
+def corpus_pages(paths):
+    files = []
+    for path in paths:
+        if path == CORPUS_DIR and not os.path.exists(path):
+            continue
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.htm*"))))
+        else:
+            files.append(path)
+    for file in files:
+        with open(file, encoding="UTF-8", errors="replace") as f:
+            yield os.path.basename(file), f.read()
+
+
+def has_markup_characters(cleaned):
+    """True when the text (not the tags) of a clean_html output contains "<" or "&"."""
+    text = re.sub(r'</?(?:%s)(?: [^>]*)?>' % '|'.join(MEANINGFUL_TAGS), '', cleaned)
+    return '<' in text or '&' in text
+
+
+def timed(function, *args, **kwargs):
+    # clean_html prints progress lines, keep them out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+
+def main(paths, synthetic):
+    pages = list(corpus_pages(paths))
+    if synthetic:
+        pages.extend(synthetic_pages())
+    if not pages:
+        print("Empty corpus: run benchmarks/fetch_corpus.py, pass HTML files or use --synthetic")
+        return 1
+
+    failures = 0
+    totals = [0.0, 0.0, 0.0, 0.0]
+    print(f"{'page':40} {'KB':>7} {'old':>8} {'new':>8} {'old+pp':>8} {'new pp':>8}  result")
+    for name, html in pages:
+        old, old_time = timed(legacy_clean_html, html)
+        new, new_time = timed(clean_html, html)
+        old_pretty, old_pretty_time = timed(legacy_download_html, html)
+        new_pretty, new_pretty_time = timed(clean_html, html, pretty=True)
+        for i, elapsed in enumerate((old_time, new_time, old_pretty_time, new_pretty_time)):
+            totals[i] += elapsed
+        if old != new:
+            result = "MISMATCH"
+            failures += 1
+        elif old_pretty != new_pretty:
+            result = "escaped" if has_markup_characters(new) else "MISMATCH (pretty)"
+            failures += result != "escaped"
+        else:
+            result = "ok"
+        print(f"{name[:40]:40} {len(html) / 1024:7.0f} {old_time:8.3f} {new_time:8.3f} "
+              f"{old_pretty_time:8.3f} {new_pretty_time:8.3f}  {result}")
+
+    print(f"{'total':40} {'':7} {totals[0]:8.3f} {totals[1]:8.3f} {totals[2]:8.3f} {totals[3]:8.3f}")
+    print(f"speedup clean_html {totals[0] / totals[1]:.1f}x, with prettify {totals[2] / totals[3]:.1f}x, "
+          f"{failures} mismatching page(s)")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark downloader.clean_html")
+    parser.add_argument('paths', nargs='*', help='HTML files or directories (default: benchmarks/corpus)')
+    parser.add_argument('--synthetic', action='store_true', help='Add generated stress pages')
+    args = parser.parse_args()
+    sys.exit(main(args.paths or [CORPUS_DIR], args.synthetic))
@@ -0,0 +1,55 @@
+"""
+Save rendered pages into benchmarks/corpus/ for clean_html_benchmark.py.
+
+Pages are rendered with the downloader's BrowserPool, so the corpus holds the same
+HTML that clean_html receives during an ingest. The pages belong to their sites and
+are not committed; re-run this script to rebuild the corpus.
+
+    python benchmarks/fetch_corpus.py [--urls-file benchmarks/corpus_urls.txt]
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from downloader import BrowserPool
+
+CORPUS_DIR = os.path.join(BENCHMARK_DIR, "corpus")
+
+
+async def fetch_page(browser_pool, url):
+    try:
+        async with browser_pool.page() as page:
+            await page.goto(url, timeout=30000)
+            await page.wait_for_load_state("load")
+            await page.wait_for_timeout(2000)
+            content = await page.content()
+    except Exception as e:
+        print(f"Failed: {url} -> {e}")
+        return
+    name = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12] + ".html"
+    with open(os.path.join(CORPUS_DIR, name), "w", encoding="UTF-8") as f:
+        f.write(content)
+    print(f"Saved {url} as {name} ({len(content)} chars)")
+
+
+async def main(urls):
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    browser_pool = BrowserPool()
+    try:
+        await asyncio.gather(*(fetch_page(browser_pool, url) for url in urls))
+    finally:
+        await browser_pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fetch the clean_html benchmark corpus")
+    parser.add_argument('--urls-file', default=os.path.join(BENCHMARK_DIR, "corpus_urls.txt"))
+    args = parser.parse_args()
+    with open(args.urls_file, encoding="UTF-8") as f:
+        urls = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    asyncio.run(main(urls))
@@ -0,0 +1,129 @@
+"""
+Measure how long a job process takes to load the knowledge index and how much memory
+the loaded copies take, for the JSON vector store the agent used to load at import (a
+converted copy of the index) and the memory-mapped vectors loaded by indexer.load_index().
+
+    python benchmarks/index_load_benchmark.py [--persist-dir DIR] [--documents N] [--processes N]
+
+Without ``--persist-dir`` a synthetic index (mock embeddings, no API calls) is built in
+a temporary directory. Each mode starts ``--processes`` fresh spawned processes, like
+the agent's job processes, and reports their load time, first query time and summed
+RSS / PSS (PSS splits shared pages between the processes sharing them, so it shows
+what the processes really cost together).
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+EMBED_DIM = 1536
+
+
+def use_mock_embeddings():
+    from llama_index.core import Settings
+    from llama_index.core.embeddings import MockEmbedding
+    Settings.embed_model = MockEmbedding(embed_dim=EMBED_DIM)
+
+
+def build_synthetic_index(directory, documents):
+    from indexer import update_index
+    chatbot_dir = os.path.join(directory, "documents")
+    os.makedirs(chatbot_dir)
+    for i in range(documents):
+        with open(os.path.join(chatbot_dir, f"{i}.txt"), 'w', encoding="UTF-8") as f:
+            f.write(f"トヨタ プリウス ハイブリッド 価格 {i} " * 300)
+    persist_dir = os.path.join(directory, "storage")
+    update_index(chatbot_dir, persist_dir)
+    return persist_dir
+
+
+def write_json_copy(persist_dir, directory):
+    """Copy of the index with its vectors in the JSON SimpleVectorStore instead."""
+    from llama_index.core.vector_stores import SimpleVectorStore
+    from llama_index.core.vector_stores.simple import SimpleVectorStoreData
+    from vector_store import VECTOR_NODES_NAME, VECTOR_SCALES_NAME, VECTORS_NAME, MmapVectorStore
+    json_dir = os.path.join(directory, "json")
+    shutil.copytree(persist_dir, json_dir,
+                    ignore=shutil.ignore_patterns(VECTORS_NAME, VECTOR_SCALES_NAME, VECTOR_NODES_NAME))
+    store = MmapVectorStore.from_persist_dir(persist_dir)
+    data = SimpleVectorStoreData(embedding_dict={node_id: store.get(node_id) for node_id in store.node_ids})
+    SimpleVectorStore(data).persist(os.path.join(json_dir, "default__vector_store.json"))
+    return json_dir
+
+
+def load(mode, persist_dir, results, ready, release):
+    use_mock_embeddings()
+    start = time.perf_counter()
+    if mode == "json":
+        from llama_index.core import StorageContext, load_index_from_storage
+        index = load_index_from_storage(StorageContext.from_defaults(persist_dir=persist_dir))
+    else:
+        from indexer import load_index
+        index = load_index(persist_dir)
+    loaded = time.perf_counter()
+    # the first query touches every vector
+    index.as_retriever().retrieve("プリウス")
+    results.put((loaded - start, time.perf_counter() - loaded))
+    ready.wait()
+    release.wait()
+
+
+def memory(pid):
+    """RSS and PSS in MB of a process (PSS only on Linux)."""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                if key in ("Rss", "Pss"):
+                    values[key] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return values.get("Rss", 0.0), values.get("Pss", 0.0)
+
+
+def run(mode, persist_dir, processes):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    ready = context.Barrier(processes + 1)
+    release = context.Event()
+    workers = [context.Process(target=load, args=(mode, persist_dir, results, ready, release))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    ready.wait()
+    load_times, query_times = zip(*(results.get() for _ in workers))
+    rss, pss = map(sum, zip(*(memory(worker.pid) for worker in workers)))
+    release.set()
+    for worker in workers:
+        worker.join()
+    print(f"{mode:5} load median {statistics.median(load_times):7.3f}s  max {max(load_times):7.3f}s  "
+          f"first query {statistics.median(query_times):7.3f}s  "
+          f"RSS {rss:8.1f} MB  PSS {pss:8.1f} MB  ({processes} processes)")
+
+
+def main(persist_dir, documents, processes):
+    with tempfile.TemporaryDirectory() as directory:
+        if persist_dir is None:
+            use_mock_embeddings()
+            persist_dir = build_synthetic_index(directory, documents)
+        size = sum(os.path.getsize(os.path.join(persist_dir, name)) for name in os.listdir(persist_dir))
+        print(f"index {persist_dir}: {size / 1024 / 1024:.1f} MB on disk")
+        run("json", write_json_copy(persist_dir, directory), processes)
+        run("mmap", persist_dir, processes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark knowledge index loading in job processes")
+    parser.add_argument('--persist-dir', help='Persisted index (default: a synthetic one)')
+    parser.add_argument('--documents', type=int, default=100, help='Documents of the synthetic index')
+    parser.add_argument('--processes', type=int, default=4, help='Processes loading the index at the same time')
+    args = parser.parse_args()
+    main(args.persist_dir, args.documents, args.processes)
@@ -0,0 +1,584 @@
+"""
+Load test of chatbot_agent.py without network or API keys: how many concurrent sessions
+one worker holds before the latency degrades.
+
+    python benchmarks/session_load_benchmark.py [--sessions 1,2,4,8,16] [--turns 4] [--json]
+
+Each step starts ``--sessions`` sessions at once in a fresh spawned process, like a
+worker with JOB_EXECUTOR=thread (one process for all rooms, with one event loop here).
+Every session runs the real entrypoint of chatbot_agent.py (VoicePipelineAgent with
+the Silero VAD, the knowledge base, answer cache, speculative retrieval, chat context
+window and TTS cache) in a local stand-in for the room, with deterministic local
+plugins in place of the paid services: an STT transcribing scripted questions when it
+hears speech, a turn detector, a llama-index LLM streaming a fixed answer and mock
+embeddings, each with a configurable latency, and a TTS synthesizing speech-like
+audio. A synthetic participant speaks ``--turns`` questions with a speech-like signal
+(real audio frames through the VAD and STT, and back through the agent's audio
+track) and measures the time from the end of each question to the first audio of the
+reply, and from joining to the first audio of the greeting.
+
+Per step it reports the CPU (cores) and memory (RSS growth) per session, the lag of
+the event loop and the turn latency percentiles, plus the per-stage percentiles the
+agent writes to METRICS_FILE (turn_metrics.py). The capacity is the largest step whose
+p95 turn latency stays within ``--degradation`` of the single session one.
+"""
+import argparse
+import asyncio
+import gc
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+CHATBOT = "loadtest"
+EMBED_DIM = 1536
+MIC_SAMPLE_RATE = 48000
+TTS_SAMPLE_RATE = 24000
+FRAME_MS = 20
+# int16 RMS above which audio counts as speech (the synthetic speech is far louder)
+SPEECH_RMS = 300
+# the agent is done speaking after this much silence on its track
+AGENT_SILENCE = 0.6
+# a reply not started this long after the question counts as failed
+REPLY_TIMEOUT = 15.0
+LAG_INTERVAL = 0.05
+QUESTIONS = [
+    "プリウスの価格はいくらですか",
+    "ハイブリッドの燃費を教えてください",
+    "試乗の予約はできますか",
+    "保証期間はどのくらいですか",
+    "納車までどのくらいかかりますか",
+]
+ANSWER = ("ご質問ありがとうございます。プリウスのハイブリッドモデルは燃費が良く、"
+          "価格はグレードによって異なります。詳しくは販売店までお問い合わせください。")
+SECONDS_PER_CHAR = 0.08
+MAX_REPLY_SECONDS = 4.0
+
+
+def speech(seconds, sample_rate, seed=0):
+    """A speech-like signal (voiced syllables at 4 Hz with a moving pitch) the Silero VAD detects as speech."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.7 * t) + 10 * np.sin(2 * np.pi * 5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    signal = sum(np.sin(k * phase) * (1 + np.cos(2 * np.pi * (0.3 + 0.1 * k) * t)) / k for k in range(1, 25))
+    signal = signal * np.clip(np.sin(2 * np.pi * 4 * t), 0, None) ** 0.5 + 0.02 * rng.standard_normal(len(t))
+    return (signal / np.abs(signal).max() * 0.5 * 32767).astype(np.int16)
+
+
+def rms(frame):
+    samples = np.frombuffer(frame.data, dtype=np.int16).astype(np.float32)
+    return float(np.sqrt(np.mean(samples ** 2))) if len(samples) else 0.0
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def define_plugins(args):
+    """The local stand-ins of Deepgram, the turn detector, OpenAI (LLM and embeddings) and the TTS."""
+    from livekit import rtc
+    from livekit.agents import stt, tts, utils
+    from llama_index.core.embeddings import MockEmbedding
+    from llama_index.core.llms import CompletionResponse, CustomLLM, LLMMetadata
+    from llama_index.core.llms.callbacks import llm_completion_callback
+
+    question_numbers = itertools.count()
+
+    class FakeRecognizeStream(stt.RecognizeStream):
+        async def _run(self):
+            speaking = False
+            voiced = silent = interim_at = 0.0
+            text = ""
+            async for frame in self._input_ch:
+                if isinstance(frame, self._FlushSentinel):
+                    continue
+                duration = frame.samples_per_channel / frame.sample_rate
+                if rms(frame) > SPEECH_RMS:
+                    if not speaking:
+                        speaking, voiced, interim_at = True, 0.0, 0.0
+                        number = next(question_numbers)
+                        # numbered, so repeated questions (in this step or the previous ones) miss the answer cache
+                        text = f"{QUESTIONS[number % len(QUESTIONS)]} {args.step}-{number}"
+                    voiced += duration
+                    silent = 0.0
+                    if voiced - interim_at >= args.interim_interval:
+                        interim_at = voiced
+                        self._event_ch.send_nowait(stt.SpeechEvent(
+                            type=stt.SpeechEventType.INTERIM_TRANSCRIPT,
+                            alternatives=[stt.SpeechData(language="ja", text=text[:int(voiced * 6)])]))
+                elif speaking:
+                    silent += duration
+                    if silent >= args.stt_final_delay:
+                        speaking = False
+                        self._event_ch.send_nowait(stt.SpeechEvent(
+                            type=stt.SpeechEventType.FINAL_TRANSCRIPT,
+                            alternatives=[stt.SpeechData(language="ja", text=text, confidence=1.0)]))
+
+    class FakeSTT(stt.STT):
+        def __init__(self):
+            super().__init__(capabilities=stt.STTCapabilities(streaming=True, interim_results=True))
+
+        async def _recognize_impl(self, buffer, *, language=None, conn_options=None):
+            raise NotImplementedError("only streaming")
+
+        def stream(self, *, language=None, conn_options=None):
+            from livekit.agents import DEFAULT_API_CONNECT_OPTIONS
+            return FakeRecognizeStream(stt=self, conn_options=conn_options or DEFAULT_API_CONNECT_OPTIONS)
+
+    tts_audio = speech(MAX_REPLY_SECONDS, TTS_SAMPLE_RATE, seed=1)
+
+    class FakeChunkedStream(tts.ChunkedStream):
+        async def _run(self):
+            await asyncio.sleep(args.tts_ttfb)
+            request_id = utils.shortuuid()
+            samples = tts_audio[:int(min(len(self._input_text) * SECONDS_PER_CHAR, MAX_REPLY_SECONDS) * TTS_SAMPLE_RATE)]
+            chunk = TTS_SAMPLE_RATE // 10
+            for start in range(0, len(samples), chunk):
+                data = samples[start:start + chunk]
+                self._event_ch.send_nowait(tts.SynthesizedAudio(request_id=request_id, frame=rtc.AudioFrame(
+                    data=data.tobytes(), sample_rate=TTS_SAMPLE_RATE, num_channels=1, samples_per_channel=len(data))))
+
+    class FakeTTS(tts.TTS):
+        def __init__(self):
+            super().__init__(capabilities=tts.TTSCapabilities(streaming=False), sample_rate=TTS_SAMPLE_RATE,
+                             num_channels=1)
+
+        def synthesize(self, text, *, conn_options=None):
+            return FakeChunkedStream(tts=self, input_text=text, conn_options=conn_options)
+
+    class FakeTurnDetector:
+        def unlikely_threshold(self, language):
+            return 0.15
+
+        def supports_language(self, language):
+            return True
+
+        async def predict_end_of_turn(self, chat_ctx, *, timeout=3):
+            await asyncio.sleep(args.eou_ms / 1000)
+            return 0.9
+
+        async def predict_eou(self, chat_ctx):
+            return await self.predict_end_of_turn(chat_ctx)
+
+    class FakeLLM(CustomLLM):
+        @property
+        def metadata(self):
+            return LLMMetadata()
+
+        @llm_completion_callback()
+        def complete(self, prompt, formatted=False, **kwargs):
+            return CompletionResponse(text=ANSWER)
+
+        @llm_completion_callback()
+        def stream_complete(self, prompt, formatted=False, **kwargs):
+            yield CompletionResponse(text=ANSWER, delta=ANSWER)
+
+        @llm_completion_callback()
+        async def astream_complete(self, prompt, formatted=False, **kwargs):
+            async def stream():
+                await asyncio.sleep(args.llm_ttft)
+                text = ""
+                for start in range(0, len(ANSWER), 2):
+                    text += ANSWER[start:start + 2]
+                    yield CompletionResponse(text=text, delta=ANSWER[start:start + 2])
+                    await asyncio.sleep(1 / args.llm_tokens_per_second)
+            return stream()
+
+    class SlowMockEmbedding(MockEmbedding):
+        def _get_query_embedding(self, query):
+            # a random unit vector per text: different questions are not similar (for the answer cache)
+            rng = np.random.default_rng(int.from_bytes(hashlib.sha256(query.encode("utf-8")).digest()[:8], "little"))
+            vector = rng.standard_normal(self.embed_dim)
+            return (vector / np.linalg.norm(vector)).tolist()
+
+        async def _aget_query_embedding(self, query):
+            await asyncio.sleep(args.embed_ms / 1000)
+            return self._get_query_embedding(query)
+
+    return types.SimpleNamespace(stt=FakeSTT, tts=FakeTTS, turn_detector=FakeTurnDetector, llm=FakeLLM,
+                                 embedding=SlowMockEmbedding)
+
+
+def define_room():
+    """Stand-ins of the room, participants and job context the entrypoint gets from LiveKit."""
+    from livekit import rtc
+    from livekit.agents import utils
+
+    class Publication:
+        def __init__(self, sid, track, source):
+            self.sid, self.track, self.source = sid, track, source
+            self.subscribed = True
+
+        def set_subscribed(self, subscribed):
+            pass
+
+        async def wait_for_subscription(self):
+            pass
+
+    class LocalParticipant:
+        identity = "agent"
+
+        def __init__(self):
+            self.track_publications = {}
+            self.published = asyncio.get_running_loop().create_future()
+
+        async def publish_track(self, track, options):
+            publication = Publication(f"TR_agent_{len(self.track_publications)}", track, options.source)
+            self.track_publications[publication.sid] = publication
+            if not self.published.done():
+                self.published.set_result(track)
+            return publication
+
+        async def set_attributes(self, attributes):
+            pass
+
+        async def publish_transcription(self, transcription):
+            pass
+
+    class SyntheticParticipant(rtc.RemoteParticipant):
+        """The participant, publishing a microphone track fed by an audio source."""
+
+        def __init__(self, identity):
+            self._identity = identity
+            self.source = rtc.AudioSource(MIC_SAMPLE_RATE, 1)
+            track = rtc.LocalAudioTrack.create_audio_track("microphone", self.source)
+            self._publications = {"TR_mic": Publication("TR_mic", track, rtc.TrackSource.SOURCE_MICROPHONE)}
+
+        identity = property(lambda self: self._identity)
+        track_publications = property(lambda self: self._publications)
+
+    class Room(utils.EventEmitter):
+        def __init__(self, name):
+            super().__init__()
+            self.name = name
+            self.metadata = json.dumps({"chatbot_id": CHATBOT})
+            self.remote_participants = {}
+            self.local_participant = LocalParticipant()
+
+        def isconnected(self):
+            return True
+
+        def agent(self):
+            """The VoicePipelineAgent started in the room (it listens for participants)."""
+            from livekit.agents.pipeline import VoicePipelineAgent
+            for callback in self._events.get("participant_connected", ()):
+                if isinstance(getattr(callback, '__self__', None), VoicePipelineAgent):
+                    return callback.__self__
+            return None
+
+    class JobContext:
+        def __init__(self, proc, room, participant, join_delay):
+            self.proc, self.room = proc, room
+            self.job = types.SimpleNamespace(id=room.name, metadata="")
+            self.participant, self.join_delay = participant, join_delay
+            self.joined = None
+            self.shutdown_callbacks = []
+
+        async def connect(self, auto_subscribe=None):
+            pass
+
+        async def wait_for_participant(self):
+            await asyncio.sleep(self.join_delay)
+            self.room.remote_participants[self.participant.identity] = self.participant
+            self.joined = time.perf_counter()
+            return self.participant
+
+        def add_shutdown_callback(self, callback):
+            self.shutdown_callbacks.append(callback)
+
+        async def shutdown(self):
+            for callback in self.shutdown_callbacks:
+                # like JobContext: callbacks taking an argument get the reason
+                await (callback("benchmark done") if callback.__code__.co_argcount > 0 else callback())
+
+    return types.SimpleNamespace(room=Room, participant=SyntheticParticipant, job_context=JobContext)
+
+
+class Microphone:
+    """Pushes the participant's audio in real time: silence, or the queued speech."""
+
+    def __init__(self, source):
+        self.source = source
+        self.samples = MIC_SAMPLE_RATE * FRAME_MS // 1000
+        self.speech = np.zeros(0, dtype=np.int16)
+        self.spoken = None
+        self.task = asyncio.create_task(self.run())
+
+    def say(self, samples):
+        """Queue ``samples`` and return a future of the time their last frame was pushed."""
+        self.speech = samples
+        self.spoken = asyncio.get_running_loop().create_future()
+        return self.spoken
+
+    async def run(self):
+        from livekit import rtc
+        silence = np.zeros(self.samples, dtype=np.int16)
+        next_frame = time.perf_counter()
+        while True:
+            data, self.speech = self.speech[:self.samples], self.speech[self.samples:]
+            if len(data) < self.samples:
+                data = np.concatenate([data, silence[len(data):]])
+            await self.source.capture_frame(rtc.AudioFrame(
+                data=data.tobytes(), sample_rate=MIC_SAMPLE_RATE, num_channels=1, samples_per_channel=self.samples))
+            if not len(self.speech) and self.spoken is not None and not self.spoken.done():
+                self.spoken.set_result(time.perf_counter())
+            next_frame += FRAME_MS / 1000
+            await asyncio.sleep(max(0.0, next_frame - time.perf_counter()))
+
+
+class Speaker:
+    """Listens to the agent's audio track: when its replies start and whether it is still speaking."""
+
+    def __init__(self, track):
+        from livekit import rtc
+        self.stream = rtc.AudioStream(track, sample_rate=TTS_SAMPLE_RATE, num_channels=1)
+        self.last_voice = 0.0
+        self.started = None
+        self.task = asyncio.create_task(self.run())
+
+    def expect_reply(self):
+        self.started = asyncio.get_running_loop().create_future()
+        return self.started
+
+    async def run(self):
+        async for event in self.stream:
+            if rms(event.frame) > SPEECH_RMS:
+                self.last_voice = time.perf_counter()
+                if self.started is not None and not self.started.done():
+                    self.started.set_result(self.last_voice)
+
+    async def wait_silent(self):
+        while time.perf_counter() - self.last_voice < AGENT_SILENCE:
+            await asyncio.sleep(0.1)
+
+    async def aclose(self):
+        self.task.cancel()
+        await self.stream.aclose()
+
+
+async def run_session(number, args, chatbot_agent, room_types, proc, results):
+    """One room: the agent's entrypoint and a participant asking ``args.turns`` questions."""
+    room = room_types.room(f"loadtest-{args.step}-{number}")
+    participant = room_types.participant(f"user-{number}")
+    ctx = room_types.job_context(proc, room, participant, args.join_delay)
+    microphone = Microphone(participant.source)
+    speaker = None
+    try:
+        await chatbot_agent.entrypoint(ctx)
+        speaker = Speaker(await room.local_participant.published)
+        greeting = speaker.expect_reply()
+        results['greetings'].append(await asyncio.wait_for(greeting, REPLY_TIMEOUT) - ctx.joined)
+        await speaker.wait_silent()
+        for turn in range(args.turns):
+            await asyncio.sleep(args.think_time)
+            reply = speaker.expect_reply()
+            spoken = await microphone.say(speech(args.utterance_seconds, MIC_SAMPLE_RATE, seed=number * 100 + turn))
+            try:
+                results['turns'].append(await asyncio.wait_for(reply, REPLY_TIMEOUT) - spoken)
+            except asyncio.TimeoutError:
+                results['failed'] += 1
+            await speaker.wait_silent()
+    except Exception as e:
+        logging.exception(f"session {number} failed")
+        results['failed'] += 1
+        results['errors'].append(repr(e))
+    finally:
+        agent = room.agent()
+        if agent is not None:
+            await agent.aclose()
+        await ctx.shutdown()
+        microphone.task.cancel()
+        if speaker is not None:
+            await speaker.aclose()
+
+
+async def monitor(samples, stop):
+    """Event loop lag (how late a sleep wakes up) and RSS, until ``stop`` is set."""
+    from index_load_benchmark import memory
+    last_memory = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples['lag'].append(time.perf_counter() - start - LAG_INTERVAL)
+        if start - last_memory > 0.5:
+            last_memory = start
+            samples['rss'] = max(samples['rss'], memory(os.getpid())[0])
+
+
+async def run_step(args, chatbot_agent, room_types, proc):
+    from index_load_benchmark import memory
+    gc.collect()
+    baseline_rss = memory(os.getpid())[0]
+    results = {'greetings': [], 'turns': [], 'failed': 0, 'errors': [], 'lag': [], 'rss': baseline_rss}
+    stop = asyncio.Event()
+    monitor_task = asyncio.create_task(monitor(results, stop))
+    cpu = os.times()
+    start = time.perf_counter()
+    sessions = []
+    for number in range(args.sessions):
+        sessions.append(asyncio.create_task(run_session(number, args, chatbot_agent, room_types, proc, results)))
+        await asyncio.sleep(args.stagger)
+    await asyncio.gather(*sessions)
+    wall = time.perf_counter() - start
+    cpu_seconds = sum(os.times()[:4]) - sum(cpu[:4])
+    stop.set()
+    await monitor_task
+    return {
+        'sessions': args.sessions, 'seconds': round(wall, 1),
+        'cpu_per_session': round(cpu_seconds / wall / args.sessions, 3),
+        'rss_mb_per_session': round((results['rss'] - baseline_rss) / args.sessions, 1),
+        'loop_lag_ms': {f"p{p}": round(percentile(results['lag'], p) * 1000, 1) for p in (50, 99)}
+        | {'max': round(max(results['lag']) * 1000, 1)},
+        'greeting_ms': {f"p{p}": round(percentile(results['greetings'], p) * 1000) for p in (50, 95)}
+        if results['greetings'] else {},
+        'turn_ms': {f"p{p}": round(percentile(results['turns'], p) * 1000) for p in (50, 90, 95, 99)}
+        if results['turns'] else {},
+        'turns': len(results['turns']), 'failed': results['failed'], 'errors': results['errors'][:3],
+    }
+
+
+def step_process(args, directory, output):
+    """A fresh worker process: set up the local plugins, prewarm and run one step."""
+    os.chdir(directory)
+    os.environ.update({"CHATBOT_NAME": CHATBOT, "PREWARM_CHATBOTS": CHATBOT, "CHAT_SUMMARY_MODEL": "",
+                       "METRICS_FILE": "metrics/turns.jsonl", "WORKER_NAME": f"step-{args.step}",
+                       # no provider connections to open (the OpenAI client is created, never used)
+                       "WARMUP": "vad,noise_cancellation,turn_detector,retrieval", "OPENAI_API_KEY": "loadtest"})
+    logging.basicConfig(level=logging.WARNING)
+
+    async def main():
+        from livekit.agents import utils
+        from llama_index.core import Settings
+        import chatbot_agent
+        from tts_cache import fill_tts_cache, fixed_phrases
+        plugins = define_plugins(args)
+        Settings.embed_model = plugins.embedding(embed_dim=EMBED_DIM)
+        Settings.llm = plugins.llm()
+        chatbot_agent.create_stt = lambda http_session=None: plugins.stt()
+        chatbot_agent.create_tts = lambda client=None: plugins.tts()
+        chatbot_agent.create_answer_llm = lambda http_client=None: Settings.llm
+        chatbot_agent.create_turn_detector = plugins.turn_detector
+        # the worker synthesizes the greeting when it starts
+        await fill_tts_cache(lambda http_session: plugins.tts(), fixed_phrases(chatbot_agent.INITITAL_MESSAGE))
+        # the HTTP session a job process provides to its plugins
+        utils.http_context._new_session_ctx()
+        proc = types.SimpleNamespace(userdata={})
+        chatbot_agent.prewarm(proc)
+        if not args.noise_cancellation:
+            proc.userdata["noise_cancellation"] = None
+        output.put(await run_step(args, chatbot_agent, define_room(), proc))
+        await utils.http_context._close_http_ctx()
+        # lets the native audio streams of the closed sessions finish before the loop closes
+        await asyncio.sleep(1)
+
+    asyncio.run(main())
+
+
+def build_index(directory, documents):
+    """A synthetic knowledge base of the chatbot, embedded with mock embeddings (no API calls)."""
+    from llama_index.core import Settings
+    from llama_index.core.embeddings import MockEmbedding
+    from indexer import chatbot_documents_dir, chatbot_persist_dir, update_index
+    Settings.embed_model = MockEmbedding(embed_dim=EMBED_DIM)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        documents_dir = chatbot_documents_dir(CHATBOT)
+        os.makedirs(documents_dir)
+        for i in range(documents):
+            with open(os.path.join(documents_dir, f"{i}.txt"), 'w', encoding="UTF-8") as f:
+                f.write(f"トヨタ プリウス ハイブリッド 価格 燃費 試乗 保証 納車 {i} " * 300)
+        update_index(documents_dir, chatbot_persist_dir(CHATBOT))
+    finally:
+        os.chdir(cwd)
+
+
+def stage_percentiles(directory, step):
+    """p50 / p95 in ms of each stage the agent recorded in METRICS_FILE during a step."""
+    from turn_metrics import STAGES, read_turns
+    path = os.path.join(directory, "metrics", "turns.jsonl")
+    if not os.path.exists(path):
+        return {}
+    turns = [turn for turn in read_turns(path) if turn['worker'] == f"step-{step}"]
+    return {stage: [round(percentile(values, p) * 1000) for p in (50, 95)]
+            for stage in STAGES if (values := [turn[stage] for turn in turns if stage in turn])}
+
+
+def main(args):
+    context = multiprocessing.get_context("spawn")
+    steps = []
+    with tempfile.TemporaryDirectory() as directory:
+        build_index(directory, args.documents)
+        for step, sessions in enumerate(args.sessions):
+            step_args = argparse.Namespace(**{**vars(args), 'sessions': sessions, 'step': step})
+            output = context.Queue()
+            process = context.Process(target=step_process, args=(step_args, directory, output))
+            process.start()
+            result = output.get()
+            process.join()
+            result['stages_ms'] = stage_percentiles(directory, step)
+            steps.append(result)
+            if not args.json:
+                print_step(result)
+    baseline = steps[0].get('turn_ms', {}).get('p95')
+    capacity = max((step['sessions'] for step in steps if step['failed'] == 0 and step.get('turn_ms')
+                    and baseline and step['turn_ms']['p95'] <= baseline * args.degradation), default=0)
+    if args.json:
+        print(json.dumps({'steps': steps, 'capacity': capacity}, ensure_ascii=False, indent=2))
+    else:
+        print(f"capacity: {capacity} sessions within {args.degradation}x the single session p95 turn latency")
+
+
+def print_step(step):
+    turn = step.get('turn_ms', {})
+    print(f"{step['sessions']:4} sessions  CPU/session {step['cpu_per_session']:6.3f} cores  "
+          f"RSS/session {step['rss_mb_per_session']:6.1f} MB  "
+          f"loop lag p99 {step['loop_lag_ms']['p99']:6.1f} ms max {step['loop_lag_ms']['max']:6.1f} ms  "
+          f"greeting p50 {step.get('greeting_ms', {}).get('p50', '-')} ms  "
+          f"turn p50/p95/p99 {turn.get('p50', '-')}/{turn.get('p95', '-')}/{turn.get('p99', '-')} ms  "
+          f"failed {step['failed']}")
+    print("      stages p50/p95 ms: " + ", ".join(f"{stage} {p50}/{p95}"
+                                               for stage, (p50, p95) in step['stages_ms'].items()))
+    for error in step['errors']:
+        print(f"      error: {error}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test chatbot_agent.py sessions with local plugins")
+    parser.add_argument('--sessions', type=lambda value: [int(n) for n in value.split(",")], default=[1, 2, 4, 8, 16],
+                        help='Concurrent sessions of each step, comma separated')
+    parser.add_argument('--turns', type=int, default=4, help='Questions per session')
+    parser.add_argument('--documents', type=int, default=100, help='Documents of the synthetic knowledge base')
+    parser.add_argument('--stagger', type=float, default=0.1, help='Seconds between session starts')
+    parser.add_argument('--join-delay', type=float, default=1.0, help='Seconds from dispatch to the participant')
+    parser.add_argument('--think-time', type=float, default=0.5, help='Seconds between a reply and the next question')
+    parser.add_argument('--utterance-seconds', type=float, default=2.0, help='Duration of each question')
+    parser.add_argument('--interim-interval', type=float, default=0.3, help='Seconds between interim transcripts')
+    parser.add_argument('--stt-final-delay', type=float, default=0.3,
+                        help='Silence before the STT sends the final transcript')
+    parser.add_argument('--eou-ms', type=float, default=20, help='Turn detector inference time')
+    parser.add_argument('--embed-ms', type=float, default=100, help='Query embedding latency')
+    parser.add_argument('--llm-ttft', type=float, default=0.4, help='LLM time to first token')
+    parser.add_argument('--llm-tokens-per-second', type=float, default=50, help='LLM streaming speed')
+    parser.add_argument('--tts-ttfb', type=float, default=0.2, help='TTS time to first byte')
+    parser.add_argument('--noise-cancellation', action='store_true',
+                        help='Keep the Krisp filter on the participant audio (it may need LiveKit Cloud)')
+    parser.add_argument('--degradation', type=float, default=1.25,
+                        help='p95 turn latency ratio to the single session one still within capacity')
+    parser.add_argument('--json', action='store_true', help='Results as JSON')
+    main(parser.parse_args())
@@ -0,0 +1,93 @@
+"""
+Compare the on-disk size, load time, query latency and recall of the vector store
+formats: llama_index's JSON SimpleVectorStore and vector_store.MmapVectorStore with
+float32, float16 and int8 vectors.
+
+    python benchmarks/vector_store_benchmark.py [--rows N] [--dim N] [--queries N] [--formats ...]
+
+Vectors are random (clustered like real embeddings), so no API calls are needed. The
+recall is the overlap of each format's top-k with the exact float32 top-k. JSON is
+only benchmarked when asked for (``--formats json,...``): it takes minutes to load
+beyond a few thousand rows.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.simple import SimpleVectorStoreData
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from vector_store import MmapVectorStore, normalize
+
+
+def synthetic_vectors(rows, dim, rng):
+    centers = rng.normal(size=(max(rows // 50, 1), dim))
+    vectors = centers[rng.integers(len(centers), size=rows)] + rng.normal(scale=0.5, size=(rows, dim))
+    return normalize(vectors.astype(np.float32))
+
+
+def write_store(fmt, directory, node_ids, vectors):
+    path = os.path.join(directory, "default__vector_store.json")
+    if fmt == "json":
+        data = SimpleVectorStoreData(embedding_dict=dict(zip(node_ids, vectors.tolist())))
+        SimpleVectorStore(data).persist(path)
+    else:
+        data = SimpleVectorStoreData(embedding_dict=dict(zip(node_ids, vectors)))
+        MmapVectorStore.from_simple_vector_store(SimpleVectorStore(data), fmt).persist(path)
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def load_store(fmt, directory):
+    if fmt == "json":
+        return SimpleVectorStore.from_persist_dir(directory)
+    return MmapVectorStore.from_persist_dir(directory)
+
+
+def main(rows, dim, queries, top_k, formats):
+    rng = np.random.default_rng(0)
+    vectors = synthetic_vectors(rows, dim, rng)
+    node_ids = [f"node-{i}" for i in range(rows)]
+    query_vectors = synthetic_vectors(queries, dim, rng)
+    exact = [set(np.argsort(-(vectors @ query))[:top_k]) for query in query_vectors]
+    positions = {node_id: i for i, node_id in enumerate(node_ids)}
+
+    print(f"{rows} vectors of {dim} dimensions, {queries} queries, top {top_k}")
+    print(f"{'format':8} {'disk MB':>9} {'load s':>8} {'p50 ms':>8} {'p95 ms':>8} {'recall':>7}")
+    for fmt in formats:
+        with tempfile.TemporaryDirectory() as directory:
+            size = write_store(fmt, directory, node_ids, vectors)
+            start = time.perf_counter()
+            store = load_store(fmt, directory)
+            load_time = time.perf_counter() - start
+
+            latencies = []
+            hits = 0
+            for query, expected in zip(query_vectors, exact):
+                start = time.perf_counter()
+                result = store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=top_k))
+                latencies.append((time.perf_counter() - start) * 1000)
+                hits += len(expected & {positions[node_id] for node_id in result.ids})
+            latencies.sort()
+            print(f"{fmt:8} {size / 1024 / 1024:9.1f} {load_time:8.3f} {statistics.median(latencies):8.2f} "
+                  f"{latencies[int(len(latencies) * 0.95)]:8.2f} {hits / (queries * top_k):7.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the vector store formats")
+    parser.add_argument('--rows', type=int, default=50000, help='Number of vectors')
+    parser.add_argument('--dim', type=int, default=1536, help='Dimensions of the vectors')
+    parser.add_argument('--queries', type=int, default=200, help='Number of queries')
+    parser.add_argument('--top-k', type=int, default=2, help='Results per query (the chat engine uses 2)')
+    parser.add_argument('--formats', default='float32,float16,int8',
+                        help='Comma separated formats among json, float32, float16, int8')
+    args = parser.parse_args()
+    main(args.rows, args.dim, args.queries, args.top_k, args.formats.split(','))
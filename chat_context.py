@@ -0,0 +1,173 @@
+import asyncio
+import functools
+import logging
+import os
+import re
+import statistics
+
+from livekit.agents import llm
+
+logger = logging.getLogger("chat-context")
+
+# tokens of conversation sent with each LLM request, besides the pinned system prompt
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "1500"))
+# model summarizing the turns dropped from the context, empty to drop them without a summary
+CHAT_SUMMARY_MODEL = os.getenv("CHAT_SUMMARY_MODEL", "gpt-4o-mini")
+CHAT_SUMMARY_WORDS = 80
+# tokens every message costs besides its content (role and separators, as counted by OpenAI)
+MESSAGE_OVERHEAD_TOKENS = 4
+# prompt sizes grouped by this many tokens when reporting the time to first token
+TTFT_BUCKET_TOKENS = 500
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below between a user and a voice assistant, including the summary of "
+    f"the earlier conversation if there is one, in at most {CHAT_SUMMARY_WORDS} words and in the language "
+    "of the conversation. Keep names, numbers and what the user asked for."
+)
+# start of the system message holding the summary, which tells a trimmed conversation from a new one
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+# characters of scripts without spaces (CJK, kana), about one token each
+WIDE = re.compile(r'[　-鿿豈-﫿＀-￯]')
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer():
+    """The tiktoken encoding of the OpenAI models, None when it cannot be loaded (it is downloaded once)."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        logger.warning("tiktoken encoding unavailable, estimating token counts from characters")
+        return None
+
+
+def count_tokens(text):
+    tokenizer = load_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text))
+    wide = len(WIDE.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def message_text(msg):
+    if isinstance(msg.content, list):
+        return "\n".join(content for content in msg.content if isinstance(content, str))
+    return msg.content or ""
+
+
+def is_opener(chat_ctx):
+    """
+    Whether the latest message of ``chat_ctx`` is the question opening the conversation:
+    no user message before it and no summary of dropped turns (ChatContextWindow).
+    """
+    return not any(msg.role == "user" or (msg.role == "system" and message_text(msg).startswith(SUMMARY_PREFIX))
+                   for msg in chat_ctx.messages[:-1])
+
+
+class ChatContextWindow:
+    """
+    Keeps the chat context of a session within ``max_tokens`` before each LLM request
+    (call fit() from before_llm_cb): the leading system messages are pinned, then come
+    as many of the latest turns as fit, whole turns from a user message on. Dropped
+    turns are summarized in the background by ``summarize_llm`` (if given) into one
+    system message kept after the pinned ones, so a turn never waits for a summary.
+
+    The prompt size of every request is logged, and observe_ttft() pairs it with the
+    measured time to first token; report() logs the median per prompt size.
+    """
+
+    def __init__(self, max_tokens=CHAT_CONTEXT_TOKENS, summarize_llm=None):
+        self.max_tokens = max_tokens
+        self.summarize_llm = summarize_llm
+        self.tokens = {}  # message id -> tokens
+        self.dropped = set()
+        self.pending = []
+        self.summary = ""
+        self.summary_message = None
+        self.summary_task = None
+        self.prompt_tokens = 0
+        self.samples = []  # (prompt tokens, time to first token)
+
+    def message_tokens(self, msg):
+        if msg.id not in self.tokens:
+            self.tokens[msg.id] = count_tokens(message_text(msg)) + MESSAGE_OVERHEAD_TOKENS
+        return self.tokens[msg.id]
+
+    def fit(self, chat_ctx):
+        """Trim ``chat_ctx`` (the copy of the agent's context a request is built from) in place."""
+        messages = chat_ctx.messages
+        pinned = 0
+        while pinned < len(messages) and messages[pinned].role == "system":
+            pinned += 1
+        summary = [self.summary_message] if self.summary_message is not None else []
+        budget = self.max_tokens - sum(self.message_tokens(msg) for msg in summary)
+
+        kept = len(messages)
+        total = 0
+        # the latest message (the question) is always kept
+        while kept > pinned and (kept == len(messages) or total + self.message_tokens(messages[kept - 1]) <= budget):
+            kept -= 1
+            total += self.message_tokens(messages[kept])
+        # a trimmed conversation starts with a question, not the end of a turn
+        while pinned < kept < len(messages) - 1 and messages[kept].role != "user":
+            total -= self.message_tokens(messages[kept])
+            kept += 1
+
+        dropped = [msg for msg in messages[pinned:kept] if msg.id not in self.dropped]
+        self.dropped.update(msg.id for msg in dropped)
+        if dropped and self.summarize_llm is not None:
+            self.pending.extend(dropped)
+            self.start_summary()
+        logger.info(f"chat context: {len(messages) - kept} of {len(messages) - pinned} messages kept, "
+                    f"~{self.max_tokens - budget + total} of {self.max_tokens} tokens for the conversation")
+        chat_ctx.messages[:] = messages[:pinned] + summary + messages[kept:]
+        self.prompt_tokens = sum(self.message_tokens(msg) for msg in chat_ctx.messages)
+        return chat_ctx
+
+    def start_summary(self):
+        if self.summary_task is not None or not self.pending:
+            return
+        messages, self.pending = self.pending, []
+        self.summary_task = asyncio.create_task(self.update_summary(messages))
+
+    async def update_summary(self, messages):
+        transcript = "\n".join(f"{msg.role}: {message_text(msg)}" for msg in messages
+                               if msg.role in ("user", "assistant"))
+        if self.summary:
+            transcript = f"{SUMMARY_PREFIX}{self.summary}\n\n{transcript}"
+        chat_ctx = llm.ChatContext().append(role="system", text=SUMMARY_PROMPT).append(role="user", text=transcript)
+        try:
+            parts = []
+            async with self.summarize_llm.chat(chat_ctx=chat_ctx) as stream:
+                async for chunk in stream:
+                    parts.extend(choice.delta.content or "" for choice in chunk.choices)
+            self.summary = "".join(parts).strip()
+            self.summary_message = llm.ChatMessage.create(
+                text=f"{SUMMARY_PREFIX}{self.summary}", role="system")
+            logger.info(f"chat summary updated with {len(messages)} messages, ~{count_tokens(self.summary)} tokens")
+        except Exception:
+            logger.exception("failed to summarize the dropped turns, they are left out")
+        # turns dropped meanwhile
+        self.summary_task = None
+        self.start_summary()
+
+    def observe_ttft(self, ttft):
+        """Record the time to first token of the request of the last fit()."""
+        self.samples.append((self.prompt_tokens, ttft))
+        logger.info(f"LLM time to first token {ttft:.3f}s with a prompt of ~{self.prompt_tokens} tokens "
+                    "(system prompt and conversation)")
+
+    def report(self):
+        buckets = {}
+        for tokens, ttft in self.samples:
+            buckets.setdefault(tokens // TTFT_BUCKET_TOKENS * TTFT_BUCKET_TOKENS, []).append(ttft)
+        for start, ttfts in sorted(buckets.items()):
+            logger.info(f"prompt {start}-{start + TTFT_BUCKET_TOKENS} tokens: median time to first token "
+                        f"{statistics.median(ttfts):.3f}s over {len(ttfts)} requests")
+
+    async def aclose(self, reason=None):
+        # also a job shutdown callback, which gets the shutdown reason
+        self.report()
+        if self.summary_task is not None:
+            self.summary_task.cancel()
@@ -1,45 +1,69 @@
+import asyncio
+import json
 import logging
 import os
+import re
+import sys
+import time
 
 from dotenv import load_dotenv
 from livekit.agents import (
     AutoSubscribe,
     JobContext,
+    JobExecutorType,
     JobProcess,
     WorkerOptions,
     cli,
     llm,
     metrics,
+    utils,
 )
 from livekit.agents.pipeline import VoicePipelineAgent
 from livekit.plugins import (
     cartesia,
     openai,
     deepgram,
-    noise_cancellation,
-    silero,
     turn_detector
 )
-from livekit.plugins import llama_index
 
-from llama_index.core import (
-    SimpleDirectoryReader,
-    StorageContext,
-    VectorStoreIndex,
-    load_index_from_storage,
-)
-from llama_index.core.chat_engine.types import ChatMode
 
 from datetime import datetime
 
+from chat_context import CHAT_SUMMARY_MODEL, ChatContextWindow, load_tokenizer
+from answer_cache import CachedLLM, CachedRetriever, KnowledgeCache
+from indexer import IndexCache, chatbot_documents_dir, chatbot_ids, chatbot_persist_dir, update_index
+from retrieval import SpeculativeRetriever
+from speculative_stt import SpeculativeSTT
+from tts_cache import CachedTTS, fill_tts_cache, fixed_phrases, load_tts_cache
+from session_data import SessionData
+from turn_metrics import TurnMetrics
+from warmup import (
+    DEEPGRAM_URL,
+    WarmupTimings,
+    create_openai_client,
+    create_openai_http_client,
+    load_noise_cancellation,
+    load_vad,
+    warm_http,
+    warm_openai,
+    warm_session,
+    warm_tts,
+    warm_turn_detector,
+)
+
 load_dotenv(dotenv_path=".env.local")
 logger = logging.getLogger("voice-agent")
 
 
 # Initialize RAG components
-CHATBOT_NAME = "toyotaja"
-CHATBOT_DIR = f"document_chatbot/{CHATBOT_NAME}"
-PERSIST_DIR = f"./chatbot-knowledge-storage/{CHATBOT_NAME}"
+# the chatbot_id of a room comes from the job or room metadata ({"chatbot_id": ...}), this one otherwise
+CHATBOT_NAME = os.getenv("CHATBOT_NAME", "toyotaja")
+# chatbots whose index every job process loads in prewarm
+PREWARM_CHATBOTS = [name for name in os.getenv("PREWARM_CHATBOTS", CHATBOT_NAME).split(",") if name]
+# estimated memory of the loaded indexes kept per process, least recently used ones are dropped
+INDEX_CACHE_MB = int(os.getenv("INDEX_CACHE_MB", "1024"))
+# "thread" runs every job in the worker process, so all rooms share one index cache
+JOB_EXECUTOR = JobExecutorType(os.getenv("JOB_EXECUTOR", "process"))
 INITIAL_SYSTEM_CONTEXT = (
     "あなたは法人向けのカジュアル面談で使われる音声アシスタントです。"
     "話し方はやわらかく親しみやすく、丁寧すぎない自然なトーンにしてください。"
@@ -50,21 +74,70 @@ INITIAL_SYSTEM_CONTEXT = (
 )
 INITITAL_MESSAGE = "こんにちは。本日はカジュアル面談にご参加いただき、ありがとうございます。何かお手伝いできることがあれば教えてくださいね。"
 
-if not os.path.exists(PERSIST_DIR):
-    # Load dental knowledge documents and create index
-    documents = SimpleDirectoryReader(CHATBOT_DIR).load_data()
-    index = VectorStoreIndex.from_documents(documents)
-    index.storage_context.persist(persist_dir=PERSIST_DIR)
-else:
-    # Load existing dental knowledge index
-    storage_context = StorageContext.from_defaults(persist_dir=PERSIST_DIR)
-    index = load_index_from_storage(storage_context)
+# seconds a job process may take to prewarm (VAD and knowledge indexes)
+PREWARM_TIMEOUT = float(os.getenv("PREWARM_TIMEOUT", "60"))
+# retrieve for interim transcripts of the question ahead of the end of the turn (embedding calls per turn)
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "1") == "1"
+
+index_cache = IndexCache(INDEX_CACHE_MB * 1024 * 1024)
+
+# the plugins of a session (benchmarks/session_load_benchmark.py replaces them with local ones)
+def create_stt(http_session=None):
+    return deepgram.STT(http_session=http_session)
+
+def create_tts(client=None):
+    return openai.TTS(model="tts-1",voice="nova",client=client)
+
+def create_answer_llm(http_client=None):
+    # llama_index's default LLM (what Settings.llm resolves to), on the HTTP client the session warmup warms
+    from llama_index.llms.openai import OpenAI
+    return OpenAI(async_http_client=http_client)
+
+def create_turn_detector():
+    # use LiveKit's transformer-based turn detector
+    return turn_detector.EOUModel()
 
-# Create chat engine for dental knowledge
-chat_engine = index.as_chat_engine(chat_mode=ChatMode.CONTEXT)
+def get_chatbot_id(ctx: JobContext):
+    for metadata in (ctx.job.metadata, ctx.room.metadata):
+        try:
+            chatbot_id = json.loads(metadata or "{}").get("chatbot_id")
+        except (ValueError, AttributeError):
+            chatbot_id = None
+        if chatbot_id:
+            break
+    else:
+        chatbot_id = CHATBOT_NAME
+    if not re.fullmatch(r"[\w.-]+", chatbot_id) or IndexCache.version(chatbot_id) is None:
+        raise ValueError(f"no knowledge index for chatbot {chatbot_id!r}")
+    return chatbot_id
+
+def load_chatbot_index(chatbot_id):
+    start = time.perf_counter()
+    index = index_cache.get(chatbot_id)
+    if index is None:
+        raise ValueError(f"no knowledge index for chatbot {chatbot_id!r}, run indexer.py --name {chatbot_id}")
+    logger.info(f"knowledge index of {chatbot_id} ready in {time.perf_counter() - start:.3f}s")
+    return index
 
 def prewarm(proc: JobProcess):
-    proc.userdata["vad"] = silero.VAD.load()
+    timings = WarmupTimings("process")
+    with timings.timed("tokenizer"):
+        load_tokenizer()
+    with timings.timed("vad"):
+        proc.userdata["vad"] = load_vad()
+    with timings.timed("noise_cancellation"):
+        proc.userdata["noise_cancellation"] = load_noise_cancellation()
+    with timings.timed("tts_cache"):
+        # audio of the greeting, synthesized when the worker starts
+        proc.userdata["tts_cache"] = load_tts_cache(create_tts, fixed_phrases(INITITAL_MESSAGE))
+    # the embeddings are memory-mapped and shared by every process loading them
+    with timings.timed("indexes"):
+        for chatbot_id in PREWARM_CHATBOTS:
+            try:
+                load_chatbot_index(chatbot_id)
+            except ValueError:
+                logger.warning(f"no knowledge index for chatbot {chatbot_id}, not prewarmed")
+    timings.report()
 
 
 async def entrypoint(ctx: JobContext):
@@ -76,39 +149,88 @@ async def entrypoint(ctx: JobContext):
     logger.info(f"ctx {str(ctx.room)}")
     logger.info(f"connecting to room {ctx.room.name}")
     await ctx.connect(auto_subscribe=AutoSubscribe.AUDIO_ONLY)
+    chatbot_id = get_chatbot_id(ctx)
+    logger.info(f"chatbot {chatbot_id} for room {ctx.room.name}")
+    # loads (or reuses) the index while waiting for the participant
+    index_task = asyncio.create_task(asyncio.to_thread(load_chatbot_index, chatbot_id))
+
+    # the plugins are created and warmed while waiting for the participant
+    tts_cache = ctx.proc.userdata.get("tts_cache")
+    # the HTTP session and OpenAI HTTP client the session warmup opens the connections of; the
+    # TTS and the chat engine's answer LLM both send their OpenAI requests through the latter
+    http_session = utils.http_context.http_session()
+    openai_http_client = create_openai_http_client()
+    openai_client = create_openai_client(openai_http_client)
+    ctx.add_shutdown_callback(lambda: openai_client.close())
+    agent_stt = create_stt(http_session)
+    agent_tts = create_tts(openai_client)
+    if tts_cache is not None:
+        agent_tts = CachedTTS(agent_tts, tts_cache)
+    eou_model = create_turn_detector()
+
+    async def warm_retrieval():
+        # the BM25 tokenizer and the index pages, without an embedding request
+        knowledge_base = await index_task
+        await knowledge_base.warm(INITITAL_MESSAGE)
+
+    # referenced until the warmup is done
+    warmup_task = asyncio.create_task(warm_session({
+        "turn_detector": lambda: warm_turn_detector(eou_model),
+        "stt": lambda: warm_http(http_session, DEEPGRAM_URL),
+        "llm": lambda: warm_openai(openai_client),
+        "tts": lambda: warm_tts(agent_tts),
+        "retrieval": warm_retrieval,
+    }))
 
     # Wait for the first participant to connect
     participant = await ctx.wait_for_participant()
     logger.info(f"starting voice assistant for participant {participant.identity}")
+    # transcript of the session, written to TRANSCRIPT_FILE in the background
+    session_data = SessionData(ctx.job.id, room=ctx.room.name, chatbot=chatbot_id, participant=participant.identity)
+    ctx.add_shutdown_callback(session_data.aclose)
     
+    # the conversation sent to the LLM stays within CHAT_CONTEXT_TOKENS, older turns are summarized
+    chat_window = ChatContextWindow(summarize_llm=openai.LLM(model=CHAT_SUMMARY_MODEL) if CHAT_SUMMARY_MODEL else None)
+    ctx.add_shutdown_callback(chat_window.aclose)
+
     async def llm_cb(assistant: VoicePipelineAgent, chat_ctx: llm.ChatContext):
-        logger.info(f"lm_cb assistant room: {str(assistant._room)} chat_ctx: {str(chat_ctx)}")
-        if len(chat_ctx.messages) > 6:
-            chat_ctx.messages.pop(1)
-        # if len(chat_ctx.messages) > 15:
-        #     chat_ctx.messages = chat_ctx.messages[-15:]
+        chat_window.fit(chat_ctx)
+        session_data.sample_llm_request(chat_ctx, chat_window.prompt_tokens)
     # This project is configured to use Deepgram STT, OpenAI LLM and Cartesia TTS plugins
     # Other great providers exist like Cerebras, ElevenLabs, Groq, Play.ht, Rime, and more
     # Learn more and pick the best one for your app:
     # https://docs.livekit.io/agents/plugins
     # Create a combined LLM that uses both GPT and the dental knowledge base
-    combined_llm = llama_index.LLM(
-        chat_engine=chat_engine
-    )
+    # Create chat engine for dental knowledge; per session, the engine keeps the chat memory
+    knowledge_base = await index_task
+    # repeated questions are answered (or retrieved for) from the cache, shared by the rooms of the chatbot
+    knowledge_cache = KnowledgeCache(chatbot_persist_dir(chatbot_id), knowledge_base.version)
+    ctx.add_shutdown_callback(knowledge_cache.aclose)
+    # retrieval starts on interim transcripts, while the endpointing delay runs; the cache
+    # lookups and the vector retrieval share one embedding of each question
+    speculative_retriever = SpeculativeRetriever(knowledge_base.as_retriever(embed=knowledge_cache.embedding))
+    if SPECULATIVE_RETRIEVAL:
+        # the question so far is the turn's final transcripts and the interim one
+        agent_stt = SpeculativeSTT(agent_stt, speculative_retriever.speculate)
+    turn_metrics = TurnMetrics(chatbot=chatbot_id, room=ctx.room.name)
+    chat_engine = knowledge_base.as_chat_engine(
+        retriever=CachedRetriever(speculative_retriever, knowledge_cache, knowledge_base.index.docstore,
+                                  on_retrieved=turn_metrics.add_retrieval),
+        llm=create_answer_llm(openai_http_client))
+    combined_llm = CachedLLM(chat_engine=chat_engine, cache=knowledge_cache)
     agent = VoicePipelineAgent(
         vad=ctx.proc.userdata["vad"],
-        stt=deepgram.STT(),
+        stt=agent_stt,
         llm=combined_llm,
-        tts=openai.TTS(model="tts-1",voice="nova"),
-        # use LiveKit's transformer-based turn detector
-        turn_detector=turn_detector.EOUModel(),
+        tts=agent_tts,
+        turn_detector=eou_model,
         # minimum delay for endpointing, used when turn detector believes the user is done with their turn
         min_endpointing_delay=0.5,
         # maximum delay for endpointing, used when turn detector does not believe the user is done with their turn
         max_endpointing_delay=5.0,
         # enable background voice & noise cancellation, powered by Krisp
         # included at no additional cost with LiveKit Cloud
-        noise_cancellation=noise_cancellation.BVC(),
+        noise_cancellation=ctx.proc.userdata["noise_cancellation"],
         chat_ctx=initial_ctx,
         before_llm_cb=llm_cb
     )
@@ -129,7 +251,10 @@ async def entrypoint(ctx: JobContext):
     @agent.on("metrics_collected")
     def on_metrics_collected(agent_metrics: metrics.AgentMetrics):
         metrics.log_metrics(agent_metrics)
+        if isinstance(agent_metrics, metrics.PipelineLLMMetrics) and not agent_metrics.cancelled:
+            chat_window.observe_ttft(agent_metrics.ttft)
         usage_collector.collect(agent_metrics)
+        turn_metrics.collect(agent_metrics)
 
     # user_speech_committed
     @agent.on("user_speech_committed")
@@ -150,7 +275,7 @@ async def entrypoint(ctx: JobContext):
                 "is_final": True,
                 "timestamp": datetime.now().isoformat()
             }
-            # session_data.add_stt_transcript(transcript)
+            session_data.add_stt_transcript(transcript)
             logger.info(f"Added user speech to session data {str(transcript)}")
         except Exception as e:
             logger.error(f"Error processing user speech: {str(e)}", exc_info=True)
@@ -174,11 +299,16 @@ async def entrypoint(ctx: JobContext):
                 "text": content,
                 "timestamp": datetime.now().isoformat()
             }
-            # session_data.add_llm_message(message)
+            session_data.add_llm_message(message)
             logger.info(f"Added agent speech to session data {str(message)}")
         except Exception as e:
             logger.error(f"Error processing agent speech: {str(e)}", exc_info=True)
 
+    if SPECULATIVE_RETRIEVAL:
+        @agent.on("user_speech_committed")
+        def on_turn_committed(msg: llm.ChatMessage):
+            agent_stt.new_turn()
+
     agent.start(ctx.room, participant)
 
     # The agent should be polite and greet the user when it joins :)
@@ -186,9 +316,18 @@ async def entrypoint(ctx: JobContext):
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] != ["download-files"]:
+        # embed new or changed documents once, in the worker process; job processes only load the indexes
+        for chatbot_id in chatbot_ids():
+            update_index(chatbot_documents_dir(chatbot_id), chatbot_persist_dir(chatbot_id))
+        # synthesize the fixed phrases not cached yet
+        # (OpenAI's TTS does not use the aiohttp session fill_tts_cache() creates)
+        asyncio.run(fill_tts_cache(lambda http_session: create_tts(), fixed_phrases(INITITAL_MESSAGE)))
     cli.run_app(
         WorkerOptions(
             entrypoint_fnc=entrypoint,
             prewarm_fnc=prewarm,
+            initialize_process_timeout=PREWARM_TIMEOUT,
+            job_executor_type=JOB_EXECUTOR,
         ),
     )
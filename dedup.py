@@ -0,0 +1,137 @@
+"""
+Near-duplicate detection of downloaded documents (pagination, tag listings, print
+versions of the same page), so only one copy of each is indexed.
+
+A document's fingerprint is the sha256 of its normalized text, for exact duplicates,
+and a MinHash signature of its character shingles, for near duplicates: character
+n-grams need no word segmentation, so Japanese and mixed text work the same as
+English. Candidate pairs are found by locality sensitive hashing of the signature
+bands, so a crawl is not compared pairwise.
+"""
+import hashlib
+import html
+import os
+import re
+import unicodedata
+
+import numpy as np
+
+# estimated Jaccard similarity of the shingles above which two documents are duplicates
+# (1 for exact duplicates only)
+DEDUP_SIMILARITY = float(os.getenv("DEDUP_SIMILARITY", "0.9"))
+# characters per shingle
+SHINGLE_SIZE = 5
+# documents with less text only collapse with exact duplicates
+DEDUP_MIN_CHARS = 200
+# MinHash signature length, as DEDUP_BANDS bands of rows hashed together for the candidates
+NUM_PERM = 64
+DEDUP_BANDS = 16
+# documents whose text is compared, the others (PDFs, images, ...) by their file hash only
+TEXT_EXTENSIONS = {'.html', '.txt', '.md'}
+
+TAGS = re.compile(r'<[^>]*>')
+SPACES = re.compile(r'\s+')
+MASK64 = (1 << 64) - 1
+
+
+def permutation(i):
+    # fixed across runs and processes, signatures are stored in the manifest
+    digest = hashlib.sha256(f"minhash-{i}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], 'little') | 1, int.from_bytes(digest[8:16], 'little')
+
+
+PERMUTATIONS = np.array([permutation(i) for i in range(NUM_PERM)], dtype=np.uint64)
+
+
+def normalize_text(text):
+    """Text as compared: NFKC, lower case, without markup and whitespace."""
+    text = html.unescape(TAGS.sub(' ', text))
+    return SPACES.sub('', unicodedata.normalize('NFKC', text).lower())
+
+
+def shingle_hashes(text, size=SHINGLE_SIZE):
+    """64-bit hashes of the distinct character ``size``-grams of ``text``."""
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < size:
+        return np.unique(codes)
+    with np.errstate(over='ignore'):
+        hashes = np.zeros(len(codes) - size + 1, dtype=np.uint64)
+        for i in range(size):
+            hashes = hashes * np.uint64(1000003) + codes[i:len(codes) - size + 1 + i]
+        # splitmix64 finalizer, the polynomial alone leaves the high bits poorly mixed
+        hashes ^= hashes >> np.uint64(30)
+        hashes *= np.uint64(0xBF58476D1CE4E5B9)
+        hashes ^= hashes >> np.uint64(27)
+        hashes *= np.uint64(0x94D049BB133111EB)
+        hashes ^= hashes >> np.uint64(31)
+    return np.unique(hashes)
+
+
+def minhash(text):
+    hashes = shingle_hashes(text)
+    signature = np.empty(NUM_PERM, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for i, (a, b) in enumerate(PERMUTATIONS):
+            signature[i] = (hashes * a + b).min()
+    return signature
+
+
+def fingerprint(text):
+    """Fingerprint of a document's text: ``text`` (sha256) and ``minhash`` (hex, None for short texts)."""
+    text = normalize_text(text)
+    return {'text': hashlib.sha256(text.encode('utf-8')).hexdigest(),
+            'minhash': minhash(text).tobytes().hex() if len(text) >= DEDUP_MIN_CHARS else None}
+
+
+def fingerprint_file(path, extension):
+    """Fingerprint of a downloaded document, for the CPU pool; binary documents only get the file hash."""
+    if extension in TEXT_EXTENSIONS:
+        try:
+            with open(path, 'r', encoding="UTF-8") as f:
+                return fingerprint(f.read())
+        except UnicodeDecodeError:
+            pass
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return {'text': digest.hexdigest(), 'minhash': None}
+
+
+def similarity(signature, other):
+    return float(np.count_nonzero(signature == other)) / NUM_PERM
+
+
+def find_duplicates(fingerprints, preferred=()):
+    """
+    Group the documents of ``fingerprints`` ({key: fingerprint}) that are duplicates and
+    return {duplicate: kept} for all but one document of each group. The document kept is
+    one in ``preferred`` if any (the one indexed before, so the index does not churn),
+    else the one with the shortest key (URL), which is usually the canonical page.
+    """
+    preferred = set(preferred)
+    rows = NUM_PERM // DEDUP_BANDS
+    by_text = {}
+    bands = [{} for _ in range(DEDUP_BANDS)]
+    signatures = {}
+    duplicates = {}
+    for key in sorted(fingerprints, key=lambda key: (key not in preferred, len(key), key)):
+        document = fingerprints[key]
+        if document['text'] in by_text:
+            duplicates[key] = by_text[document['text']]
+            continue
+        signature = None
+        if document.get('minhash') and DEDUP_SIMILARITY < 1:
+            signature = np.frombuffer(bytes.fromhex(document['minhash']), dtype=np.uint64)
+            candidates = {kept for band, table in enumerate(bands)
+                          for kept in table.get(signature[band * rows:(band + 1) * rows].tobytes(), ())}
+            best = max(candidates, key=lambda kept: similarity(signature, signatures[kept]), default=None)
+            if best is not None and similarity(signature, signatures[best]) >= DEDUP_SIMILARITY:
+                duplicates[key] = best
+                continue
+        by_text[document['text']] = key
+        if signature is not None:
+            signatures[key] = signature
+            for band, table in enumerate(bands):
+                table.setdefault(signature[band * rows:(band + 1) * rows].tobytes(), []).append(key)
+    return duplicates
@@ -1,275 +1,1023 @@
 import asyncio
 import aiohttp
 import os
-import shutil
-import tempfile
+import functools
 import magic
-import uuid
+import hashlib
 import json
-from bs4 import BeautifulSoup, Tag, NavigableString, Comment
-from llama_index.core import SimpleDirectoryReader
-from janome.tokenizer import Tokenizer
-from spellchecker import SpellChecker
+from lxml import etree
 import re
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit, urlunsplit
 from playwright.async_api import async_playwright
-import requests
 import time
 import logging
 import string
-from typing import List, Union
+import random
+import collections
+import gzip
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import sys
 import argparse
+from contextlib import asynccontextmanager
+import yarl
+
+import dedup
+
+# maximum number of browser pages rendering at the same time
+MAX_CONCURRENT_PAGES = int(os.getenv("DOWNLOADER_MAX_PAGES", "4"))
+# processes running the CPU bound document cleaning next to the network I/O
+CPU_WORKERS = int(os.getenv("DOWNLOADER_CPU_WORKERS", str(os.cpu_count() or 1)))
+# number of URLs processed at the same time by one downloads() run
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("DOWNLOADER_MAX_DOWNLOADS", "16"))
+# connection limits of the shared HTTP session (global and per host)
+MAX_CONNECTIONS = int(os.getenv("DOWNLOADER_MAX_CONNECTIONS", "32"))
+MAX_CONNECTIONS_PER_HOST = int(os.getenv("DOWNLOADER_MAX_CONNECTIONS_PER_HOST", "4"))
+# retries on connection errors, timeouts and RETRY_STATUSES, with exponential backoff
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.6778.33 Safari/537.36"}
+
+# binary downloads are streamed to disk in chunks of this size
+CHUNK_SIZE = 64 * 1024
+# bytes buffered before asking libmagic for the MIME type of a binary download
+MIME_SNIFF_SIZE = 64 * 1024
+# binary downloads larger than this are rejected (from Content-Length when sent, else while streaming)
+MAX_DOWNLOAD_SIZE = int(os.getenv("DOWNLOADER_MAX_DOWNLOAD_SIZE", str(200 * 1024 * 1024)))
+# plain text documents get the same Japanese/English spacing cleanup as HTML pages
+# (not markdown, whose code blocks and inline code must stay as written)
+NORMALIZED_TEXT_EXTENSIONS = {'.txt'}
+EXTENSIONS_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloader_extensions_config.json')
+
+@functools.lru_cache(maxsize=None)
+def load_extensions():
+    with open(EXTENSIONS_CONFIG, 'r') as f:
+        return json.load(f)
 
-DELAY_TIME = 0.1
 def get_extension_from_mime(mime_type):
     # Return file extension based on MIME type
-    with open('downloader_extensions_config.json', 'r') as f:
-        # Load the JSON data
-        extensions = json.load(f)
-        return extensions.get(mime_type, None)  # Return None for unknown types
+    extension = load_extensions().get(mime_type, None)  # Return None for unknown types
+    if extension:
+        # some types list several extensions (".jpeg, .jpg"), use the first one
+        extension = extension.split(',')[0].strip()
+    return extension
     
-def is_html(url):
+# bytes buffered from the start of every response to decide between HTML and binary
+SNIFF_SIZE = 1024
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+
+def is_html(content_type, head):
+    """Decide from the Content-Type header and the first bytes of a response whether it is an HTML page."""
+    content_type = (content_type or '').lower()
+    if any(html_type in content_type for html_type in HTML_CONTENT_TYPES):
+        return True
+    # If Content-Type is missing or unclear, check the first bytes of content
+    head = head.lower()
+    return b"<html" in head or b"<!doctype html" in head
+
+async def read_head(response, size=SNIFF_SIZE):
+    """Read up to ``size`` bytes from the start of ``response`` without consuming the rest."""
+    head = b""
+    while len(head) < size:
+        chunk = await response.content.read(size - len(head))
+        if not chunk:
+            break
+        head += chunk
+    return head
+
+# per-chatbot record of what was downloaded; hidden so SimpleDirectoryReader skips it
+MANIFEST_NAME = ".manifest.json"
+# crawl mode defaults and the frontier checkpoint, saved every CHECKPOINT_INTERVAL pages
+CRAWL_MAX_DEPTH = 3
+CRAWL_MAX_PAGES = 1000
+CRAWL_STATE_NAME = ".crawl_state.json"
+CHECKPOINT_INTERVAL = 25
+MAX_SITEMAPS = 50
+MAX_SITEMAP_URLS = 50000
+TRACKING_PARAMS = ('utm_', 'fbclid=', 'gclid=')
+
+def document_filename(url, extension):
+    """Stable file name of a URL's document, so a refreshed document replaces its previous copy."""
+    return hashlib.sha1(url.encode("utf-8")).hexdigest() + extension
+
+def part_path_of(path):
+    """Hidden name a document is written under until complete, so an index update never reads it half written."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "." + name + ".part")
+
+def load_manifest(chatbot_directory):
+    """Return the manifest of the previous run as {url: entry}, or {} for a first crawl."""
     try:
-        # Use GET instead of HEAD for better compatibility
-        response = requests.get(url, timeout=10, stream=True)
-        
-        # Check Content-Type header
-        content_type = response.headers.get('Content-Type', '').lower()
-        if 'text/html' in content_type:
-            return True
-
-        # If Content-Type is missing or unclear, check the first 1024 bytes of content
-        for chunk in response.iter_content(1024):
-            if b"<html" in chunk.lower():
-                return True
-            break  # No need to read more than one chunk
-
-    except requests.RequestException:
-        pass  # Handle network errors gracefully
-    
-    return False
+        with open(chatbot_directory + MANIFEST_NAME, 'r', encoding="UTF-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-async def download_html_page(chatbot_directory, document_metadata):    
-    url = document_metadata['url']
+def save_manifest(chatbot_directory, manifest):
+    path = chatbot_directory + MANIFEST_NAME
+    with open(path + ".tmp", 'w', encoding="UTF-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+def conditional_headers(chatbot_directory, previous):
+    """If-None-Match/If-Modified-Since for a URL whose previous copy is still on disk."""
+    headers = {}
+    if previous and os.path.exists(chatbot_directory + previous['filename']):
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+    return headers
+
+def is_unchanged(chatbot_directory, previous, sha256):
+    return bool(previous) and previous.get('sha256') == sha256 and os.path.exists(chatbot_directory + previous['filename'])
+
+def keep_previous(chatbot_directory, document_metadata, previous):
+    """Fill document metadata from the manifest entry of a document that did not change."""
+    document_metadata['final_path'] = chatbot_directory + previous['filename']
+    document_metadata['extension'] = previous['extension']
+    document_metadata['sha256'] = previous['sha256']
+    document_metadata['status'] = 'unchanged'
+    if 'links' in previous:
+        document_metadata['links'] = previous['links']
+    if 'fingerprint' in previous:
+        document_metadata['fingerprint'] = previous['fingerprint']
+    print(f"Unchanged: {document_metadata['url']}")
+    return document_metadata
+
+def create_http_session():
+    """Create the keep-alive HTTP session shared by every download of a run."""
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS_PER_HOST,
+                                     ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+    return aiohttp.ClientSession(headers=HEADERS, connector=connector, timeout=timeout)
+
+def retry_delay(attempt, retry_after=None):
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), 30.0)
+    return RETRY_BACKOFF * (2 ** attempt) * (1 + random.random())
+
+async def get_with_retry(session, url, **kwargs):
+    """
+    GET ``url`` on the shared session, retrying transient failures with backoff.
+
+    Returns an open response that the caller must release (use it with ``async with``).
+    Raises aiohttp.ClientResponseError for non transient HTTP errors.
+    """
+    attempt = 0
+    while True:
+        try:
+            response = await session.get(url, **kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+            print(f"Retry {url} in {delay:.1f}s -> {e!r}")
+        else:
+            if response.status not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+                response.raise_for_status()
+                return response
+            delay = retry_delay(attempt, response.headers.get("Retry-After"))
+            response.release()
+            print(f"Retry {url} in {delay:.1f}s -> HTTP {response.status}")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+class BrowserPool:
+    """
+    Long-lived headless Chromium shared by every HTML download.
+
+    Pages are opened lazily up to ``max_pages`` and handed back to the pool after each
+    download, so a run pays for one browser cold start instead of one per URL. The pool
+    must be used from a single event loop; it relaunches the browser if it crashes.
+    """
+
+    def __init__(self, max_pages: int = MAX_CONCURRENT_PAGES):
+        self.max_pages = max_pages
+        self._playwright = None
+        self._browser = None
+        self._context = None
+        self._idle_pages = []
+        self._semaphore = None
+        self._lock = None
+
+    def _is_running(self) -> bool:
+        return self._browser is not None and self._browser.is_connected()
+
+    async def start(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._is_running():
+                return
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            print(f"launching shared browser (max {self.max_pages} pages)")
+            self._browser = await self._playwright.chromium.launch(headless=True)
+            self._context = await self._browser.new_context()
+            self._idle_pages = []
+
+    @asynccontextmanager
+    async def page(self):
+        """Borrow a page, waiting while ``max_pages`` pages are already in use."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pages)
+        async with self._semaphore:
+            await self.start()
+            page = self._idle_pages.pop() if self._idle_pages else await self._context.new_page()
+            reusable = False
+            try:
+                yield page
+                reusable = True
+            finally:
+                if reusable and self._is_running() and not page.is_closed():
+                    self._idle_pages.append(page)
+                else:
+                    # a page that failed mid-navigation may be stuck, never hand it out again
+                    try:
+                        await page.close()
+                    except Exception:
+                        pass
+
+    async def close(self):
+        if self._browser is not None:
+            try:
+                await self._browser.close()
+            except Exception:
+                pass
+        if self._playwright is not None:
+            await self._playwright.stop()
+        self._playwright = None
+        self._browser = None
+        self._context = None
+        self._idle_pages = []
+
+
+def create_cpu_pool(workers=CPU_WORKERS):
+    """
+    Process pool for the CPU bound stages of a download, so a heavy page never stalls
+    the event loop that drives the other downloads. Workers are spawned (not forked
+    from a process running the browser and event loop threads) and set up their
+    parser state once in init_cpu_worker.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=init_cpu_worker)
+
+def init_cpu_worker():
+    get_html_parser()
+    get_text_normalizer()
+
+def process_html_document(html, base_url=None):
+    """
+    CPU stage of an HTML download, run in the CPU pool: the page as saved to disk, and
+    the absolute URLs it links to when ``base_url`` is given (crawl mode).
+    """
+    content = clean_html(html, pretty=True, normalize_text=get_text_normalizer().normalize)
+    links = extract_links(html, base_url) if base_url else []
+    return content, links
+
+async def download_html_page(chatbot_directory, document_metadata, browser_pool, body=None,
+                             content_type="text/html", page_url=None, status='added', cpu_pool=None,
+                             follow_links=False):
+    """
+    Render a page with a page borrowed from the shared browser pool, then clean it in
+    ``cpu_pool`` (the loop's default executor when None). With ``follow_links`` the links
+    of the rendered page are returned in ``document_metadata['links']``.
+
+    When ``body`` is given it is the document already fetched by download_file; it is
+    served to the browser for ``page_url`` so only the page's subresources hit the network.
+    """
+    url = page_url or document_metadata['url']
     print(f"download_html_page url {url}")
-    """Fetch content from a URL using Playwright."""
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        page = await browser.new_page()
-        content = False
+    content = False
+    # Chromium requests its own form of the URL (trailing slash, host case, escaping)
+    document_url = yarl.URL(url).with_fragment(None)
+    served = False
+
+    def is_document(request_url):
         try:
-            await page.goto(url, timeout=10000)  # 10s timeout
-            await page.wait_for_load_state("load")
-            await page.wait_for_timeout(2000)
-            content = await page.content()  # Get HTML content
-            print(f"Downloaded: {url}")
-        except Exception as e:
-            print(f"Failed: {url} -> {e}")
-        finally:
-            await browser.close()
-        if content == False:
+            return yarl.URL(request_url).with_fragment(None) == document_url
+        except ValueError:
             return False
-        
-        soup = BeautifulSoup(clean_html(content), 'html.parser')
-        content = str(soup.prettify())
-        extension = ".html"
-        mime_type = "text/html"
-        final_path = chatbot_directory+str(uuid.uuid4()) + extension
-        with open(final_path, "w", encoding="UTF-8") as f:
-            f.write(content)
-            
-        print(f"File has been saved as {final_path} with MIME type {mime_type}")
-        # add final path and extension to document metadata
-        document_metadata['final_path'] = final_path
-        document_metadata['extension'] = extension
-        return document_metadata
+
+    async def serve_document(route):
+        nonlocal served
+        served = True
+        await route.fulfill(status=200, content_type=content_type, body=body)
+
+    try:
+        async with browser_pool.page() as page:
+            if body is not None:
+                await page.route(is_document, serve_document)
+            try:
+                await page.goto(url, timeout=10000)  # 10s timeout
+                if body is not None and not served:
+                    print(f"Fetched again by the browser, its request did not match {url}")
+                await page.wait_for_load_state("load")
+                await page.wait_for_timeout(2000)
+                content = await page.content()  # Get HTML content
+            finally:
+                if body is not None:
+                    await page.unroute(is_document, serve_document)
+            print(f"Downloaded: {url}")
+    except Exception as e:
+        print(f"Failed: {url} -> {e}")
+    if content == False:
+        return False
+
+    content, links = await asyncio.get_running_loop().run_in_executor(cpu_pool, process_html_document, content,
+                                                                      url if follow_links else None)
+    extension = ".html"
+    mime_type = "text/html"
+    final_path = chatbot_directory + document_filename(document_metadata['url'], extension)
+    part_path = part_path_of(final_path)
+    with open(part_path, "w", encoding="UTF-8") as f:
+        f.write(content)
+    os.replace(part_path, final_path)
+
+    print(f"File has been saved as {final_path} with MIME type {mime_type}")
+    # add final path and extension to document metadata
+    document_metadata['final_path'] = final_path
+    document_metadata['extension'] = extension
+    document_metadata['status'] = status
+    if follow_links:
+        document_metadata['links'] = links
+    return document_metadata
     
 MEANINGFUL_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'a', 'ul', 'ol', 'li', 'table', 'tr', 'th', 'td',
                     'blockquote', 'pre', 'img', 'video', 'audio'}
 ALLOWED_ATTRS = {'a': ['href', 'title'], 'img': ['src', 'alt'], 'video': ['src'], 'audio': ['src']}
 REMOVE_TAGS = {'header', 'footer', 'nav', 'script', 'style'}
 
-def clean_html(html: str) -> str:
+# Strings under these tags are typed by the tag (Script, Stylesheet, ...) and only count as
+# text for a tag of the same name, the way BeautifulSoup's stripped_strings treats them.
+STRING_CONTAINER_TAGS = {'script', 'style', 'template', 'rt', 'rp'}
+HIDDEN_STYLES = ('display:none', 'visibility:hidden')
+STYLE_WHITESPACE = {ord(c): None for c in string.whitespace}
+BLANK_LINES = re.compile(r'\n{3,}')
+
+def escape_html(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def quote_attribute(value):
+    value = escape_html(value)
+    if '"' not in value:
+        return f'"{value}"'
+    if "'" not in value:
+        return f"'{value}'"
+    return '"' + value.replace('"', '&quot;') + '"'
+
+def render_pretty(items, level):
+    """Lay out the children of a tag one per line the way BeautifulSoup's prettify() does."""
+    lines = []
+    text = []
+    for item in items + [None]:
+        if isinstance(item, str):
+            text.append(item)
+            continue
+        if text:
+            lines.append(' ' * level + escape_html(BLANK_LINES.sub('\n\n', ' '.join(text))) + '\n')
+            text = []
+        if item is not None:
+            lines.append(item[0])
+    return ''.join(lines)
+
+html_parser_state = threading.local()
+
+def get_html_parser():
+    """lxml HTML parser reused by every clean_html call of a thread (parsers are not thread safe)."""
+    parser = getattr(html_parser_state, 'parser', None)
+    if parser is None:
+        parser = html_parser_state.parser = etree.HTMLParser(encoding="utf-8")
+    return parser
+
+def clean_html(html: str, pretty: bool = False, normalize_text=None) -> str:
     """
     Clean and format HTML content.
 
+    Single pass over the lxml tree: comments, hidden elements (inline display:none or
+    visibility:hidden), elements without text and REMOVE_TAGS are dropped, MEANINGFUL_TAGS
+    are kept with their ALLOWED_ATTRS and every other tag is flattened into its text.
+
     Args:
         html (str): Input HTML string.
+        pretty (bool): Lay the result out one tag or text per indented line, as
+            ``BeautifulSoup(clean_html(html), 'html.parser').prettify()`` would, without
+            parsing the cleaned HTML a second time.
+        normalize_text (callable): Applied to every text of the output, e.g.
+            MixedTextNormalizer.normalize.
 
     Returns:
         str: Cleaned and formatted HTML string.
     """
-    def process_tag(tag: Union[Tag, NavigableString]) -> List[str]:
-        if isinstance(tag, NavigableString):
-            return [str(tag).strip()] if tag.strip() else []
-        
-        if tag.name not in MEANINGFUL_TAGS:
-            return sum((process_tag(child) for child in tag.children), [])
-        
-        attrs = ' '.join(f'{k}="{v}"' for k, v in tag.attrs.items() if k in ALLOWED_ATTRS.get(tag.name, []))
-        opening_tag = f"<{tag.name}{f' {attrs}' if attrs else ''}>"
-        closing_tag = f"</{tag.name}>"
-        
-        content = ' '.join(sum((process_tag(child) for child in tag.children), []))
-        return [f"{opening_tag}{content}{closing_tag}"]
-
     print("clean_html")
-    try:        
-        soup = BeautifulSoup(html, 'lxml')
-        # Find all comments
-        comments = soup.find_all(string=lambda text: isinstance(text, Comment))
-
-        # Remove all comments
-        for comment in comments:
-            comment.extract()
-
-        # Remove elements with inline style="display: none"
-        for tag in soup.find_all(style=True):
-            if tag is not None and tag.get_text() and tag['style'] is not None:
-                style = tag['style'].translate({ord(c): None for c in string.whitespace})
-                if ('display:none' in style) or ('visibility:hidden' in style):
-                    tag.decompose()  # Decompose completely removes the tag
-            
-    
-        # Remove tags with empty content
-        for tag in soup.find_all():
-            if not tag.contents or not ''.join(tag.stripped_strings):
-                tag.decompose()
-        for tag in soup.find_all(REMOVE_TAGS):
-            tag.decompose()
-
-        processed_content = sum((process_tag(tag) for tag in soup.body.children 
-                                 if isinstance(tag, Tag) or (isinstance(tag, NavigableString) and tag.strip())), [])
-        
-        formatted_output = ' '.join(processed_content)
-        formatted_output = re.sub(r'\n{3,}', '\n\n', formatted_output)
+    try:
+        root = etree.fromstring(html.encode("utf-8"), get_html_parser())
+        if root is None:
+            return ""
+        body_parts = None
+        # one frame per open element: [context, raw text kinds, kept text kinds, output parts,
+        # indent level, inside pre]; a text "kind" is the innermost STRING_CONTAINER_TAGS
+        # ancestor (None outside them). Output parts are stripped texts (str) and, in pretty
+        # mode, already rendered tags wrapped in a tuple.
+        stack = []
+
+        def add_text(frame, text):
+            if text:
+                frame[1].add(frame[0])
+                stripped = text.strip()
+                if stripped:
+                    frame[2].add(frame[0])
+                    if normalize_text is not None:
+                        stripped = normalize_text(stripped) or stripped
+                    frame[3].append(stripped)
+
+        for event, element in etree.iterwalk(root, events=("start", "end", "comment", "pi")):
+            if event in ("comment", "pi"):
+                # dropped, only the text following them is content
+                if stack:
+                    add_text(stack[-1], element.tail)
+                continue
+            if event == "start":
+                if stack:
+                    parent = stack[-1]
+                    context, level, in_pre = parent[0], parent[4], parent[5]
+                else:
+                    context, level, in_pre = None, 0, False
+                if element.tag in STRING_CONTAINER_TAGS:
+                    context = element.tag
+                if element.tag in MEANINGFUL_TAGS:
+                    level += 1
+                    in_pre = in_pre or element.tag == 'pre'
+                stack.append([context, set(), set(), [], level, in_pre])
+                add_text(stack[-1], element.text)
+                continue
+
+            context, raw_kinds, kept_kinds, parts, level, in_pre = stack.pop()
+            kind = element.tag if element.tag in STRING_CONTAINER_TAGS else None
+            style = element.get("style")
+            hidden = (style is not None and kind in raw_kinds
+                      and any(hidden_style in style.translate(STYLE_WHITESPACE) for hidden_style in HIDDEN_STYLES))
+            removed = hidden or kind not in kept_kinds
+            if element.tag == "body" and body_parts is None:
+                body_parts = [] if removed else parts
+            if not stack:
+                if removed:
+                    body_parts = []
+                break
+            parent = stack[-1]
+            parent[1].update(raw_kinds)
+            if not hidden:
+                parent[2].update(kept_kinds)
+            if not removed and element.tag not in REMOVE_TAGS:
+                if element.tag not in MEANINGFUL_TAGS:
+                    parent[3].extend(parts)
+                elif not pretty:
+                    attrs = ' '.join(f'{k}="{v}"' for k, v in element.attrib.items()
+                                     if k in ALLOWED_ATTRS.get(element.tag, []))
+                    opening_tag = f"<{element.tag}{f' {attrs}' if attrs else ''}>"
+                    parent[3].append(f"{opening_tag}{' '.join(parts)}</{element.tag}>")
+                else:
+                    attrs = ''.join(f' {k}={quote_attribute(v)}' for k, v in sorted(element.attrib.items())
+                                    if k in ALLOWED_ATTRS.get(element.tag, []))
+                    opening_tag = f"<{element.tag}{attrs}>"
+                    closing_tag = f"</{element.tag}>"
+                    if in_pre:
+                        # whitespace inside <pre> is content, keep the tags inline
+                        content = ' '.join(escape_html(BLANK_LINES.sub('\n\n', part)) if isinstance(part, str)
+                                           else part[0] for part in parts)
+                        rendered = f"{opening_tag}{content}{closing_tag}"
+                        if not parent[5]:
+                            rendered = ' ' * parent[4] + rendered + '\n'
+                    else:
+                        indent = ' ' * parent[4]
+                        rendered = f"{indent}{opening_tag}\n{render_pretty(parts, level)}{indent}{closing_tag}\n"
+                    parent[3].append((rendered,))
+            add_text(parent, element.tail)
+
+        if body_parts is None:
+            return ""
+        if pretty:
+            print("clean_html finish")
+            return render_pretty(body_parts, 0)
+        formatted_output = ' '.join(body_parts)
+        formatted_output = BLANK_LINES.sub('\n\n', formatted_output)
         print("clean_html finish")
         return formatted_output.strip()
     except Exception as e:
         print(f"An error occurred: {e}")
         return ""
-async def download_file(chatbot_directory, document_metadata, delay):
-    await asyncio.sleep(delay)
-    if(is_html(document_metadata['url'])):
-        return await download_html_page(chatbot_directory, document_metadata)
-    else: 
-        headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.6778.33 Safari/537.36"}
-        async with aiohttp.ClientSession(headers=headers) as session:
-            try:
-                url = document_metadata['url']
-                async with session.get(url) as response:
-                    print(f"download url {url}")
-                    # print(f"response {str(response)}")
-                    with tempfile.NamedTemporaryFile() as file:
-                        while True:
-                            chunk = await response.content.read()
-                            if not chunk:
-                                break
-                            file.write(chunk)
-                            # print(f"chunk file {str(chunk)}")
-                        file.flush()  # Ensure all data is written to the file
-                        
-                        # Process the file as needed
-                        file.seek(0)  # Go back to the start of the file if you need to read it
-                        print(f"Downloaded file {file.name}")
-                        mime_type = magic.from_file(file.name, mime=True)
-                        print(f"detected mime_type {mime_type}")
-                        extension = get_extension_from_mime(mime_type)                    
-                        print(f"detected extension {extension}")
-                        if extension:
-                            # Save the final file with the correct extension
-                            final_path = chatbot_directory+str(uuid.uuid4()) + extension
-                            shutil.copyfile(file.name, final_path)
-                            print(f"File has been saved as {final_path} with MIME type {mime_type}")
-                            # add final path and extension to document metadata
-                            document_metadata['final_path'] = final_path
-                            document_metadata['extension'] = extension
-                            return document_metadata
-                        else:
-                            print("Downloaded file type is not supported by LlamaIndex.")
-                            return False
-            except aiohttp.ClientConnectionError:
-                print(f"Connection error {url}") 
-                return False
-            except aiohttp.ClientResponseError:
-                print(f"Invalid response {url}")
-                return False            
-
-async def downloads(chatbot_id, urls):
+
+async def download_binary(chatbot_directory, document_metadata, response, head, previous=None, status='added',
+                          cpu_pool=None):
+    """
+    Stream a non HTML response straight to its final location in CHUNK_SIZE chunks.
+
+    The MIME type comes from the first buffered bytes and the sha256 is computed while
+    streaming, so the body is written once and memory use does not grow with file size.
+    """
+    url = document_metadata['url']
+    print(f"download url {url}")
+    if response.content_length is not None and response.content_length > MAX_DOWNLOAD_SIZE:
+        print(f"Too large ({response.content_length} bytes): {url}")
+        return False
+    head += await read_head(response, MIME_SNIFF_SIZE - len(head))
+    mime_type = magic.from_buffer(head, mime=True)
+    print(f"detected mime_type {mime_type}")
+    extension = get_extension_from_mime(mime_type)
+    print(f"detected extension {extension}")
+    if not extension:
+        print("Downloaded file type is not supported by LlamaIndex.")
+        return False
+
+    final_path = chatbot_directory + document_filename(url, extension)
+    # stream next to the final file and rename at the end, so a failed download never
+    # leaves a truncated document behind (or clobbers the previous copy)
+    part_path = part_path_of(final_path)
+    checksum = hashlib.sha256(head)
+    size = len(head)
+    try:
+        with open(part_path, "wb") as f:
+            f.write(head)
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_DOWNLOAD_SIZE:
+                    print(f"Too large (over {MAX_DOWNLOAD_SIZE} bytes): {url}")
+                    return False
+                f.write(chunk)
+                checksum.update(chunk)
+        sha256 = checksum.hexdigest()
+        if is_unchanged(chatbot_directory, previous, sha256):
+            return keep_previous(chatbot_directory, document_metadata, previous)
+        os.replace(part_path, final_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    if extension in NORMALIZED_TEXT_EXTENSIONS:
+        await asyncio.get_running_loop().run_in_executor(cpu_pool, normalize_text_file, final_path)
+
+    print(f"File has been saved as {final_path} with MIME type {mime_type}")
+    # add final path and extension to document metadata
+    document_metadata['final_path'] = final_path
+    document_metadata['extension'] = extension
+    document_metadata['sha256'] = sha256
+    document_metadata['status'] = status
+    return document_metadata
+
+async def download_file(chatbot_directory, document_metadata, session, browser_pool, previous=None, cpu_pool=None,
+                        follow_links=False):
+    """
+    Download one URL, skipping the work when the manifest entry ``previous`` is still current.
+
+    Returns the document metadata with ``status`` set to added, changed or unchanged,
+    or False when the URL could not be downloaded. With ``follow_links`` (crawl mode)
+    it also carries the page's ``links``.
+    """
+    url = document_metadata['url']
+    status = 'changed' if previous else 'added'
+    # a crawl needs the links of every page, only skip pages whose links were recorded
+    current = None if follow_links and previous and 'links' not in previous else previous
+    try:
+        headers = conditional_headers(chatbot_directory, current)
+        async with await get_with_retry(session, url, headers=headers) as response:
+            if response.status == 304:
+                return keep_previous(chatbot_directory, document_metadata, current)
+            document_metadata['etag'] = response.headers.get('ETag')
+            document_metadata['last_modified'] = response.headers.get('Last-Modified')
+            # classify from the same response that is downloaded, so every URL is fetched once
+            content_type = response.headers.get('Content-Type', '')
+            head = await read_head(response)
+            if is_html(content_type, head):
+                body = head + await response.content.read()
+                sha256 = hashlib.sha256(body).hexdigest()
+                if is_unchanged(chatbot_directory, current, sha256):
+                    return keep_previous(chatbot_directory, document_metadata, current)
+                document_metadata['sha256'] = sha256
+                return await download_html_page(chatbot_directory, document_metadata, browser_pool, body,
+                                                content_type or "text/html", str(response.url), status,
+                                                cpu_pool, follow_links)
+            else:
+                if follow_links:
+                    document_metadata['links'] = []
+                return await download_binary(chatbot_directory, document_metadata, response, head,
+                                             current, status, cpu_pool)
+    except aiohttp.ClientConnectionError:
+        print(f"Connection error {url}") 
+        return False
+    except aiohttp.ClientResponseError:
+        print(f"Invalid response {url}")
+        return False            
+    except asyncio.TimeoutError:
+        print(f"Timeout {url}")
+        return False
+
+def normalize_url(url, base_url=None):
+    """
+    Absolute, comparable form of a (possibly relative) link: http(s) only, lower case
+    host, no default port, fragment or tracking parameters. None for other links.
+    """
+    try:
+        parts = urlsplit(urljoin(base_url, url.strip()) if base_url else url.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https') or not parts.hostname:
+        return None
+    host = parts.hostname
+    if ':' in host:
+        host = f"[{host}]"
+    if port is not None and (scheme, port) not in (('http', 80), ('https', 443)):
+        host = f"{host}:{port}"
+    query = '&'.join(param for param in parts.query.split('&')
+                     if param and not param.lower().startswith(TRACKING_PARAMS))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+def site_of(url):
+    """Host of a URL without a leading www., so example.com and www.example.com are one site."""
+    host = urlsplit(url).hostname or ''
+    return host[4:] if host.startswith('www.') else host
+
+def extract_links(html, base_url):
+    """Normalized, deduplicated targets of the <a>/<area> links of a page."""
+    root = etree.fromstring(html.encode("utf-8"), get_html_parser())
+    if root is None:
+        return []
+    base = root.find('.//base[@href]')
+    if base is not None:
+        base_url = urljoin(base_url, base.get('href'))
+    links = (normalize_url(element.get('href'), base_url) for element in root.iter('a', 'area') if element.get('href'))
+    return list(dict.fromkeys(link for link in links if link))
+
+def parse_sitemap(body):
+    """Return (is_sitemap_index, locations) of a sitemap.xml (optionally gzipped) body."""
+    if body[:2] == b'\x1f\x8b':
+        body = gzip.decompress(body)
+    parser = etree.XMLParser(recover=True, resolve_entities=False, no_network=True, huge_tree=True)
+    root = etree.fromstring(body, parser)
+    if root is None:
+        return False, []
+    locations = [loc.text.strip() for loc in root.iter('{*}loc') if loc.text and loc.text.strip()]
+    return etree.QName(root).localname == 'sitemapindex', locations
+
+async def fetch_sitemap_urls(session, seed_url, limit, cpu_pool=None):
+    """Page URLs listed by the sitemaps of the seed's site (sitemap.xml and robots.txt Sitemap lines)."""
+    parts = urlsplit(seed_url)
+    site_root = f"{parts.scheme}://{parts.netloc}"
+    sitemaps = [site_root + "/sitemap.xml"]
+    try:
+        async with await get_with_retry(session, site_root + "/robots.txt") as response:
+            robots = await response.text(errors="replace")
+        sitemaps += [line.split(':', 1)[1].strip() for line in robots.splitlines()
+                     if line.lower().startswith('sitemap:')]
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pass
+    seen = set()
+    urls = []
+    while sitemaps and len(urls) < limit and len(seen) < MAX_SITEMAPS:
+        sitemap = sitemaps.pop(0)
+        if sitemap in seen:
+            continue
+        seen.add(sitemap)
+        try:
+            async with await get_with_retry(session, sitemap) as response:
+                body = await response.read()
+            is_index, locations = await asyncio.get_running_loop().run_in_executor(cpu_pool, parse_sitemap, body)
+        except Exception as e:
+            print(f"Sitemap {sitemap} skipped -> {e!r}")
+            continue
+        if is_index:
+            sitemaps.extend(locations)
+        else:
+            urls.extend(locations)
+    print(f"{len(urls)} URLs found in the sitemaps of {site_root}")
+    return urls[:limit]
+
+class Frontier:
+    """
+    URLs still to download in an ingest.
+
+    A URL list is a frontier that follows no links. In crawl mode (``max_depth`` > 0)
+    the links of every downloaded page on the seeds' sites are queued one level deeper,
+    until ``max_depth`` or ``max_pages`` is reached. URLs are normalized and
+    deduplicated; the state can be saved and loaded to resume an interrupted crawl.
+    """
+
+    def __init__(self, urls, max_depth=0, max_pages=None):
+        self.seeds = [normalize_url(url) or url for url in urls]
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.sites = {site_of(url) for url in self.seeds}
+        self.depths = {}  # every accepted URL -> depth, in discovery order
+        self.results = {}  # downloaded URL -> document metadata or False
+        self.queue = collections.deque()
+        self.in_flight = 0
+        self._changed = None
+        for url in self.seeds:
+            self.add(url, 0)
+
+    @property
+    def follow_links(self):
+        return self.max_depth > 0
+
+    def add(self, url, depth):
+        if url in self.depths or depth > self.max_depth:
+            return
+        if self.max_pages is not None and len(self.depths) >= self.max_pages:
+            return
+        if depth > 0 and site_of(url) not in self.sites:
+            return
+        self.depths[url] = depth
+        self.queue.append(url)
+        if self._changed is not None:
+            self._changed.set()
+
+    async def get(self):
+        """Next URL to download; waits for pages in flight, None once the crawl is over."""
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        while not self.queue and self.in_flight:
+            self._changed.clear()
+            await self._changed.wait()
+        if not self.queue:
+            self._changed.set()
+            return None
+        self.in_flight += 1
+        return self.queue.popleft()
+
+    def done(self, url, document):
+        self.results[url] = document
+        self.in_flight -= 1
+        if document and self.follow_links:
+            for link in document.get('links', []):
+                self.add(link, self.depths[url] + 1)
+        if self._changed is not None:
+            self._changed.set()
+
+    def save(self, path):
+        state = {'seeds': self.seeds, 'max_depth': self.max_depth, 'max_pages': self.max_pages,
+                 'depths': self.depths, 'results': self.results}
+        with open(path + ".tmp", 'w', encoding="UTF-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path):
+        """Resume from the checkpoint at ``path`` when it belongs to the same crawl."""
+        try:
+            with open(path, 'r', encoding="UTF-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if [state.get(key) for key in ('seeds', 'max_depth', 'max_pages')] != [self.seeds, self.max_depth, self.max_pages]:
+            return False
+        self.depths = state['depths']
+        self.results = state['results']
+        # pages that were in flight when the crawl stopped are downloaded again
+        self.queue = collections.deque(url for url in self.depths if url not in self.results)
+        print(f"Resuming crawl: {len(self.results)} pages done, {len(self.queue)} queued")
+        return True
+
+async def downloads(chatbot_id, urls, browser_pool=None, cpu_pool=None, progress=None):
+    """
+    Download every URL into ``document_chatbot/<chatbot_id>/``.
+
+    Documents are kept between runs under stable names and recorded in the chatbot's
+    manifest; a refresh only re-downloads what changed (conditional requests plus a
+    content hash) and deletes documents whose URL is no longer listed.
+
+    Pass a long-lived ``browser_pool`` and ``cpu_pool`` to share Chromium and the
+    cleaning processes across calls (see server.py); otherwise they are created for
+    this run and closed at the end.
+
+    ``progress(url, document, done, total)`` is called on the event loop after each URL
+    (``document`` is False when it failed).
+
+    Returns a dict with the per-URL ``documents_downloaded`` list (False for failures),
+    the URLs ``added``, ``changed``, ``unchanged``, ``removed`` and ``failed``, and the
+    ``duplicates`` ({url: url of the document kept}) left out of the index (see
+    collapse_duplicates()).
+    """
+    return await ingest(chatbot_id, Frontier(urls), browser_pool, cpu_pool, progress=progress)
+
+async def crawl(chatbot_id, seed_url, max_depth=CRAWL_MAX_DEPTH, max_pages=CRAWL_MAX_PAGES, sitemap=True,
+                browser_pool=None, cpu_pool=None, progress=None):
+    """
+    Crawl the site of ``seed_url`` (same domain links, up to ``max_depth`` clicks and
+    ``max_pages`` pages, seeded from its sitemaps) into ``document_chatbot/<chatbot_id>/``.
+
+    The frontier is checkpointed while crawling; calling crawl again with the same
+    arguments after a crash resumes where it stopped. ``progress`` and the returned dict
+    are the same as for downloads().
+    """
+    return await ingest(chatbot_id, Frontier([seed_url], max(max_depth, 1), max_pages), browser_pool, cpu_pool,
+                        sitemap, progress)
+
+def collapse_duplicates(chatbot_directory, manifest, previous_manifest):
+    """
+    Hide the documents of ``manifest`` that duplicate another one (same text, or nearly,
+    see dedup.py) from the indexer: their file is renamed with a leading dot, which
+    SimpleDirectoryReader skips, and kept for refreshes. The manifest entry of a
+    duplicate records ``duplicate_of``, the one of the document kept its ``duplicates``.
+    Documents indexed before are kept over new copies. Returns {duplicate: kept}.
+    """
+    fingerprints = {url: entry['fingerprint'] for url, entry in manifest.items() if entry.get('fingerprint')}
+    indexed = [url for url, entry in previous_manifest.items() if 'duplicate_of' not in entry]
+    duplicates = dedup.find_duplicates(fingerprints, indexed)
+    for url, entry in manifest.items():
+        entry.pop('duplicate_of', None)
+        entry.pop('duplicates', None)
+        filename = entry['filename'].lstrip('.')
+        if url in duplicates:
+            entry['duplicate_of'] = duplicates[url]
+            filename = '.' + filename
+        if filename != entry['filename'] and os.path.exists(chatbot_directory + entry['filename']):
+            os.replace(chatbot_directory + entry['filename'], chatbot_directory + filename)
+            entry['filename'] = filename
+    for url, kept in duplicates.items():
+        manifest[kept].setdefault('duplicates', []).append(url)
+        print(f"Duplicate: {url} of {kept}")
+    return duplicates
+
+async def ingest(chatbot_id, frontier, browser_pool=None, cpu_pool=None, sitemap=False, progress=None):
     print("download documents")
+    own_browser_pool = browser_pool is None
+    if own_browser_pool:
+        browser_pool = BrowserPool()
+    own_cpu_pool = cpu_pool is None
+    if own_cpu_pool:
+        cpu_pool = create_cpu_pool()
     chatbot_directory = "document_chatbot/" + chatbot_id + "/"
-    if not os.path.exists("document_chatbot/"):
-        os.mkdir("document_chatbot/")
-    if os.path.exists(chatbot_directory):
-        shutil.rmtree(chatbot_directory)    
-    os.mkdir(chatbot_directory)
-    urls_metadata = []
-    for url in urls:
-        urls_metadata.append({
-            'title': "",
-            'tags': [],
-            'url': url,
-            'priority': 'high'
-        })
-    tasks = []
-    i = 0
-    for document_metadata in urls_metadata:
-        delay_time = i*DELAY_TIME
-        tasks.append(download_file(chatbot_directory, document_metadata, delay_time))
-        i = i + 1
-    documents_downloaded = await asyncio.gather(*tasks)
-    print("download documents finish")
-    return documents_downloaded
+    os.makedirs(chatbot_directory, exist_ok=True)
+    # documents of a directory ingested before manifests existed (random names) are
+    # replaced by the ones downloaded now, or they would be indexed twice
+    legacy = not os.path.exists(chatbot_directory + MANIFEST_NAME)
+    manifest = load_manifest(chatbot_directory)
+    checkpoint_path = chatbot_directory + CRAWL_STATE_NAME
+    resumed = frontier.follow_links and frontier.load(checkpoint_path)
 
-def clean_mixed_text(text):
-    # Initialize the tokenizer and spell checker
-    t = Tokenizer()
-    spell = SpellChecker()
-    tokens = t.tokenize(text, wakati=True)
+    # a fixed set of workers pulls the next URL as soon as one finishes, so the
+    # connection pool stays busy without sleeping on a schedule
+    async def worker(session):
+        while (url := await frontier.get()) is not None:
+            document_metadata = {
+                'title': "",
+                'tags': [],
+                'url': url,
+                'priority': 'high'
+            }
+            document = False
+            try:
+                document = await download_file(chatbot_directory, document_metadata, session, browser_pool,
+                                               manifest.get(url), cpu_pool, frontier.follow_links)
+                if document and 'fingerprint' not in document:
+                    try:
+                        document['fingerprint'] = await asyncio.get_running_loop().run_in_executor(
+                            cpu_pool, dedup.fingerprint_file, document['final_path'], document['extension'])
+                    except Exception as e:
+                        # the document is indexed, it only cannot be compared with the others
+                        print(f"Not fingerprinted: {url} -> {e}")
+                        document['fingerprint'] = None
+            except Exception as e:
+                print(f"Failed: {url} -> {e}")
+            frontier.done(url, document)
+            if progress is not None:
+                progress(url, document, len(frontier.results), len(frontier.depths))
+            if frontier.follow_links and len(frontier.results) % CHECKPOINT_INTERVAL == 0:
+                frontier.save(checkpoint_path)
 
-    cleaned_tokens = []
-    previous_token_is_english = False
+    try:
+        async with create_http_session() as session:
+            if sitemap and not resumed:
+                for seed in frontier.seeds:
+                    remaining = None if frontier.max_pages is None else frontier.max_pages - len(frontier.depths)
+                    for url in await fetch_sitemap_urls(session, seed, remaining or MAX_SITEMAP_URLS, cpu_pool):
+                        url = normalize_url(url)
+                        if url and site_of(url) in frontier.sites:
+                            frontier.add(url, 0)
+            await asyncio.gather(*(worker(session) for _ in range(MAX_CONCURRENT_DOWNLOADS)))
+    finally:
+        if own_browser_pool:
+            await browser_pool.close()
+        if own_cpu_pool:
+            cpu_pool.shutdown()
 
-    for token in tokens:
-        if token is None:
+    documents_downloaded = [frontier.results.get(url, False) for url in frontier.depths]
+    result = {'documents_downloaded': documents_downloaded,
+              'added': [], 'changed': [], 'unchanged': [], 'removed': [], 'failed': [], 'duplicates': {}}
+    new_manifest = {}
+    for url, document in zip(frontier.depths, documents_downloaded):
+        if not document:
+            result['failed'].append(url)
+            # keep the previous copy, a failed refresh must not drop a document
+            if url in manifest:
+                new_manifest[url] = manifest[url]
             continue
-        # Determine if the token is an English word
-        is_english = re.match(r'^[a-zA-Z]+$', token)
-        
-        # Correct spelling mistakes in English words using SpellChecker
-        # if is_english:
-        #     token = spell.correction(token)
-        if token is None:
-            continue
-        # Add spaces appropriately between English and Japanese words
-        if cleaned_tokens:
-            if is_english and not previous_token_is_english:
-                cleaned_tokens.append(' ')
-            elif not is_english and previous_token_is_english:
-                cleaned_tokens.append(' ')
-        
-        cleaned_tokens.append(token)
-        previous_token_is_english = is_english
-
-    # Join tokens to create text
-    cleaned_text = ''.join(cleaned_tokens)
-    
-    # Remove extra spaces within sentences
-    cleaned_text = re.sub(r'\s+', ' ', cleaned_text)
-    # Adjust spaces around punctuation marks
-    cleaned_text = re.sub(r' ([.,!?;:])', r'\1', cleaned_text)
-    # Remove leading and trailing spaces
-    cleaned_text = cleaned_text.strip()
-    # Remove spaces between Japanese characters
-    cleaned_text = re.sub(r'(?<=[\u3040-\u30FF\u4E00-\u9FFF]) (?=[\u3040-\u30FF\u4E00-\u9FFF])', '', cleaned_text)
+        result[document['status']].append(url)
+        new_manifest[url] = {
+            'filename': os.path.basename(document['final_path']),
+            'extension': document['extension'],
+            'sha256': document['sha256'],
+            'etag': document.get('etag') or manifest.get(url, {}).get('etag'),
+            'last_modified': document.get('last_modified') or manifest.get(url, {}).get('last_modified'),
+            'fingerprint': document.get('fingerprint'),
+        }
+        if 'links' in document:
+            new_manifest[url]['links'] = document.pop('links')
+    result['duplicates'] = collapse_duplicates(chatbot_directory, new_manifest, manifest)
+    kept_files = {entry['filename'] for entry in new_manifest.values()}
+    for url, entry in manifest.items():
+        if url not in new_manifest:
+            result['removed'].append(url)
+        if entry['filename'] not in kept_files and os.path.exists(chatbot_directory + entry['filename']):
+            os.remove(chatbot_directory + entry['filename'])
+    if legacy:
+        for entry in os.scandir(chatbot_directory):
+            if entry.is_file() and not entry.name.startswith('.') and entry.name not in kept_files:
+                print(f"Removed untracked document {entry.name}")
+                os.remove(entry.path)
+    save_manifest(chatbot_directory, new_manifest)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    print(f"download documents finish: {len(result['added'])} added, {len(result['changed'])} changed, "
+          f"{len(result['unchanged'])} unchanged, {len(result['removed'])} removed, {len(result['failed'])} failed, "
+          f"{len(result['duplicates'])} duplicates not indexed")
+    return result
+
+class MixedTextNormalizer:
+    """
+    Spacing cleanup for mixed Japanese/English text: one space between Japanese and
+    Latin letters, no spaces between Japanese characters. Only the spaces at those
+    script boundaries change, so URLs, e-mail addresses, model numbers and any other
+    ASCII run are left as they are, and so is the leading indentation of a line.
+
+    The patterns are compiled once per normalizer; get_text_normalizer() returns the
+    shared one of the current thread.
+    """
+    JAPANESE = '[\u3040-\u30FF\u3400-\u4DBF\u4E00-\u9FFF\uF900-\uFAFF\uFF66-\uFF9F]'
+    LATIN = '[A-Za-z]'
+    # horizontal whitespace only, lines are normalized one at a time
+    SPACES = r'[^\S\r\n]'
+    SPACE_BETWEEN_JAPANESE = re.compile(f'(?<={JAPANESE}){SPACES}+(?={JAPANESE})')
+    SPACE_AT_SCRIPT_BOUNDARY = re.compile(
+        f'(?<={JAPANESE}){SPACES}*(?={LATIN})|(?<={LATIN}){SPACES}*(?={JAPANESE})')
+
+    def normalize(self, text: str) -> str:
+        text = self.SPACE_BETWEEN_JAPANESE.sub('', text)
+        return self.SPACE_AT_SCRIPT_BOUNDARY.sub(' ', text)
+
+    def normalize_all(self, texts):
+        """Normalize many texts with the same compiled patterns, yielding each normalized text."""
+        for text in texts:
+            yield self.normalize(text)
+
+text_normalizer_state = threading.local()
 
-    return cleaned_text
+def get_text_normalizer() -> MixedTextNormalizer:
+    normalizer = getattr(text_normalizer_state, 'normalizer', None)
+    if normalizer is None:
+        normalizer = text_normalizer_state.normalizer = MixedTextNormalizer()
+    return normalizer
+
+def clean_mixed_text(text):
+    return get_text_normalizer().normalize(text)
+
+def normalize_text_file(path):
+    """
+    Normalize a downloaded UTF-8 text document line by line, in constant memory.
+    Files in another encoding are left as they are.
+    """
+    part_path = part_path_of(path)
+    try:
+        with open(path, "r", encoding="UTF-8") as src, open(part_path, "w", encoding="UTF-8") as dst:
+            lines = (line.rstrip('\r\n') for line in src)
+            for line in get_text_normalizer().normalize_all(lines):
+                dst.write(line + '\n')
+        os.replace(part_path, path)
+        return True
+    except UnicodeDecodeError:
+        print(f"Not normalized, {path} is not UTF-8")
+        return False
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Async downloader")
     parser.add_argument('--name', required=True, help='Name of the download task')
-    parser.add_argument('--urls', nargs='+', required=True, help='List of URLs to download')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--urls', nargs='+', help='List of URLs to download')
+    source.add_argument('--crawl', metavar='URL', help='Seed URL of a site to crawl')
+    parser.add_argument('--max-depth', type=int, default=CRAWL_MAX_DEPTH,
+                        help='Maximum number of links followed from the seed URL (--crawl)')
+    parser.add_argument('--max-crawl-pages', type=int, default=CRAWL_MAX_PAGES,
+                        help='Maximum number of pages downloaded (--crawl)')
+    parser.add_argument('--no-sitemap', action='store_true', help='Do not seed the crawl from sitemap.xml')
+    parser.add_argument('--max-pages', type=int, default=MAX_CONCURRENT_PAGES,
+                        help='Maximum number of browser pages rendering at the same time')
+    parser.add_argument('--cpu-workers', type=int, default=CPU_WORKERS,
+                        help='Number of processes cleaning downloaded documents')
     args = parser.parse_args()
 
     # Additional validation
@@ -277,13 +1025,39 @@ def parse_args():
         print("Error: --name cannot be empty or just spaces.")
         sys.exit(1)
 
-    filtered_urls = [url for url in args.urls if url.strip()]
-    if not filtered_urls:
-        print("Error: --urls must contain at least one non-empty URL.")
+    if args.crawl is not None:
+        if normalize_url(args.crawl) is None:
+            print("Error: --crawl must be an http(s) URL.")
+            sys.exit(1)
+        if args.max_depth < 1 or args.max_crawl_pages < 1:
+            print("Error: --max-depth and --max-crawl-pages must be at least 1.")
+            sys.exit(1)
+    else:
+        args.urls = [url for url in args.urls if url.strip()]
+        if not args.urls:
+            print("Error: --urls must contain at least one non-empty URL.")
+            sys.exit(1)
+    if args.max_pages < 1:
+        print("Error: --max-pages must be at least 1.")
+        sys.exit(1)
+    if args.cpu_workers < 1:
+        print("Error: --cpu-workers must be at least 1.")
         sys.exit(1)
-    return args.name, filtered_urls
+    return args
+
+async def main(args):
+    browser_pool = BrowserPool(args.max_pages)
+    cpu_pool = create_cpu_pool(args.cpu_workers)
+    try:
+        if args.crawl is not None:
+            return await crawl(args.name, args.crawl, args.max_depth, args.max_crawl_pages, not args.no_sitemap,
+                               browser_pool, cpu_pool)
+        return await downloads(args.name, args.urls, browser_pool, cpu_pool)
+    finally:
+        await browser_pool.close()
+        cpu_pool.shutdown()
 
 if __name__=='__main__':
-    name, urls = parse_args()
-    print(name, urls)
-    asyncio.run(downloads(name, urls))
\ No newline at end of file
+    args = parse_args()
+    print(args.name, args.crawl or args.urls)
+    asyncio.run(main(args))
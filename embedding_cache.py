@@ -0,0 +1,100 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import logging
+import os
+import sqlite3
+
+import numpy as np
+from llama_index.core.schema import MetadataMode
+
+logger = logging.getLogger("indexer")
+
+# shared by every chatbot: the same chunk embedded with the same model is embedded once
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./chatbot-knowledge-storage/.embedding_cache.sqlite")
+# texts per embedding request and requests in flight at the same time
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+
+
+def model_key(embed_model):
+    return f"{embed_model.class_name()}:{getattr(embed_model, 'model_name', '')}"
+
+
+class EmbeddingCache:
+    """On-disk embeddings keyed by the sha256 of the embedding model and the chunk text."""
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    @staticmethod
+    def key(model, text):
+        return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        keys = list(set(keys))
+        # bounded by SQLite's limit on query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            found.update((key, np.frombuffer(vector, dtype=np.float32).tolist()) for key, vector in rows)
+        return found
+
+    def put_many(self, items):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                ((key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items))
+
+    def close(self):
+        self.connection.close()
+
+
+async def embed_texts(embed_model, texts):
+    """Embed ``texts`` in EMBED_BATCH_SIZE batches, EMBED_CONCURRENCY requests at a time."""
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+    async def embed_batch(batch):
+        async with semaphore:
+            return await embed_model.aget_text_embedding_batch(batch)
+
+    batches = [texts[start:start + EMBED_BATCH_SIZE] for start in range(0, len(texts), EMBED_BATCH_SIZE)]
+    return [embedding for batch in await asyncio.gather(*(embed_batch(batch) for batch in batches))
+            for embedding in batch]
+
+
+def run_async(coroutine):
+    """
+    Run ``coroutine`` to completion from synchronous code. Called from an event loop (the
+    ingest jobs of server.py), it runs on a loop of its own in another thread, as
+    asyncio.run() cannot be nested.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding") as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def embed_nodes(nodes, embed_model, cache):
+    """Set the embedding of every node, from the cache when its text was embedded before."""
+    model = model_key(embed_model)
+    keys = [cache.key(model, node.get_content(metadata_mode=MetadataMode.EMBED)) for node in nodes]
+    cached = cache.get_many(keys)
+    missing = {}
+    for node, key in zip(nodes, keys):
+        if key not in cached:
+            missing.setdefault(key, node.get_content(metadata_mode=MetadataMode.EMBED))
+    if missing:
+        embeddings = run_async(embed_texts(embed_model, list(missing.values())))
+        cache.put_many(zip(missing, embeddings))
+        cached.update(zip(missing, embeddings))
+    for node, key in zip(nodes, keys):
+        node.embedding = cached[key]
+    logger.info(f"{len(nodes)} chunks, {len(missing)} embedded and the others from the cache")
@@ -0,0 +1,252 @@
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from llama_index.core import (
+    Settings,
+    SimpleDirectoryReader,
+    StorageContext,
+    VectorStoreIndex,
+    load_index_from_storage,
+)
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import MetadataMode
+from llama_index.core.vector_stores import SimpleVectorStore
+
+from embedding_cache import EmbeddingCache, embed_nodes
+from retrieval import BM25Index, KnowledgeBase, tokenize_all
+from vector_store import VECTOR_NODES_NAME, MmapVectorStore
+
+logger = logging.getLogger("indexer")
+
+# documents downloaded for a chatbot and its persisted index, by chatbot_id (as in server.py)
+DOCUMENTS_ROOT = "document_chatbot"
+STORAGE_ROOT = "./chatbot-knowledge-storage"
+# per-file content hash and the ids of the documents indexed from it, next to the persisted index
+INDEX_STATE_NAME = "index_state.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+# processes parsing changed documents (PDFs and the like) in parallel
+PARSE_WORKERS = int(os.getenv("INDEX_PARSE_WORKERS", str(os.cpu_count() or 1)))
+# vector store files of indexes persisted before MmapVectorStore, converted by update_index()
+LEGACY_VECTOR_STORE_NAMES = ("default__vector_store.json", "vector_ids.json")
+
+
+def chatbot_documents_dir(chatbot_id):
+    return os.path.join(DOCUMENTS_ROOT, chatbot_id)
+
+
+def chatbot_persist_dir(chatbot_id):
+    return os.path.join(STORAGE_ROOT, chatbot_id)
+
+
+def chatbot_ids():
+    """Every chatbot with downloaded documents."""
+    if not os.path.isdir(DOCUMENTS_ROOT):
+        return []
+    return sorted(entry.name for entry in os.scandir(DOCUMENTS_ROOT) if entry.is_dir())
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def document_files(chatbot_dir):
+    # the files SimpleDirectoryReader would read: not hidden (the downloader manifest), not recursive
+    return sorted(entry.name for entry in os.scandir(chatbot_dir)
+                  if entry.is_file() and not entry.name.startswith('.'))
+
+
+def load_index_state(persist_dir):
+    try:
+        with open(os.path.join(persist_dir, INDEX_STATE_NAME), 'r', encoding="UTF-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_index_state(persist_dir, state):
+    path = os.path.join(persist_dir, INDEX_STATE_NAME)
+    with open(path + ".tmp", 'w', encoding="UTF-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def index_version(persist_dir):
+    # update_index() saves the index state last; None for an index it has not built or updated yet
+    try:
+        return os.stat(os.path.join(persist_dir, INDEX_STATE_NAME)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def load_vector_store(persist_dir):
+    if os.path.exists(os.path.join(persist_dir, VECTOR_NODES_NAME)):
+        return MmapVectorStore.from_persist_dir(persist_dir)
+    return MmapVectorStore.from_simple_vector_store(SimpleVectorStore.from_persist_dir(persist_dir))
+
+
+def remove_legacy_vector_store(persist_dir):
+    for name in LEGACY_VECTOR_STORE_NAMES:
+        if os.path.exists(os.path.join(persist_dir, name)):
+            os.remove(os.path.join(persist_dir, name))
+
+
+def update_bm25(index, persist_dir):
+    """Persist the BM25 index of the nodes of ``index``, tokenizing only nodes it did not have."""
+    bm25 = BM25Index.from_persist_dir(persist_dir) if BM25Index.exists(persist_dir) else BM25Index.empty()
+    node_ids = index.vector_store.node_ids
+    known = set(bm25.node_ids)
+    new_nodes = index.docstore.get_nodes([node_id for node_id in node_ids if node_id not in known])
+    tokens = tokenize_all([node.get_content(metadata_mode=MetadataMode.NONE) for node in new_nodes], PARSE_WORKERS)
+    bm25 = bm25.updated(node_ids, {node.node_id: node_tokens for node, node_tokens in zip(new_nodes, tokens)})
+    bm25.persist(persist_dir)
+    logger.info(f"BM25 index {persist_dir}: {len(new_nodes)} chunks tokenized, {len(node_ids)} in total")
+
+
+def update_index(chatbot_dir, persist_dir):
+    """
+    Bring the index persisted in ``persist_dir`` up to date with the documents in
+    ``chatbot_dir``: files are compared by content hash, only new and changed files are
+    parsed (in PARSE_WORKERS processes) and only chunks missing from the EmbeddingCache
+    are embedded, and the documents of changed or removed files are deleted from the
+    index. The index and its BM25 index are loaded and persisted again only when
+    something changed. Returns True when it did.
+
+    An index persisted without an index state (built before incremental updates) is
+    rebuilt once; one persisted before MmapVectorStore or without a BM25 index is
+    converted once. It blocks until done, also when called from an event loop (run it
+    with asyncio.to_thread() there to keep the loop responsive).
+    """
+    state = load_index_state(persist_dir) if os.path.exists(persist_dir) else None
+    hashes = {name: file_sha256(os.path.join(chatbot_dir, name)) for name in document_files(chatbot_dir)}
+    changed = [name for name, sha256 in hashes.items() if (state or {}).get(name, {}).get('sha256') != sha256]
+    removed = [name for name in state or {} if name not in hashes]
+    converted = os.path.exists(os.path.join(persist_dir, VECTOR_NODES_NAME)) and BM25Index.exists(persist_dir)
+    if state is not None and not changed and not removed and converted:
+        logger.info(f"index {persist_dir} is up to date ({len(hashes)} files)")
+        return False
+
+    if state is None:
+        index = VectorStoreIndex([], storage_context=StorageContext.from_defaults(vector_store=MmapVectorStore()))
+        state = {}
+    else:
+        storage_context = StorageContext.from_defaults(persist_dir=persist_dir,
+                                                       vector_store=load_vector_store(persist_dir))
+        index = load_index_from_storage(storage_context)
+    for name in changed + removed:
+        for doc_id in state.pop(name, {}).get('doc_ids', []):
+            index.delete_ref_doc(doc_id, delete_from_docstore=True)
+    if changed:
+        input_files = [os.path.join(chatbot_dir, name) for name in changed]
+        documents = SimpleDirectoryReader(input_files=input_files, filename_as_id=True).load_data(
+            num_workers=min(PARSE_WORKERS, len(input_files)))
+        for name in changed:
+            state[name] = {'sha256': hashes[name], 'doc_ids': []}
+        nodes = run_transformations(documents, Settings.transformations)
+        cache = EmbeddingCache()
+        try:
+            embed_nodes(nodes, Settings.embed_model, cache)
+        finally:
+            cache.close()
+        index.insert_nodes(nodes)
+        for document in documents:
+            index.docstore.set_document_hash(document.doc_id, document.hash)
+            state[document.metadata['file_name']]['doc_ids'].append(document.doc_id)
+
+    index.storage_context.persist(persist_dir=persist_dir)
+    update_bm25(index, persist_dir)
+    remove_legacy_vector_store(persist_dir)
+    save_index_state(persist_dir, state)
+    logger.info(f"index {persist_dir} updated: {len(changed)} files parsed, {len(removed)} removed, "
+                f"{len(hashes) - len(changed)} unchanged")
+    return True
+
+
+def load_index(persist_dir):
+    """
+    Load a persisted index and its BM25 index for querying, as a retrieval.KnowledgeBase.
+    The embeddings and BM25 postings are memory-mapped read-only (see
+    vector_store.MmapVectorStore), so the processes of a worker loading the same index
+    share one copy of them; only the docstore is parsed per process.
+    """
+    version = index_version(persist_dir)
+    vector_store = MmapVectorStore.from_persist_dir(persist_dir)
+    storage_context = StorageContext.from_defaults(persist_dir=persist_dir, vector_store=vector_store)
+    bm25 = BM25Index.from_persist_dir(persist_dir) if BM25Index.exists(persist_dir) else None
+    if bm25 is None:
+        logger.warning(f"no BM25 index in {persist_dir}, vector retrieval only (run indexer.py to build it)")
+    return KnowledgeBase(load_index_from_storage(storage_context), bm25, version)
+
+
+class IndexCache:
+    """
+    Loaded indexes of many chatbots, least recently used first out once their estimated
+    memory exceeds ``max_bytes`` (the last used index is always kept). An index is
+    loaded again when update_index() changed it since it was cached. get() returns None
+    for a chatbot without an index built by update_index() (none, or one persisted
+    before index states, which the next update rebuilds). Thread safe, so jobs running
+    as threads of one worker share it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.indexes = collections.OrderedDict()  # chatbot_id -> (version, size, index)
+        self.lock = threading.Lock()
+        self.loading = collections.defaultdict(threading.Lock)
+
+    @staticmethod
+    def version(chatbot_id):
+        return index_version(chatbot_persist_dir(chatbot_id))
+
+    @staticmethod
+    def estimate_size(chatbot_id):
+        # the parsed docstore, index store, vector node ids and BM25 terms; the arrays are mapped, evictable page cache
+        directory = chatbot_persist_dir(chatbot_id)
+        return sum(entry.stat().st_size for entry in os.scandir(directory)
+                   if entry.name.endswith(".json"))
+
+    def get(self, chatbot_id):
+        version = self.version(chatbot_id)
+        if version is None:
+            return None
+        with self.lock:
+            cached = self.indexes.get(chatbot_id)
+            if cached is not None and cached[0] == version:
+                self.indexes.move_to_end(chatbot_id)
+                return cached[2]
+            loading = self.loading[chatbot_id]
+        # one thread loads a chatbot's index, the others wait for it
+        with loading:
+            with self.lock:
+                cached = self.indexes.get(chatbot_id)
+                if cached is not None and cached[0] == version:
+                    self.indexes.move_to_end(chatbot_id)
+                    return cached[2]
+            index = load_index(chatbot_persist_dir(chatbot_id))
+            size = self.estimate_size(chatbot_id)
+            with self.lock:
+                self.indexes[chatbot_id] = (version, size, index)
+                self.indexes.move_to_end(chatbot_id)
+                while len(self.indexes) > 1 and sum(entry[1] for entry in self.indexes.values()) > self.max_bytes:
+                    evicted, _ = self.indexes.popitem(last=False)
+                    logger.info(f"index of {evicted} evicted from the cache")
+            return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Update the knowledge index of a chatbot")
+    names = parser.add_mutually_exclusive_group(required=True)
+    names.add_argument('--name', help='Name of the chatbot (document_chatbot/<name>)')
+    names.add_argument('--all', action='store_true', help='Update the index of every chatbot')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for name in chatbot_ids() if args.all else [args.name]:
+        update_index(chatbot_documents_dir(name), chatbot_persist_dir(name))
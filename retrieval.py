@@ -0,0 +1,399 @@
+import asyncio
+import collections
+import concurrent.futures
+import difflib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import List
+
+import numpy as np
+from janome.tokenizer import Tokenizer
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.chat_engine import ContextChatEngine
+from llama_index.core.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+logger = logging.getLogger("retrieval")
+
+# lexical index next to the vector store: per-term postings (CSR) and the terms / node ids
+BM25_TERMS_NAME = "bm25_terms.json"
+BM25_ARRAY_NAMES = ("bm25_indptr", "bm25_rows", "bm25_tfs", "bm25_doc_lengths")
+BM25_K1 = 1.2
+BM25_B = 0.75
+# "vector" (embedding only), "bm25" (no embedding call) or "hybrid" (both, rank fused)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# in hybrid mode, how long to wait for the vector results before answering from BM25 alone
+RETRIEVAL_BUDGET_MS = float(os.getenv("RETRIEVAL_BUDGET_MS", "300"))
+# candidates taken from each retriever before fusion, and the reciprocal rank fusion constant
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "10"))
+RRF_K = 60
+# nodes tokenized in processes when at least this many are new
+PARALLEL_TOKENIZE_MIN = 256
+
+# interim transcripts retrieved for when at least this long and this much longer or shorter than the
+# last one (normalized), and at most one per SPECULATIVE_INTERVAL_MS; each costs a query embedding
+SPECULATIVE_MIN_CHARS = int(os.getenv("SPECULATIVE_MIN_CHARS", "6"))
+SPECULATIVE_MIN_GROWTH = int(os.getenv("SPECULATIVE_MIN_GROWTH", "4"))
+SPECULATIVE_INTERVAL_MS = float(os.getenv("SPECULATIVE_INTERVAL_MS", "300"))
+# similarity (difflib ratio) of a final question to a speculated transcript for its nodes to be used
+SPECULATIVE_MATCH = float(os.getenv("SPECULATIVE_MATCH", "0.9"))
+# speculative retrievals kept per turn, the oldest is cancelled
+SPECULATIONS_KEPT = 4
+
+# tokens made of letters or digits; lone hiragana are particles
+WORD = re.compile(r'\w')
+PARTICLE = re.compile(r'[ぁ-ゟ]')
+
+tokenizer_state = threading.local()
+
+
+def normalize_question(text):
+    """The question without case, width, punctuation and spacing differences."""
+    return ''.join(re.findall(r'\w+', unicodedata.normalize('NFKC', text).lower()))
+
+
+def tokenize(text):
+    """Janome tokens of NFKC normalized, lower case text, without punctuation and particles."""
+    tokenizer = getattr(tokenizer_state, 'tokenizer', None)
+    if tokenizer is None:
+        tokenizer = tokenizer_state.tokenizer = Tokenizer(wakati=True)
+    text = unicodedata.normalize('NFKC', text).lower()
+    return [token for token in tokenizer.tokenize(text, wakati=True)
+            if WORD.search(token) and not PARTICLE.fullmatch(token)]
+
+
+def tokenize_all(texts, workers):
+    if len(texts) < PARALLEL_TOKENIZE_MIN or workers < 2:
+        return [tokenize(text) for text in texts]
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return list(pool.map(tokenize, texts, chunksize=64))
+
+
+class BM25Index:
+    """
+    Okapi BM25 over janome tokens of the index's nodes. Postings are stored per term
+    (CSR arrays) so a query only touches the postings of its terms; a persisted index
+    is memory-mapped like the vector store.
+    """
+
+    def __init__(self, terms, node_ids, indptr, rows, tfs, doc_lengths):
+        self.terms = terms
+        self.node_ids = node_ids
+        self.indptr = indptr
+        self.rows = rows
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+
+    @classmethod
+    def from_entries(cls, terms, node_ids, doc_lengths, entry_terms, entry_rows, entry_tfs):
+        """Build the postings from (term, row, tf) entries, dropping terms without any."""
+        used, entry_terms = np.unique(entry_terms, return_inverse=True)
+        order = np.lexsort((entry_rows, entry_terms))
+        indptr = np.zeros(len(used) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(entry_terms, minlength=len(used)), out=indptr[1:])
+        return cls([terms[i] for i in used], list(node_ids), indptr, entry_rows[order].astype(np.int32),
+                   entry_tfs[order].astype(np.float32), np.asarray(doc_lengths, dtype=np.float32))
+
+    def updated(self, node_ids, new_tokens):
+        """
+        A BM25 index of ``node_ids``: rows of this index whose node is still listed are
+        kept, and ``new_tokens`` (node id -> tokens) are added for the others.
+        """
+        terms = list(self.terms)
+        term_ids = dict(self.term_ids)
+        old_rows = {node_id: row for row, node_id in enumerate(self.node_ids)}
+        row_map = np.full(len(self.node_ids), -1, dtype=np.int64)
+        doc_lengths = []
+        entries = [[], [], []]
+        for row, node_id in enumerate(node_ids):
+            if node_id in old_rows:
+                row_map[old_rows[node_id]] = row
+                doc_lengths.append(self.doc_lengths[old_rows[node_id]])
+                continue
+            counts = {}
+            for token in new_tokens[node_id]:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                if token not in term_ids:
+                    term_ids[token] = len(terms)
+                    terms.append(token)
+                entries[0].append(term_ids[token])
+                entries[1].append(row)
+                entries[2].append(count)
+            doc_lengths.append(len(new_tokens[node_id]))
+
+        old_terms = np.repeat(np.arange(len(self.terms)), np.diff(self.indptr))
+        old_rows_mapped = row_map[self.rows]
+        kept = old_rows_mapped >= 0
+        return BM25Index.from_entries(
+            terms, node_ids, doc_lengths,
+            np.concatenate([old_terms[kept], np.asarray(entries[0], dtype=np.int64)]),
+            np.concatenate([old_rows_mapped[kept], np.asarray(entries[1], dtype=np.int64)]),
+            np.concatenate([np.asarray(self.tfs)[kept], np.asarray(entries[2], dtype=np.float32)]))
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32),
+                   np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32))
+
+    @classmethod
+    def exists(cls, persist_dir):
+        return os.path.exists(os.path.join(persist_dir, BM25_TERMS_NAME))
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir):
+        with open(os.path.join(persist_dir, BM25_TERMS_NAME), 'r', encoding="UTF-8") as f:
+            names = json.load(f)
+        arrays = [np.load(os.path.join(persist_dir, name + ".npy"), mmap_mode='r') for name in BM25_ARRAY_NAMES]
+        return cls(names['terms'], names['node_ids'], *arrays)
+
+    def persist(self, persist_dir):
+        arrays = (self.indptr, self.rows, self.tfs, self.doc_lengths)
+        for name, array in zip(BM25_ARRAY_NAMES, arrays):
+            path = os.path.join(persist_dir, name + ".npy")
+            with open(path + ".tmp", 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(path + ".tmp", path)
+        path = os.path.join(persist_dir, BM25_TERMS_NAME)
+        with open(path + ".tmp", 'w', encoding="UTF-8") as f:
+            json.dump({'terms': self.terms, 'node_ids': self.node_ids}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def search(self, tokens, top_k):
+        """The ``top_k`` (node_id, score) of the nodes matching any of the tokens, best first."""
+        term_ids = {self.term_ids[token] for token in tokens if token in self.term_ids}
+        if not term_ids:
+            return []
+        documents = len(self.node_ids)
+        scores = np.zeros(documents, dtype=np.float32)
+        for term_id in term_ids:
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            rows = self.rows[start:end]
+            tfs = self.tfs[start:end]
+            idf = math.log(1 + (documents - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[rows] / self.average_length)
+            scores[rows] += idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+        matches = np.flatnonzero(scores)
+        k = min(top_k, len(matches))
+        top = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(self.node_ids[row], float(scores[row])) for row in top]
+
+
+class BM25Retriever(BaseRetriever):
+    """Retrieve nodes with a BM25Index, without any embedding call."""
+
+    def __init__(self, bm25, docstore, similarity_top_k=DEFAULT_SIMILARITY_TOP_K):
+        super().__init__()
+        self._bm25 = bm25
+        self._docstore = docstore
+        self._similarity_top_k = similarity_top_k
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        hits = self._bm25.search(tokenize(query_bundle.query_str), self._similarity_top_k)
+        return [NodeWithScore(node=self._docstore.get_node(node_id), score=score) for node_id, score in hits]
+
+
+def reciprocal_rank_fusion(result_lists, top_k):
+    scores = {}
+    nodes = {}
+    for results in result_lists:
+        for rank, result in enumerate(results):
+            scores[result.node.node_id] = scores.get(result.node.node_id, 0.0) + 1 / (RRF_K + rank + 1)
+            nodes.setdefault(result.node.node_id, result.node)
+    best = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [NodeWithScore(node=nodes[node_id], score=scores[node_id]) for node_id in best]
+
+
+class QueryEmbeddingRetriever(BaseRetriever):
+    """
+    Vector retriever embedding the query with ``embed`` (a coroutine function of the text,
+    e.g. answer_cache.KnowledgeCache.embedding, which shares one embedding of a question
+    with the answer cache lookups) when the query bundle has no embedding yet.
+    """
+
+    def __init__(self, retriever, embed):
+        super().__init__()
+        self._retriever = retriever
+        self._embed = embed
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self._retriever.retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            embedding = await self._embed(query_bundle.query_str)
+            if embedding is not None:
+                query_bundle = QueryBundle(query_bundle.query_str, custom_embedding_strs=query_bundle.embedding_strs,
+                                           embedding=embedding.tolist())
+        return await self._retriever.aretrieve(query_bundle)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Vector and BM25 retrieval at the same time, fused by reciprocal rank. When the
+    vector results (an embedding round-trip) are not there within ``budget_ms`` of the
+    start, the BM25 results are used alone, unless BM25 found nothing.
+    """
+
+    executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="vector-retrieval")
+
+    def __init__(self, vector_retriever, bm25_retriever, similarity_top_k=DEFAULT_SIMILARITY_TOP_K,
+                 budget_ms=RETRIEVAL_BUDGET_MS):
+        super().__init__()
+        self._vector_retriever = vector_retriever
+        self._bm25_retriever = bm25_retriever
+        self._similarity_top_k = similarity_top_k
+        self._budget = budget_ms / 1000
+
+    def _fuse(self, vector, lexical):
+        return reciprocal_rank_fusion([vector, lexical], self._similarity_top_k)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        start = time.perf_counter()
+        vector_future = self.executor.submit(self._vector_retriever.retrieve, query_bundle)
+        lexical = self._bm25_retriever.retrieve(query_bundle)
+        try:
+            timeout = max(self._budget - (time.perf_counter() - start), 0) if lexical else None
+            return self._fuse(vector_future.result(timeout=timeout), lexical)
+        except concurrent.futures.TimeoutError:
+            vector_future.cancel()
+            logger.info(f"vector retrieval over the {self._budget * 1000:.0f}ms budget, BM25 results only")
+            return lexical[:self._similarity_top_k]
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        start = time.perf_counter()
+        vector_task = asyncio.ensure_future(self._vector_retriever.aretrieve(query_bundle))
+        # janome is pure Python, keep it off the event loop
+        lexical = await asyncio.to_thread(self._bm25_retriever.retrieve, query_bundle)
+        try:
+            timeout = max(self._budget - (time.perf_counter() - start), 0) if lexical else None
+            return self._fuse(await asyncio.wait_for(vector_task, timeout), lexical)
+        except asyncio.TimeoutError:
+            logger.info(f"vector retrieval over the {self._budget * 1000:.0f}ms budget, BM25 results only")
+            return lexical[:self._similarity_top_k]
+
+
+class SpeculativeRetriever(BaseRetriever):
+    """
+    Retriever starting retrievals for the transcript of a question while it is still
+    being spoken (speculate(), on interim transcripts), so retrieval overlaps the
+    endpointing delay. The question is then answered with the nodes of the speculated
+    transcript closest to it, when similar enough, else retrieved as usual.
+    """
+
+    def __init__(self, retriever, match=SPECULATIVE_MATCH):
+        super().__init__()
+        self._retriever = retriever
+        self._match = match
+        self._speculations = collections.OrderedDict()  # normalized transcript -> retrieval task
+        self._last_speculation = 0.0
+
+    async def _speculative_retrieve(self, text):
+        return await self._retriever.aretrieve(QueryBundle(text))
+
+    def speculate(self, text, final=False):
+        """
+        Start retrieving for a partial transcript of the question (from the event loop).
+        Interim transcripts are throttled; ``final`` ones (the end of a sentence) only skip
+        what was already speculated.
+        """
+        key = normalize_question(text)
+        last = next(reversed(self._speculations), '')
+        now = time.monotonic()
+        if len(key) < SPECULATIVE_MIN_CHARS or key in self._speculations:
+            return
+        if not final and (abs(len(key) - len(last)) < SPECULATIVE_MIN_GROWTH
+                          or now - self._last_speculation < SPECULATIVE_INTERVAL_MS / 1000):
+            return
+        self._last_speculation = now
+        self._speculations[key] = asyncio.ensure_future(self._speculative_retrieve(text))
+        if len(self._speculations) > SPECULATIONS_KEPT:
+            self._speculations.popitem(last=False)[1].cancel()
+
+    def _take(self, query_str):
+        """The speculation matching the question, cancelling the others."""
+        key = normalize_question(query_str)
+        best, best_ratio = None, self._match
+        for text, task in reversed(self._speculations.items()):
+            ratio = 1.0 if text == key else difflib.SequenceMatcher(None, text, key).ratio()
+            if ratio >= best_ratio and not task.cancelled():
+                best, best_ratio = task, ratio
+        for task in self._speculations.values():
+            if task is not best:
+                task.cancel()
+        self._speculations.clear()
+        return best
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self._retriever.retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        speculation = self._take(query_bundle.query_str)
+        if speculation is not None:
+            try:
+                nodes = await speculation
+                logger.info(f"retrieval of {query_bundle.query_str!r} from a speculative retrieval")
+                return nodes
+            except Exception:
+                logger.exception("speculative retrieval failed, retrieving again")
+        return await self._retriever.aretrieve(query_bundle)
+
+
+class KnowledgeBase:
+    """
+    A chatbot's loaded vector index and BM25 index (None for an index persisted without
+    one), and the version of the persisted index they were loaded from.
+    """
+
+    def __init__(self, index, bm25=None, version=None):
+        self.index = index
+        self.bm25 = bm25
+        self.version = version
+
+    def as_retriever(self, mode=RETRIEVAL_MODE, similarity_top_k=DEFAULT_SIMILARITY_TOP_K, embed=None):
+        """The retriever of ``mode``; its vector retrieval embeds queries with ``embed`` when given."""
+        def vector_retriever(similarity_top_k):
+            retriever = self.index.as_retriever(similarity_top_k=similarity_top_k)
+            return QueryEmbeddingRetriever(retriever, embed) if embed is not None else retriever
+
+        if self.bm25 is None or mode == "vector":
+            return vector_retriever(similarity_top_k)
+        if mode == "bm25":
+            return BM25Retriever(self.bm25, self.index.docstore, similarity_top_k)
+        if mode != "hybrid":
+            raise ValueError(f"RETRIEVAL_MODE must be vector, bm25 or hybrid, not {mode!r}")
+        candidates = max(HYBRID_CANDIDATES, similarity_top_k)
+        # the query embedding counts in the budget of the vector retrieval
+        return HybridRetriever(vector_retriever(candidates),
+                               BM25Retriever(self.bm25, self.index.docstore, candidates), similarity_top_k)
+
+    async def warm(self, text, mode=RETRIEVAL_MODE):
+        """
+        Retrieve ``text`` once, so the BM25 tokenizer and the index pages are loaded, with the
+        stored embedding of an indexed chunk as the query embedding: no embedding request.
+        """
+        node_ids = self.index.vector_store.node_ids
+        if node_ids:
+            embedding = self.index.vector_store.get(node_ids[0])
+            await self.as_retriever(mode).aretrieve(QueryBundle(text, embedding=embedding))
+
+    def as_chat_engine(self, mode=RETRIEVAL_MODE, retriever=None, **kwargs):
+        """
+        A ContextChatEngine (what index.as_chat_engine(chat_mode=ChatMode.CONTEXT) builds)
+        on ``retriever``, by default as_retriever(mode).
+        """
+        # the default memory keeps the history in an in-memory SQLite database whose table is
+        # missing on its other pooled connections, failing concurrent chats
+        kwargs.setdefault('memory', ChatMemoryBuffer.from_defaults())
+        return ContextChatEngine.from_defaults(retriever=retriever or self.as_retriever(mode), **kwargs)
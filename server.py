@@ -1,21 +1,144 @@
 import crochet
 crochet.setup()     # initialize crochet
+import asyncio
+import collections
+import copy
+import os
 import subprocess
-from flask import Flask, request
-from downloader import downloads
+import threading
+import uuid
+from flask import Flask, Response, request
+from downloader import BrowserPool, create_cpu_pool, downloads
 import json
 
 import time
 import logging
 
 app = Flask('Scrape With Flask')
+logger = logging.getLogger("server")
+
+# number of ingest jobs running at the same time, and finished jobs kept for the status endpoint
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+MAX_FINISHED_JOBS = int(os.getenv("INGEST_MAX_FINISHED_JOBS", "100"))
+EVENTS_KEEPALIVE = 15
+
+# Every download runs on one long-lived loop so the browser pool (and its Chromium
+# process) and the cleaning processes are shared by all requests instead of being
+# started per request.
+download_runtime = {}
+download_runtime_lock = threading.Lock()
+
+# Ingest jobs. All job state is changed on the download loop; job_events wakes the
+# threads streaming progress events.
+jobs = {}
+finished_jobs = collections.deque()
+queued_jobs = {}  # chatbot_id -> job waiting to run
+running_chatbots = set()
+job_events = threading.Condition()
+
+def get_download_runtime():
+    # started on first use, not at import: the cleaning processes import this module again
+    with download_runtime_lock:
+        if not download_runtime:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="download-loop", daemon=True).start()
+            download_runtime.update(loop=loop, browser_pool=BrowserPool(), cpu_pool=create_cpu_pool())
+            download_runtime['queue'] = asyncio.run_coroutine_threadsafe(start_ingest_workers(), loop).result()
+        return download_runtime
+
+async def start_ingest_workers():
+    queue = asyncio.Queue()
+    for _ in range(INGEST_WORKERS):
+        asyncio.get_running_loop().create_task(ingest_worker(queue))
+    return queue
+
+def add_job_event(job, event, **fields):
+    with job_events:
+        job['events'].append({'event': event, 'time': time.time(), **fields})
+        job_events.notify_all()
+
+async def submit_job(chatbot_id, urls):
+    """
+    Queue a download of ``urls`` for ``chatbot_id``. Jobs of one chatbot never run at
+    the same time: a submission while another job of the chatbot is still queued
+    replaces that job's URLs (a download always syncs the whole URL list) and returns it.
+    """
+    job = queued_jobs.get(chatbot_id)
+    if job is not None:
+        job['urls'] = urls
+        job['total'] = len(urls)
+        job['coalesced'] += 1
+        add_job_event(job, 'coalesced', total=len(urls))
+        return job
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'chatbot_id': chatbot_id,
+        'urls': urls,
+        'status': 'queued',
+        'coalesced': 0,
+        'submitted_at': time.time(),
+        'started_at': None,
+        'finished_at': None,
+        'done': 0,
+        'total': len(urls),
+        'results': {},
+        'result': None,
+        'error': None,
+        'events': [],
+    }
+    jobs[job['job_id']] = job
+    queued_jobs[chatbot_id] = job
+    add_job_event(job, 'queued', total=len(urls))
+    # a job of a running chatbot is queued once that job finishes
+    if chatbot_id not in running_chatbots:
+        download_runtime['queue'].put_nowait(job)
+    return job
+
+async def ingest_worker(queue):
+    while True:
+        job = await queue.get()
+        chatbot_id = job['chatbot_id']
+        del queued_jobs[chatbot_id]
+        running_chatbots.add(chatbot_id)
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+        add_job_event(job, 'started', total=job['total'])
+
+        def progress(url, document, done, total):
+            job['results'][url] = document['status'] if document else 'failed'
+            job['done'], job['total'] = done, total
+            add_job_event(job, 'url', url=url, status=job['results'][url], done=done, total=total)
+
+        try:
+            job['result'] = await downloads(chatbot_id, job['urls'], download_runtime['browser_pool'],
+                                            download_runtime['cpu_pool'], progress)
+            job['status'] = 'done'
+        except Exception as e:
+            logger.exception(f"ingest job {job['job_id']} failed")
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        job['finished_at'] = time.time()
+        running_chatbots.discard(chatbot_id)
+        if chatbot_id in queued_jobs:
+            queue.put_nowait(queued_jobs[chatbot_id])
+        finished_jobs.append(job['job_id'])
+        while len(finished_jobs) > MAX_FINISHED_JOBS:
+            jobs.pop(finished_jobs.popleft(), None)
+        add_job_event(job, job['status'], error=job['error'])
+
+async def job_status(job_id):
+    """A copy of a job's state, taken on the download loop that changes it (None for an unknown job)."""
+    job = jobs.get(job_id)
+    if job is None:
+        return None
+    return copy.deepcopy({key: value for key, value in job.items() if key not in ('urls', 'events')})
 
 @app.route('/test', methods=['GET'])
 def get_test():
     return {"success": True, "message": "OK"}
     
 @app.route('/download_document', methods=['POST'])
-async def post_download_document():
+def post_download_document():
     #check request data
     if request.is_json is False:
         return {"error": True, "message": "Request must be JSON"}
@@ -25,13 +148,46 @@ async def post_download_document():
     if chatbot_id is False or urls == []:
         return {"error": True, "message": "Request params invalid"}
     try:
-        # download document by url store in file local
-        documents_downloaded = await downloads(chatbot_id, urls)
-        return {"documents_downloaded": documents_downloaded}
+        # the download runs in the background, poll /download_document/<job_id> for its progress
+        runtime = get_download_runtime()
+        job = asyncio.run_coroutine_threadsafe(submit_job(chatbot_id, urls), runtime['loop']).result()
+        return {"job_id": job['job_id'], "status": job['status'], "coalesced": job['coalesced']}, 202
     except Exception as e:
-        print("download_document exception:")
-        print(e)
+        logger.exception("download_document failed")
         return {"error": True, "message": str(e)}
+
+@app.route('/download_document/<job_id>', methods=['GET'])
+def get_download_document(job_id):
+    # status, per-URL results and, once done, the downloads() result of a job
+    status = None
+    if download_runtime:
+        status = asyncio.run_coroutine_threadsafe(job_status(job_id), download_runtime['loop']).result()
+    if status is None:
+        return {"error": True, "message": "Job not found"}, 404
+    return status
+
+@app.route('/download_document/<job_id>/events', methods=['GET'])
+def get_download_document_events(job_id):
+    # progress of a job as server-sent events, the stream ends when the job is finished
+    job = jobs.get(job_id)
+    if job is None:
+        return {"error": True, "message": "Job not found"}, 404
+
+    def stream():
+        sent = 0
+        while True:
+            with job_events:
+                job_events.wait_for(lambda: len(job['events']) > sent, timeout=EVENTS_KEEPALIVE)
+                events = job['events'][sent:]
+            sent += len(events)
+            for event in events:
+                yield f"event: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                if event['event'] in ('done', 'failed'):
+                    return
+            if not events:
+                yield ": keep-alive\n\n"
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
     
 if __name__=='__main__':
-    app.run('0.0.0.0', 9000)
\ No newline at end of file
+    app.run('0.0.0.0', 9000)
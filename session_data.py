@@ -0,0 +1,176 @@
+"""
+Transcripts of the voice sessions: what the user said, what the agent answered and a
+sample of the LLM requests, one record per event appended to TRANSCRIPT_FILE (JSON lines,
+or SQLite when it ends with .sqlite or .db).
+
+Records are queued in a bounded ring buffer per session and written in batches by a
+background thread, so the event loop never waits on the disk. When the writer falls
+behind, a full buffer drops its oldest records and the count of dropped records is
+written with the end of the session.
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("session-data")
+
+# empty to disable
+TRANSCRIPT_FILE = os.getenv("TRANSCRIPT_FILE", "transcripts/transcripts.jsonl")
+# records of a session waiting for the writer, the oldest are dropped beyond it
+TRANSCRIPT_BUFFER = int(os.getenv("TRANSCRIPT_BUFFER", "256"))
+# records written at once; the writer wakes up early when a session has this many waiting
+TRANSCRIPT_BATCH = 64
+TRANSCRIPT_FLUSH_INTERVAL = 1.0
+# one LLM request in this many is recorded (the first of each session always is)
+CHAT_LOG_EVERY = int(os.getenv("CHAT_LOG_EVERY", "10"))
+CHAT_LOG_CHARS = 200
+
+
+class TranscriptWriter:
+    """Appends the records of the registered sessions to ``path`` from a background thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sqlite = path.endswith((".sqlite", ".db"))
+        self.sessions = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.thread = threading.Thread(target=self.run, name="transcript-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def register(self, session):
+        with self.lock:
+            self.sessions.add(session)
+
+    def run(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = self.connect() if self.sqlite else None
+        while True:
+            self.wakeup.wait(TRANSCRIPT_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            closing = self.closing
+            while True:
+                records = self.take()
+                if not records:
+                    break
+                try:
+                    self.write(connection, records)
+                except (OSError, sqlite3.Error):
+                    logger.exception(f"failed to write {len(records)} transcript records to {self.path}")
+            if closing:
+                return
+
+    def take(self):
+        """Up to TRANSCRIPT_BATCH records of the sessions (the oldest first), forgetting the sessions done."""
+        records = []
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            # deque.popleft() is atomic, the event loop appends meanwhile
+            while session.buffer and len(records) < TRANSCRIPT_BATCH:
+                records.append(session.buffer.popleft())
+            if session.closed and not session.buffer:
+                with self.lock:
+                    self.sessions.discard(session)
+        return records
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS transcripts (time REAL, session TEXT, kind TEXT, record TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS transcripts_session ON transcripts (session, time)")
+        return connection
+
+    def write(self, connection, records):
+        if connection is not None:
+            with connection:
+                connection.executemany(
+                    "INSERT INTO transcripts VALUES (?, ?, ?, ?)",
+                    [(record['time'], record['session'], record['kind'], json.dumps(record, ensure_ascii=False))
+                     for record in records])
+        else:
+            # one write per batch, in append mode: lines of concurrent processes do not interleave
+            with open(self.path, 'a', encoding="UTF-8") as f:
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+
+    def close(self):
+        """Write what is left (at exit)."""
+        self.closing = True
+        self.wakeup.set()
+        self.thread.join(timeout=5)
+
+
+writers = {}
+writers_lock = threading.Lock()
+
+
+def get_writer(path=TRANSCRIPT_FILE):
+    """The process's writer of ``path`` (None when transcripts are disabled)."""
+    if not path:
+        return None
+    with writers_lock:
+        if path not in writers:
+            writers[path] = TranscriptWriter(path)
+        return writers[path]
+
+
+class SessionData:
+    """The transcript of one session: add its events, they are written in the background."""
+
+    def __init__(self, session, room=None, chatbot=None, participant=None, writer=None):
+        self.session = session
+        self.fields = {'room': room, 'chatbot': chatbot, 'participant': participant}
+        self.buffer = collections.deque(maxlen=TRANSCRIPT_BUFFER)
+        self.dropped = 0
+        self.closed = False
+        self.llm_requests = 0
+        self.writer = writer if writer is not None else get_writer()
+        if self.writer is not None:
+            self.writer.register(self)
+        self.add("session_start", **self.fields)
+
+    def add(self, kind, **record):
+        if self.writer is None or self.closed:
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append({'time': time.time(), 'session': self.session, 'kind': kind, **record})
+        if len(self.buffer) >= TRANSCRIPT_BATCH:
+            self.writer.wakeup.set()
+
+    def add_stt_transcript(self, transcript):
+        self.add("user", **transcript)
+
+    def add_llm_message(self, message):
+        self.add("assistant", **message)
+
+    def sample_llm_request(self, chat_ctx, prompt_tokens=None):
+        """Record the size of an LLM request and its question, for one request in CHAT_LOG_EVERY."""
+        self.llm_requests += 1
+        if (self.llm_requests - 1) % CHAT_LOG_EVERY:
+            return
+        question = next((msg.content for msg in reversed(chat_ctx.messages) if msg.role == "user"), None)
+        if not isinstance(question, str):
+            question = None
+        self.add("llm_request", request=self.llm_requests, messages=len(chat_ctx.messages),
+                 prompt_tokens=prompt_tokens, question=question[:CHAT_LOG_CHARS] if question else None)
+
+    async def aclose(self, reason=None):
+        # also a job shutdown callback, which gets the shutdown reason
+        if self.writer is not None and len(self.buffer) == self.buffer.maxlen:
+            # make room for the end of the session, counted with the records it reports
+            self.buffer.popleft()
+            self.dropped += 1
+        if self.dropped:
+            logger.warning(f"{self.dropped} transcript records of session {self.session} dropped, the writer fell behind")
+        self.add("session_end", reason=reason, llm_requests=self.llm_requests, dropped=self.dropped)
+        self.closed = True
+        if self.writer is not None:
+            self.writer.wakeup.set()
@@ -0,0 +1,84 @@
+import asyncio
+import dataclasses
+
+from livekit.agents import DEFAULT_API_CONNECT_OPTIONS, stt, utils
+
+
+class SpeculativeSTT(stt.STT):
+    """
+    STT passing the transcript of the user's turn so far (its final transcripts and the
+    current interim one) to ``on_transcript(text, final)`` as it is recognized by
+    ``stt_instance``, e.g. to start retrieving for the question before the turn ends.
+    Call new_turn() when a turn is committed (the agent's user_speech_committed event).
+
+    A wrapper rather than handlers on the agent's internals, so the streams the agent
+    opens again when the participant relinks report too.
+    """
+
+    def __init__(self, stt_instance, on_transcript):
+        super().__init__(capabilities=stt_instance.capabilities)
+        self._label = stt_instance.label
+        self._stt = stt_instance
+        self._on_transcript = on_transcript
+        self._finals = []
+
+        @self._stt.on("metrics_collected")
+        def forward_metrics(*args, **kwargs):
+            self.emit("metrics_collected", *args, **kwargs)
+
+    @property
+    def wrapped_stt(self):
+        return self._stt
+
+    def new_turn(self):
+        self._finals = []
+
+    def transcribed(self, event):
+        if not event.alternatives or not event.alternatives[0].text:
+            return
+        text = event.alternatives[0].text
+        if event.type == stt.SpeechEventType.FINAL_TRANSCRIPT:
+            self._finals.append(text)
+            self._on_transcript(" ".join(self._finals), True)
+        elif event.type == stt.SpeechEventType.INTERIM_TRANSCRIPT:
+            self._on_transcript(" ".join(self._finals + [text]), False)
+
+    async def _recognize_impl(self, buffer, *, language=None, conn_options=DEFAULT_API_CONNECT_OPTIONS):
+        return await self._stt.recognize(buffer=buffer, language=language, conn_options=conn_options)
+
+    def stream(self, *, language=None, conn_options=DEFAULT_API_CONNECT_OPTIONS):
+        return SpeculativeSpeechStream(stt=self, language=language, conn_options=conn_options)
+
+    async def aclose(self):
+        await self._stt.aclose()
+
+
+class SpeculativeSpeechStream(stt.RecognizeStream):
+    def __init__(self, *, stt, language, conn_options):
+        # the wrapped stream retries on its own
+        super().__init__(stt=stt, conn_options=dataclasses.replace(conn_options, max_retry=0))
+        self._language = language
+        self._wrapped_conn_options = conn_options
+
+    async def _metrics_monitor_task(self, event_aiter):
+        pass  # the wrapped stream reports them
+
+    async def _run(self):
+        stream = self._stt._stt.stream(language=self._language, conn_options=self._wrapped_conn_options)
+
+        async def forward_input():
+            async for data in self._input_ch:
+                if isinstance(data, self._FlushSentinel):
+                    stream.flush()
+                else:
+                    stream.push_frame(data)
+            stream.end_input()
+
+        input_task = asyncio.create_task(forward_input())
+        try:
+            async for event in stream:
+                self._stt.transcribed(event)
+                self._event_ch.send_nowait(event)
+        finally:
+            await utils.aio.gracefully_cancel(input_task)
+            await stream.aclose()
@@ -0,0 +1,43 @@
+import pytest
+
+from downloader import MixedTextNormalizer, normalize_text_file
+
+
+@pytest.fixture(scope="module")
+def normalizer():
+    return MixedTextNormalizer()
+
+
+@pytest.mark.parametrize("text", [
+    "https://example.com/a-b",
+    "info@example.com",
+    "Model-X",
+    "RAV4",
+    "e.g. the first one",
+    "Wi-Fi 6E, USB-C (3.2 Gen 2)",
+])
+def test_ascii_is_unchanged(normalizer, text):
+    assert normalizer.normalize(text) == text
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("日本語とEnglishの混在", "日本語と English の混在"),
+    ("日本 語  Apple  です", "日本語 Apple です"),
+    ("詳細はhttps://example.com/a-bへ", "詳細は https://example.com/a-b へ"),
+    ("お問い合わせはinfo@example.comまで", "お問い合わせは info@example.com まで"),
+    ("RAV4のModel-Xは", "RAV4の Model-X は"),
+    ("「Apple」です。", "「Apple」です。"),
+])
+def test_spaces_at_script_boundaries(normalizer, text, expected):
+    assert normalizer.normalize(text) == expected
+
+
+def test_leading_indentation_is_kept(normalizer):
+    assert normalizer.normalize("    - 項目ABC") == "    - 項目 ABC"
+
+
+def test_text_file_lines_keep_their_indentation(tmp_path):
+    path = tmp_path / "document.txt"
+    path.write_text("見出しTitle\n    print(x)の例\n", encoding="UTF-8")
+    assert normalize_text_file(str(path))
+    assert path.read_text(encoding="UTF-8") == "見出し Title\n    print(x)の例\n"
@@ -0,0 +1,203 @@
+import asyncio
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+
+import aiohttp
+from livekit import rtc
+from livekit.agents import tokenize, tts, utils
+
+logger = logging.getLogger("tts-cache")
+
+# synthesized audio of fixed phrases, 16-bit PCM, one file per phrase and voice
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "./tts-cache")
+# optional file of more fixed phrases (one per line) to synthesize ahead of time
+TTS_CACHE_PHRASES = os.getenv("TTS_CACHE_PHRASES", "")
+# duration of the frames cached audio is played in
+FRAME_MS = 50
+
+
+def fixed_phrases(*texts):
+    """``texts`` and the phrases of the TTS_CACHE_PHRASES file."""
+    phrases = list(texts)
+    if TTS_CACHE_PHRASES and os.path.exists(TTS_CACHE_PHRASES):
+        with open(TTS_CACHE_PHRASES, 'r', encoding="UTF-8") as f:
+            phrases.extend(line.strip() for line in f if line.strip())
+    return phrases
+
+
+def voice_key(tts_instance):
+    """Provider, model, voice and audio format of a TTS (the plugin options, without credentials)."""
+    options = getattr(tts_instance, '_opts', None)
+    options = dataclasses.asdict(options) if dataclasses.is_dataclass(options) else {}
+    options = {name: value for name, value in options.items() if 'key' not in name and 'url' not in name}
+    return json.dumps([tts_instance.label, tts_instance.sample_rate, tts_instance.num_channels, options],
+                      sort_keys=True, default=str)
+
+
+class TTSAudioCache:
+    """
+    Audio of fixed phrases synthesized by one TTS voice, on disk in ``directory`` and
+    the loaded phrases in memory. Phrases are keyed by the sha256 of the text and
+    voice_key(), so another voice, model or sample rate is synthesized again.
+    """
+
+    def __init__(self, tts_instance, directory=TTS_CACHE_DIR):
+        self.voice = voice_key(tts_instance)
+        self.sample_rate = tts_instance.sample_rate
+        self.num_channels = tts_instance.num_channels
+        self.directory = directory
+        self.audio = {}  # text -> PCM
+
+    def path(self, text):
+        return os.path.join(self.directory, hashlib.sha256(f"{self.voice}\n{text}".encode("utf-8")).hexdigest() + ".pcm")
+
+    def load(self, texts):
+        """Load the cached phrases among ``texts``, and return the others."""
+        missing = []
+        for text in texts:
+            try:
+                with open(self.path(text), 'rb') as f:
+                    self.audio[text] = f.read()
+            except FileNotFoundError:
+                missing.append(text)
+        return missing
+
+    async def fill(self, tts_instance, texts):
+        """Synthesize and store the phrases among ``texts`` not cached yet."""
+        os.makedirs(self.directory, exist_ok=True)
+        for text in self.load(texts):
+            frames = []
+            async with tts_instance.synthesize(text) as stream:
+                async for audio in stream:
+                    frames.append(audio.frame.data.tobytes())
+            path = self.path(text)
+            with open(path + ".tmp", 'wb') as f:
+                f.write(b"".join(frames))
+            os.replace(path + ".tmp", path)
+            self.audio[text] = b"".join(frames)
+            logger.info(f"synthesized {text[:30]!r} into {path}")
+
+    def has_prefix(self, text):
+        return any(phrase.startswith(text) for phrase in self.audio)
+
+    def frames(self, text):
+        """The cached audio of ``text`` as audio frames (None when not cached)."""
+        pcm = self.audio.get(text)
+        if pcm is None:
+            return None
+        samples = self.sample_rate * FRAME_MS // 1000
+        frame_bytes = samples * self.num_channels * 2
+        return [rtc.AudioFrame(data=pcm[start:start + frame_bytes], sample_rate=self.sample_rate,
+                               num_channels=self.num_channels,
+                               samples_per_channel=len(pcm[start:start + frame_bytes]) // (2 * self.num_channels))
+                for start in range(0, len(pcm), frame_bytes)]
+
+
+def load_tts_cache(create_tts, texts):
+    """The TTSAudioCache of ``texts`` for the TTS of create_tts(), for prewarm (None when it fails)."""
+    try:
+        cache = TTSAudioCache(create_tts())
+        missing = cache.load(texts)
+    except Exception:
+        logger.exception("failed to load the TTS cache")
+        return None
+    if missing:
+        logger.warning(f"{len(missing)} fixed phrases not synthesized yet, they will be synthesized by every session")
+    return cache
+
+
+async def fill_tts_cache(create_tts, texts):
+    """Synthesize the fixed phrases not cached yet, with the TTS of create_tts(http_session)."""
+    async with aiohttp.ClientSession() as http_session:
+        tts_instance = create_tts(http_session)
+        try:
+            await TTSAudioCache(tts_instance).fill(tts_instance, texts)
+        except Exception:
+            logger.exception("failed to synthesize the fixed phrases, they are synthesized by every session")
+        finally:
+            await tts_instance.aclose()
+
+
+class CachedTTS(tts.TTS):
+    """
+    TTS playing the phrases of a TTSAudioCache from the cache, and synthesizing any
+    other text with ``tts_instance`` as it streams in. Text is only held back while it
+    is the beginning of a cached phrase, so other replies are not delayed.
+    """
+
+    def __init__(self, tts_instance, cache):
+        super().__init__(capabilities=tts.TTSCapabilities(streaming=True), sample_rate=tts_instance.sample_rate,
+                         num_channels=tts_instance.num_channels)
+        self._label = tts_instance.label
+        self._tts = tts_instance
+        # what VoicePipelineAgent would use for a TTS without streaming
+        self._stream_tts = tts_instance if tts_instance.capabilities.streaming else tts.StreamAdapter(
+            tts=tts_instance, sentence_tokenizer=tokenize.basic.SentenceTokenizer())
+        self._cache = cache
+
+    def synthesize(self, text, *, conn_options=None):
+        return self._tts.synthesize(text, conn_options=conn_options)
+
+    def stream(self, *, conn_options=None):
+        return CachedSynthesizeStream(tts=self, conn_options=conn_options)
+
+    def prewarm(self):
+        self._tts.prewarm()
+
+    async def aclose(self):
+        await self._tts.aclose()
+
+
+class CachedSynthesizeStream(tts.SynthesizeStream):
+    async def _run(self):
+        cache = self._tts._cache
+        request_id = utils.shortuuid()
+        text = ""
+        stream = None
+        forward_task = None
+
+        async def forward(stream):
+            async for audio in stream:
+                self._event_ch.send_nowait(audio)
+
+        def synthesize():
+            nonlocal stream, forward_task
+            stream = self._tts._stream_tts.stream(conn_options=self._conn_options)
+            forward_task = asyncio.create_task(forward(stream))
+            if text:
+                stream.push_text(text)
+
+        try:
+            async for data in self._input_ch:
+                self._mark_started()
+                if stream is not None:
+                    if isinstance(data, self._FlushSentinel):
+                        stream.flush()
+                    else:
+                        stream.push_text(data)
+                elif isinstance(data, self._FlushSentinel):
+                    frames = cache.frames(text)
+                    if frames is None:
+                        synthesize()
+                        stream.flush()
+                    else:
+                        logger.info(f"playing {text[:30]!r} from the TTS cache")
+                        for i, frame in enumerate(frames):
+                            self._event_ch.send_nowait(
+                                tts.SynthesizedAudio(frame=frame, request_id=request_id, is_final=i == len(frames) - 1))
+                    text = ""
+                else:
+                    text += data
+                    if not cache.has_prefix(text):
+                        synthesize()
+                        text = ""
+            if stream is not None:
+                stream.end_input()
+                await forward_task
+        finally:
+            if stream is not None:
+                await utils.aio.gracefully_cancel(forward_task)
+                await stream.aclose()
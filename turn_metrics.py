@@ -0,0 +1,211 @@
+"""
+Per-turn latency of the voice agents: end of utterance (endpointing), transcription,
+retrieval, LLM time to first token and TTS time to first byte of every reply, one JSON
+line per turn in METRICS_FILE, and their histograms and percentiles per worker and
+chatbot:
+
+    python turn_metrics.py [--file metrics/turns.jsonl] [--since 3600] [--json | --prometheus]
+"""
+import argparse
+import bisect
+import collections
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+logger = logging.getLogger("turn-metrics")
+
+# one JSON line per turn, appended by every job process (empty to disable)
+METRICS_FILE = os.getenv("METRICS_FILE", "metrics/turns.jsonl")
+# workers sharing a METRICS_FILE are told apart by name
+WORKER_NAME = os.getenv("WORKER_NAME", socket.gethostname())
+STAGES = ("end_of_utterance", "transcription", "retrieval", "llm_ttft", "tts_ttfb", "total")
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 30.0)
+PERCENTILES = (50, 90, 95, 99)
+# turns kept waiting for their TTS metrics (a reply interrupted before it is synthesized never gets them)
+PENDING_TURNS = 16
+
+
+class MetricsWriter:
+    """Appends records to a JSON lines file from a background thread, off the event loop."""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="turn-metrics-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        self.records.put(record)
+
+    def run(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        while True:
+            records = [self.records.get()]
+            while not self.records.empty():
+                records.append(self.records.get())
+            try:
+                # one write per batch, in append mode: lines of concurrent processes do not interleave
+                with open(self.path, 'a', encoding="UTF-8") as f:
+                    f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+            except OSError:
+                logger.exception(f"failed to write turn metrics to {self.path}")
+
+
+writers = {}
+writers_lock = threading.Lock()
+
+
+def get_writer(path=METRICS_FILE):
+    """The process's writer of ``path`` (None when metrics are disabled)."""
+    if not path:
+        return None
+    with writers_lock:
+        if path not in writers:
+            writers[path] = MetricsWriter(path)
+        return writers[path]
+
+
+class TurnMetrics:
+    """
+    Collects the latency of each turn of a session from the agent's metrics_collected
+    events (collect()) and retrieval timings (add_retrieval()), keyed by the pipeline's
+    sequence id, and writes a turn once its TTS metrics arrived.
+    """
+
+    def __init__(self, chatbot=None, room=None, writer=None):
+        self.chatbot = chatbot
+        self.room = room
+        self.writer = writer if writer is not None else get_writer()
+        self.turns = collections.OrderedDict()  # sequence id -> stage -> seconds
+
+    def turn(self, sequence_id):
+        if sequence_id not in self.turns:
+            self.turns[sequence_id] = {}
+            if len(self.turns) > PENDING_TURNS:
+                self.turns.popitem(last=False)
+        return self.turns[sequence_id]
+
+    def add_retrieval(self, seconds):
+        """Count a retrieval of the reply being generated (from the LLM stream's context)."""
+        from livekit.agents.pipeline.pipeline_agent import SpeechDataContextVar
+        speech_data = SpeechDataContextVar.get(None)
+        if speech_data is not None:
+            turn = self.turn(speech_data.sequence_id)
+            turn['retrieval'] = turn.get('retrieval', 0.0) + seconds
+
+    def collect(self, agent_metrics):
+        # imported here so the report does not need livekit
+        from livekit.agents import metrics
+        if isinstance(agent_metrics, metrics.PipelineEOUMetrics):
+            turn = self.turn(agent_metrics.sequence_id)
+            turn['end_of_utterance'] = agent_metrics.end_of_utterance_delay
+            turn['transcription'] = agent_metrics.transcription_delay
+        elif isinstance(agent_metrics, metrics.PipelineLLMMetrics):
+            self.turn(agent_metrics.sequence_id)['llm_ttft'] = agent_metrics.ttft
+        elif isinstance(agent_metrics, metrics.PipelineTTSMetrics):
+            turn = self.turns.pop(agent_metrics.sequence_id, None)
+            # the greeting and other agent.say() replies have no turn
+            if turn is not None and 'llm_ttft' in turn:
+                turn['tts_ttfb'] = agent_metrics.ttfb
+                self.write(agent_metrics.sequence_id, turn)
+
+    def write(self, sequence_id, turn):
+        # from the end of the user's speech to the first audio of the reply
+        turn['total'] = turn.get('end_of_utterance', 0.0) + turn['llm_ttft'] + turn['tts_ttfb']
+        logger.info("turn latency " + ", ".join(f"{stage} {turn[stage]:.3f}s" for stage in STAGES if stage in turn))
+        if self.writer is not None:
+            self.writer.write({'time': time.time(), 'worker': WORKER_NAME, 'chatbot': self.chatbot,
+                               'room': self.room, 'sequence_id': sequence_id,
+                               **{stage: round(turn[stage], 4) for stage in STAGES if stage in turn}})
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def histogram(values):
+    """Cumulative count of values up to each of BUCKETS (and +Inf), like a Prometheus histogram."""
+    counts = [0] * (len(BUCKETS) + 1)
+    for value in values:
+        counts[bisect.bisect_left(BUCKETS, value)] += 1
+    cumulative = 0
+    result = []
+    for count in counts:
+        cumulative += count
+        result.append(cumulative)
+    return result
+
+
+def read_turns(path, since=None):
+    turns = []
+    with open(path, 'r', encoding="UTF-8") as f:
+        for line in f:
+            try:
+                turn = json.loads(line)
+            except ValueError:
+                continue  # a line being written
+            if since is None or turn['time'] >= since:
+                turns.append(turn)
+    return turns
+
+
+def aggregate(turns):
+    """(worker, chatbot) -> stage -> latencies, with "*" for all workers and all chatbots."""
+    groups = collections.defaultdict(lambda: collections.defaultdict(list))
+    for turn in turns:
+        for key in ((turn['worker'], turn['chatbot']), (turn['worker'], "*"), ("*", turn['chatbot']), ("*", "*")):
+            for stage in STAGES:
+                if stage in turn:
+                    groups[key][stage].append(turn[stage])
+    return groups
+
+
+def summary(groups):
+    return [{'worker': worker, 'chatbot': chatbot, 'stage': stage, 'count': len(values),
+             **{f"p{p}": percentile(values, p) for p in PERCENTILES},
+             'histogram': dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"], histogram(values)))}
+            for (worker, chatbot), stages in sorted(groups.items(), key=lambda item: [str(key) for key in item[0]])
+            for stage, values in stages.items()]
+
+
+def prometheus(groups):
+    lines = ["# TYPE voice_agent_turn_latency_seconds histogram"]
+    for (worker, chatbot), stages in groups.items():
+        if "*" in (worker, chatbot):
+            continue
+        for stage, values in stages.items():
+            labels = f'worker="{worker}",chatbot="{chatbot or ""}",stage="{stage}"'
+            for bound, count in zip([str(bound) for bound in BUCKETS] + ["+Inf"], histogram(values)):
+                lines.append(f'voice_agent_turn_latency_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'voice_agent_turn_latency_seconds_sum{{{labels}}} {sum(values)}')
+            lines.append(f'voice_agent_turn_latency_seconds_count{{{labels}}} {len(values)}')
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report the per-turn latency of the voice agents")
+    parser.add_argument('--file', default=METRICS_FILE, help='Turn metrics file of the agents')
+    parser.add_argument('--since', type=float, help='Only the turns of the last SINCE seconds')
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('--json', action='store_true', help='Percentiles and histograms as JSON')
+    output.add_argument('--prometheus', action='store_true',
+                        help='Histograms in the Prometheus text format (for a textfile collector)')
+    args = parser.parse_args()
+    groups = aggregate(read_turns(args.file, time.time() - args.since if args.since else None))
+    if args.json:
+        print(json.dumps(summary(groups), ensure_ascii=False, indent=2))
+    elif args.prometheus:
+        print(prometheus(groups), end="")
+    else:
+        print(f"{'worker':20} {'chatbot':16} {'stage':17} {'turns':>6} "
+              + " ".join(f"{f'p{p} ms':>8}" for p in PERCENTILES))
+        for row in summary(groups):
+            print(f"{row['worker']:20} {str(row['chatbot']):16} {row['stage']:17} {row['count']:6} "
+                  + " ".join(f"{row[f'p{p}'] * 1000:8.0f}" for p in PERCENTILES))
@@ -0,0 +1,249 @@
+import json
+import os
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+# normalized embeddings as one matrix (per-row float32 scales for int8), and the node of each row
+VECTORS_NAME = "vectors.npy"
+VECTOR_SCALES_NAME = "vector_scales.npy"
+VECTOR_NODES_NAME = "vector_nodes.json"
+# element type of new indexes: float32, or float16 / int8 for 2x / 4x smaller vectors
+# (a float16 query takes about 2.5x as long as a float32 one, an int8 query about as long)
+VECTOR_DTYPE = os.getenv("VECTOR_DTYPE", "float32")
+VECTOR_DTYPES = ("float32", "float16", "int8")
+# rows converted to float32 at a time when scoring float16 / int8 vectors (small enough for the CPU cache)
+SIMILARITY_BLOCK_ROWS = 256
+# a half float's bits shifted to the float32 exponent and mantissa are its value times 2**-112
+HALF_BITS_SHIFT = 13
+HALF_BITS_SCALE = np.float32(2.0 ** 112)
+# clears the copies of the sign bit that shifting the sign-extended bits leaves in the exponent
+HALF_BITS_MASK = np.int32(~0x70000000)
+
+
+def normalize(vectors):
+    # normalized once when stored, so a query is a plain dot product (cosine similarity)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def encode(vectors, dtype):
+    """Return the rows of a normalized float32 matrix as ``dtype`` and their int8 scales (else None)."""
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return vectors.astype(dtype), None
+
+
+def half_block_bits(block, out):
+    """
+    The float32 bits of the float16 ``block`` scaled by 2**-112, into the int32 ``out``:
+    numpy's own float16 conversion is several times slower than a few integer passes.
+    Embeddings are finite, so infinities and NaNs are not decoded.
+    """
+    np.copyto(out, block.view(np.int16))
+    np.left_shift(out, HALF_BITS_SHIFT, out=out)
+    np.bitwise_and(out, HALF_BITS_MASK, out=out)
+    return out.view(np.float32)
+
+
+def save_array(path, array):
+    # replaced, not rewritten: processes that mapped the previous file keep reading it
+    with open(path + ".tmp", 'wb') as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+class MmapVectorStore(BasePydanticVectorStore):
+    """
+    Vector store keeping the embeddings as one contiguous float32, float16 or int8
+    matrix in ``vectors.npy`` and the node ids separately in ``vector_nodes.json``.
+
+    A persisted store is memory-mapped read-only, so every process loading the same
+    index shares one copy through the page cache, and a query scores all rows with one
+    matrix product. Added and deleted nodes are applied in memory and written by
+    persist(), which is what StorageContext.persist() calls.
+    """
+
+    stores_text: bool = False
+
+    _dtype: str = PrivateAttr()
+    _vectors: Optional[np.ndarray] = PrivateAttr()
+    _scales: Optional[np.ndarray] = PrivateAttr()
+    _node_ids: List[str] = PrivateAttr()
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr()
+    _alive: List[bool] = PrivateAttr()
+    _pending: list = PrivateAttr()
+    _positions: dict = PrivateAttr()
+    _ref_doc_rows: dict = PrivateAttr()
+
+    def __init__(self, vectors: Optional[np.ndarray] = None, node_ids: Optional[List[str]] = None,
+                 ref_doc_ids: Optional[List[Optional[str]]] = None, scales: Optional[np.ndarray] = None,
+                 dtype: str = VECTOR_DTYPE) -> None:
+        super().__init__()
+        if dtype not in VECTOR_DTYPES:
+            raise ValueError(f"VECTOR_DTYPE must be one of {', '.join(VECTOR_DTYPES)}, not {dtype!r}")
+        node_ids = node_ids or []
+        if vectors is not None and len(vectors) != len(node_ids):
+            raise ValueError(f"{len(vectors)} vectors for {len(node_ids)} node ids")
+        self._dtype = dtype
+        self._vectors = vectors if node_ids else None
+        self._scales = scales
+        self._node_ids = list(node_ids)
+        self._ref_doc_ids = list(ref_doc_ids or [None] * len(node_ids))
+        self._alive = [True] * len(node_ids)
+        self._pending = []
+        self._index_rows()
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> "MmapVectorStore":
+        with open(os.path.join(persist_dir, VECTOR_NODES_NAME), 'r', encoding="UTF-8") as f:
+            nodes = json.load(f)
+        vectors = np.load(os.path.join(persist_dir, VECTORS_NAME), mmap_mode='r')
+        scales = None
+        if nodes['dtype'] == "int8":
+            scales = np.load(os.path.join(persist_dir, VECTOR_SCALES_NAME), mmap_mode='r')
+        return cls(vectors, nodes['node_ids'], nodes['ref_doc_ids'], scales, nodes['dtype'])
+
+    @classmethod
+    def from_simple_vector_store(cls, vector_store, dtype: str = VECTOR_DTYPE) -> "MmapVectorStore":
+        """Convert the JSON SimpleVectorStore indexes used to be persisted with."""
+        data = vector_store.data
+        node_ids = list(data.embedding_dict)
+        if not node_ids:
+            return cls(dtype=dtype)
+        vectors, scales = encode(
+            normalize(np.array([data.embedding_dict[node_id] for node_id in node_ids], dtype=np.float32)), dtype)
+        return cls(vectors, node_ids, [data.text_id_to_ref_doc_id.get(node_id) for node_id in node_ids], scales, dtype)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    @property
+    def dtype(self) -> str:
+        return self._dtype
+
+    @property
+    def node_ids(self) -> List[str]:
+        self._compact()
+        return list(self._node_ids)
+
+    def get(self, node_id: str) -> List[float]:
+        """Normalized embedding of a node (decoded to float32)."""
+        self._compact()
+        row = self._positions[node_id]
+        vector = self._vectors[row].astype(np.float32)
+        return (vector * self._scales[row] if self._scales is not None else vector).tolist()
+
+    def _index_rows(self):
+        self._positions = {node_id: row for row, node_id in enumerate(self._node_ids) if self._alive[row]}
+        self._ref_doc_rows = {}
+        for row, ref_doc_id in enumerate(self._ref_doc_ids):
+            if self._alive[row]:
+                self._ref_doc_rows.setdefault(ref_doc_id, []).append(row)
+
+    def _compact(self):
+        """Apply pending additions and deletions to the matrix (an in-memory copy from then on)."""
+        if not self._pending and all(self._alive):
+            return
+        blocks = ([(self._vectors, self._scales)] if self._vectors is not None else []) + self._pending
+        keep = np.flatnonzero(self._alive)
+        if len(keep):
+            self._vectors = np.concatenate([vectors for vectors, _ in blocks])[keep]
+            self._scales = np.concatenate([scales for _, scales in blocks])[keep] if self._dtype == "int8" else None
+        else:
+            self._vectors = self._scales = None
+        self._node_ids = [self._node_ids[row] for row in keep]
+        self._ref_doc_ids = [self._ref_doc_ids[row] for row in keep]
+        self._alive = [True] * len(keep)
+        self._pending = []
+        self._index_rows()
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        vectors = normalize(np.array([node.get_embedding() for node in nodes], dtype=np.float32))
+        self._pending.append(encode(vectors, self._dtype))
+        for node in nodes:
+            self._ref_doc_rows.setdefault(node.ref_doc_id, []).append(len(self._node_ids))
+            self._positions[node.node_id] = len(self._node_ids)
+            self._node_ids.append(node.node_id)
+            self._ref_doc_ids.append(node.ref_doc_id)
+            self._alive.append(True)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        for row in self._ref_doc_rows.pop(ref_doc_id, []):
+            self._alive[row] = False
+            self._positions.pop(self._node_ids[row], None)
+
+    def persist(self, persist_path: str, fs: Any = None) -> None:
+        directory = os.path.dirname(persist_path)
+        self._compact()
+        vectors = self._vectors if self._vectors is not None else np.zeros((0, 0), dtype=self._dtype)
+        save_array(os.path.join(directory, VECTORS_NAME), vectors)
+        if self._dtype == "int8":
+            scales = self._scales if self._scales is not None else np.zeros(0, dtype=np.float32)
+            save_array(os.path.join(directory, VECTOR_SCALES_NAME), scales)
+        path = os.path.join(directory, VECTOR_NODES_NAME)
+        with open(path + ".tmp", 'w', encoding="UTF-8") as f:
+            json.dump({'dtype': self._dtype, 'node_ids': self._node_ids, 'ref_doc_ids': self._ref_doc_ids}, f)
+        os.replace(path + ".tmp", path)
+
+    def similarities(self, query_embedding, rows=None) -> np.ndarray:
+        """Cosine similarity of the query with every row (or ``rows``) of the matrix."""
+        vectors = self._vectors if rows is None else self._vectors[rows]
+        query_embedding = normalize(np.asarray(query_embedding, dtype=np.float32))
+        if vectors.dtype == np.float32:
+            similarities = vectors @ query_embedding
+        elif vectors.dtype == np.float16:
+            similarities = np.empty(len(vectors), dtype=np.float32)
+            buffer = np.empty((SIMILARITY_BLOCK_ROWS, vectors.shape[1]), dtype=np.int32)
+            # the 2**-112 of the decoded rows is taken back on the query, so no product is subnormal
+            query_embedding = query_embedding * HALF_BITS_SCALE
+            for start in range(0, len(vectors), SIMILARITY_BLOCK_ROWS):
+                block = vectors[start:start + SIMILARITY_BLOCK_ROWS]
+                np.matmul(half_block_bits(block, buffer[:len(block)]), query_embedding,
+                          out=similarities[start:start + len(block)])
+        else:
+            similarities = np.empty(len(vectors), dtype=np.float32)
+            buffer = np.empty((SIMILARITY_BLOCK_ROWS, vectors.shape[1]), dtype=np.float32)
+            for start in range(0, len(vectors), SIMILARITY_BLOCK_ROWS):
+                block = vectors[start:start + SIMILARITY_BLOCK_ROWS]
+                np.copyto(buffer[:len(block)], block, casting='unsafe')
+                np.matmul(buffer[:len(block)], query_embedding, out=similarities[start:start + len(block)])
+        if self._scales is not None:
+            similarities *= self._scales if rows is None else self._scales[rows]
+        return similarities
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.filters is not None or query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError("MmapVectorStore only supports default queries without metadata filters")
+        self._compact()
+        rows = None
+        node_ids = self._node_ids
+        if query.node_ids is not None:
+            rows = [self._positions[node_id] for node_id in query.node_ids if node_id in self._positions]
+            node_ids = [node_ids[row] for row in rows]
+        if not node_ids:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        similarities = self.similarities(query.query_embedding, rows)
+        k = min(query.similarity_top_k, len(node_ids))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return VectorStoreQueryResult(similarities=similarities[top].tolist(), ids=[node_ids[i] for i in top])
@@ -0,0 +1,157 @@
+"""
+Warmup of the voice pipeline ahead of the first participant, to shorten the time from a
+participant joining to the greeting. The local models are loaded and run once per job
+process (prewarm), the provider connections are opened and the turn detector run once
+per session, in the entrypoint while the agent waits for the participant. Every step
+is timed and the timings logged per component.
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
+import os
+import time
+
+import httpx
+import openai
+from livekit import rtc
+from livekit.agents import llm
+from livekit.plugins import noise_cancellation, silero
+
+logger = logging.getLogger("warmup")
+
+# components warmed ahead of the first participant: a dummy run of the local models
+# (vad, turn_detector, retrieval), the noise cancellation model read into memory and
+# a connection opened to the providers (stt, llm, tts)
+WARMUP = [name for name in os.getenv("WARMUP", "vad,noise_cancellation,turn_detector,stt,llm,tts,retrieval").split(",")
+          if name]
+# seconds the session warmup may take, slower steps are left to the first turn
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))
+WARMUP_TEXT = "Hello"
+# silence streamed through the VAD, a few inference windows
+VAD_SAMPLE_RATE = 16000
+VAD_WARMUP_SECONDS = 0.1
+# API of the Deepgram STT plugin, whose connection is opened ahead of time
+DEEPGRAM_URL = "https://api.deepgram.com"
+
+
+class WarmupTimings:
+    """Duration of each warmup step of a stage ("process" or "session")."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = time.perf_counter()
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def timed(self, component):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[component] = time.perf_counter() - start
+
+    def report(self):
+        logger.info(f"{self.stage} warmup in {time.perf_counter() - self.start:.3f}s: "
+                    + ", ".join(f"{component} {seconds:.3f}s" for component, seconds in self.timings.items()))
+
+
+def load_vad():
+    """Silero VAD, run once on silence so its inference session is initialized."""
+    vad = silero.VAD.load()
+    if "vad" in WARMUP:
+        # on a loop of its own, prewarm may be called outside or inside an event loop
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(asyncio.run, warm_vad(vad)).result()
+    return vad
+
+
+async def warm_vad(vad):
+    """Stream VAD_WARMUP_SECONDS of silence through a VAD stream (the one inference session of ``vad``)."""
+    samples = int(VAD_SAMPLE_RATE * VAD_WARMUP_SECONDS)
+    stream = vad.stream()
+    try:
+        stream.push_frame(rtc.AudioFrame(data=bytes(2 * samples), sample_rate=VAD_SAMPLE_RATE, num_channels=1,
+                                         samples_per_channel=samples))
+        stream.end_input()
+        async for _ in stream:
+            pass
+    finally:
+        await stream.aclose()
+
+
+def load_noise_cancellation():
+    """Krisp background voice cancellation, with its model file read into the page cache."""
+    options = noise_cancellation.BVC()
+    if "noise_cancellation" in WARMUP:
+        # the filter loads the model when the participant's audio stream starts
+        with open(options.options["modelPath"], 'rb') as f:
+            while f.read(1024 * 1024):
+                pass
+    return options
+
+
+async def warm_turn_detector(model):
+    """Run the turn detector once (in the worker's inference process)."""
+    await model.predict_end_of_turn(llm.ChatContext().append(role="user", text=WARMUP_TEXT))
+
+
+def create_openai_http_client():
+    """The HTTP client the LLM and TTS plugins would create for their OpenAI client."""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(connect=15.0, read=5.0, write=5.0, pool=5.0),
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=50, keepalive_expiry=120),
+    )
+
+
+def create_openai_client(http_client=None):
+    """
+    OpenAI client for the LLM and TTS plugins of a session (their ``client``), on
+    ``http_client`` (by default create_openai_http_client()), so warm_openai() warms the
+    connections they use, and those of any other client on the same ``http_client``.
+    """
+    return openai.AsyncClient(max_retries=0, http_client=http_client or create_openai_http_client())
+
+
+async def warm_openai(client):
+    """Open the keep-alive connection of an OpenAI client, with a request that costs no tokens."""
+    await client.models.list()
+
+
+async def warm_http(http_session, url):
+    """DNS, TCP and TLS of a keep-alive connection of ``http_session`` (the one given to a plugin) to ``url``."""
+    async with http_session.head(url):
+        pass
+
+
+async def warm_tts(tts_instance):
+    """TTS.prewarm(): websocket plugins (cartesia) connect ahead of time."""
+    tts_instance.prewarm()
+
+
+async def warm_session(steps):
+    """
+    Run the warmup ``steps`` (component -> function returning an awaitable) of the
+    components enabled in WARMUP concurrently, within WARMUP_TIMEOUT; a failed step
+    only loses its warmup.
+    """
+    timings = WarmupTimings("session")
+
+    async def run(component, step):
+        with timings.timed(component):
+            try:
+                await step()
+            except Exception as e:
+                logger.warning(f"warmup of {component} failed: {e!r}")
+
+    tasks = {asyncio.create_task(run(component, step)): component for component, step in steps.items()
+             if component in WARMUP}
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=WARMUP_TIMEOUT)
+    for task in pending:
+        logger.warning(f"warmup of {tasks[task]} not done in {WARMUP_TIMEOUT}s, cancelled")
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    timings.report()